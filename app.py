@@ -1,6 +1,24 @@
-from flask import Flask, url_for, render_template, request, flash, redirect
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, Blueprint, current_app, url_for, render_template, request, flash, redirect, Response, stream_with_context, get_flashed_messages, g, session, jsonify, abort
+from flask import has_request_context, has_app_context, before_render_template, template_rendered, send_from_directory
+from flask.sessions import SessionInterface, SecureCookieSession
+from flask.json.tag import TaggedJSONSerializer
+from markupsafe import Markup
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine as sa_create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.http import is_resource_modified, parse_accept_header
+from werkzeug.wsgi import wrap_file, ClosingIterator
+from werkzeug.urls import url_decode
+from werkzeug.exceptions import HTTPException
+from itsdangerous import URLSafeSerializer, BadSignature
+from jinja2 import FileSystemBytecodeCache
+from jinja2.ext import Extension
+import zlib
 # 扩展flask_login提供给了实现用户认证需要的各类功能函数
 # login_required用于视图保护
 # 在视图保护层面来说，未登录用户不能执行下面的操作：
@@ -14,10 +32,38 @@ from werkzeug.security import generate_password_hash, check_password_hash
 # flask-login是扩展库，需要单独安装
 # Flask-Login 提供了一个 current_user 变量，注册这个函数的目的是，当程序运行后，如果用户已登录， current_user 变量的值会是当前用户的用户模型类记录
 # 继承UserMixin这个类会让 User 类拥有几个用于判断认证状态的属性和方法，其中最常用的是 is_authenticated 属性：如果当前用户已经登录，那么 current_user.is_authenticated 会返回 True， 否则返回 False
-from flask_login import LoginManager, login_user, logout_user, login_required, current_user, UserMixin
+from flask_login import LoginManager, login_user, logout_user, login_required, current_user, UserMixin, user_logged_in
 import os
 import sys
+import time
+import hashlib
+import secrets
+import threading
+import csv
+import json
+import re
+import gzip
+import shutil
+import sqlite3
+import mimetypes
+import subprocess
+import importlib.util
+import random
+import cProfile
+import pstats
+import io
+import itertools
+from collections import namedtuple, OrderedDict, deque
+from datetime import datetime, timedelta
 import click
+from functools import wraps
+
+# 可选依赖：生成brotli压缩文件和响应压缩
+# Pillow只在构建静态文件时使用，在 convert_animation 中再导入，不拖慢worker启动
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # 数据库URI前缀校验
 WIN = sys.platform.startswith('win')
@@ -26,29 +72,634 @@ if WIN:
 else:
     prefix = 'sqlite:////' # 否则使用四个斜线
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = prefix + os.path.join(app.root_path, 'data.db')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False # 关闭对模型修改的监控
-# flash() 函数在内部会把消息存储到 Flask 提供的 session 对象里。
-# session 用来在请求间存储数据，它会把数据签名后存储到浏览器的 Cookie 中，所以我们需要设置签名所需的密钥
-app.config['SECRET_KEY'] = 'dev'
+# SQLite连接配置
+# default：保持SQLite默认设置
+# tuned：开启WAL日志模式（写入时不阻塞读取）、降低同步级别、设置忙等待超时、内存映射I/O和更大的页缓存，
+#        并为每个worker使用连接池复用连接，避免每个请求都重新打开数据库和执行PRAGMA
+SQLITE_PROFILES = {
+    'default': OrderedDict(),
+    'tuned': OrderedDict([
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('busy_timeout', 5000), # 毫秒
+        ('mmap_size', 256 * 1024 * 1024), # 字节
+        ('cache_size', -64 * 1024), # 负数表示KiB
+        ('temp_store', 'MEMORY'),
+    ]),
+}
+
+# 程序工厂函数
+# 每次调用创建一个新的程序实例，config中的配置会覆盖下面的默认值。
+# flask命令会自动找到这个函数；使用gunicorn时每个worker各自创建实例：gunicorn "app:create_app()"
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = prefix + os.path.join(app.root_path, 'data.db')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False # 关闭对模型修改的监控
+    # flash() 函数在内部会把消息存储到 Flask 提供的 session 对象里。
+    # session 用来在请求间存储数据，它会把数据签名后存储到浏览器的 Cookie 中，所以我们需要设置签名所需的密钥
+    app.config['SECRET_KEY'] = 'dev'
+    # 主页分页：每页默认条数和允许的最大条数
+    app.config['MOVIES_PER_PAGE'] = 100
+    app.config['MOVIES_MAX_PER_PAGE'] = 1000
+    # 主页是否默认使用流式渲染（也可以通过 ?stream=1 临时开启）
+    app.config['STREAM_INDEX'] = False
+    # 电影列表HTML片段缓存的最大条目数
+    app.config['FRAGMENT_CACHE_SIZE'] = 256
+    # 用户资料和电影数量缓存的最大条目数
+    app.config['USER_CACHE_SIZE'] = 4096
+    # 静态文件构建目录（static下的子目录）和指纹文件的缓存时间
+    app.config['ASSET_DIST_DIR'] = 'dist'
+    app.config['ASSET_MAX_AGE'] = 365 * 24 * 3600
+    # 响应压缩：小于阈值（字节）的响应不压缩
+    app.config['COMPRESSION_ENABLED'] = True
+    app.config['COMPRESSION_MIN_SIZE'] = 500
+    app.config['COMPRESSION_LEVEL'] = 6
+    # 编译模板时去掉HTML注释和缩进
+    app.config['MINIFY_TEMPLATES'] = True
+    # 模板编译结果（字节码）的缓存目录，多个worker和重启后的进程共用，为None时不缓存
+    app.config['TEMPLATE_CACHE_DIR'] = os.path.join(app.instance_path, 'template-cache')
+    # 创建程序实例时就编译（或从缓存目录读取）全部模板，不必等到第一个请求
+    app.config['PRECOMPILE_TEMPLATES'] = True
+    # 请求耗时统计：Server-Timing响应头和 /metrics 接口
+    app.config['METRICS_ENABLED'] = True
+    # 访问 /metrics 需要 Authorization: Bearer <token>；没有设置时接口不对外开放（返回404）
+    app.config['METRICS_TOKEN'] = os.getenv('WATCHLIST_METRICS_TOKEN')
+    # 密码散列方法（即散列强度），修改后用户下次登录时会自动按新方法重新散列
+    app.config['PASSWORD_HASH_METHOD'] = os.getenv('WATCHLIST_HASH_METHOD', 'pbkdf2:sha256:260000')
+    # 计算密码散列的进程数，为0时在请求线程中直接计算
+    app.config['HASH_WORKERS'] = int(os.getenv('WATCHLIST_HASH_WORKERS', os.cpu_count() or 1))
+    # 同时等待计算的散列任务上限，超出时直接拒绝登录请求
+    app.config['HASH_QUEUE_SIZE'] = 32
+    app.config['HASH_TIMEOUT'] = 10
+    # 同一IP在时间窗口（秒）内登录失败达到次数上限后，在计算散列之前就拒绝请求
+    app.config['LOGIN_RATE_LIMIT'] = 10
+    app.config['LOGIN_RATE_WINDOW'] = 300
+    # SQLite连接配置，见 SQLITE_PROFILES
+    app.config['SQLITE_PROFILE'] = os.getenv('WATCHLIST_DB_PROFILE', 'tuned')
+    app.config['SQLITE_PRAGMAS'] = None # 为None时使用SQLITE_PROFILE对应的设置
+    app.config['SQLITE_POOL_SIZE'] = int(os.getenv('WATCHLIST_DB_POOL_SIZE', 5))
+    app.config['SQLITE_MAX_OVERFLOW'] = int(os.getenv('WATCHLIST_DB_MAX_OVERFLOW', 10))
+    # 读写分离：GET请求从只读库读取，写操作仍然使用主库，见 ReadRouter
+    # 只读库的URI，例如由外部工具同步的副本：sqlite:///file:/srv/replica.db?mode=ro&uri=true
+    app.config['SQLALCHEMY_READ_URI'] = os.getenv('WATCHLIST_READ_URI')
+    # 没有设置只读库时，可以设置间隔（秒）让程序用SQLite备份接口定期生成主库的快照来读取，为None时不开启
+    app.config['READ_SNAPSHOT_INTERVAL'] = None
+    app.config['READ_SNAPSHOT_PATH'] = os.path.join(app.instance_path, 'read-snapshot.db')
+    # 用户提交写操作后的这段时间（秒）内，他的请求都从主库读取，应该大于只读库的同步延迟
+    app.config['READ_STICKY_SECONDS'] = 10
+    # ASGI入口（asgi.py）：在线程池中处理的请求的线程数，以及异步驱动的连接池大小
+    app.config['ASGI_THREADS'] = int(os.getenv('WATCHLIST_ASGI_THREADS', 32))
+    app.config['ASGI_POOL_SIZE'] = 10
+    # 线程池中生成的响应最多缓冲的块数，客户端接收慢时工作线程等待，而不是把整个响应读进内存
+    app.config['ASGI_QUEUE_SIZE'] = 16
+    # 服务端session，见 ServerSessionInterface：None时使用Flask默认的签名Cookie；
+    # memory 保存在进程内（每个worker各自保存，适合单进程部署）；sqlite 保存在多个worker共用的SQLite文件中
+    # 过期时间使用Flask的 PERMANENT_SESSION_LIFETIME
+    app.config['SESSION_STORE'] = os.getenv('WATCHLIST_SESSION_STORE')
+    app.config['SESSION_STORE_SIZE'] = 10000 # memory：最多保存的session数量
+    app.config['SESSION_STORE_PATH'] = os.path.join(app.instance_path, 'sessions.db')
+    # 列表页面的实时更新（/events），见 ChangeBroadcaster。默认关闭：每个打开的页面都保持一个长连接，
+    # 同步worker（gunicorn默认）中一个连接占用整个worker；建议只在 asgi.py 入口下开启，连接在事件循环中保持
+    app.config['LIVE_UPDATES'] = bool(os.getenv('WATCHLIST_LIVE_UPDATES'))
+    # 每个进程查询变更记录的间隔（秒），本进程内的写入会立即推送
+    app.config['LIVE_POLL_INTERVAL'] = 1.0
+    # 没有变化时发送心跳的间隔（秒），及时发现已经断开的连接
+    app.config['LIVE_HEARTBEAT'] = 15
+    # 一个连接最长保持的时间（秒），之后浏览器会带着 Last-Event-ID 自动重连
+    app.config['LIVE_MAX_SECONDS'] = 300
+    # 每个进程同时保持的连接数上限。asgi.py 在事件循环中保持连接，不占用线程；
+    # 在线程中处理时每个连接占用一个线程，上限不超过线程池的一半（见 WatchlistASGI），其余线程留给其他请求
+    app.config['LIVE_MAX_CLIENTS'] = 100
+    # 进程内缓冲的最近变化的条数，断开不久的连接从缓冲区补齐，更早的从数据库补齐
+    app.config['LIVE_BUFFER_SIZE'] = 1000
+    # 后台任务，见 JobQueue：程序进程内执行任务的线程数，为0时只由 flask worker 执行
+    # （测试模式和内存数据库不会自动启动任务线程）
+    app.config['JOB_WORKER_THREADS'] = int(os.getenv('WATCHLIST_JOB_THREADS', 1))
+    # 没有任务时查询新任务的间隔（秒），本进程创建的任务会立即唤醒任务线程
+    app.config['JOB_POLL_INTERVAL'] = 1.0
+    # 失败后的重试：最多执行的次数，第n次重试前等待 JOB_RETRY_DELAY * 2^(n-1) 秒
+    app.config['JOB_MAX_ATTEMPTS'] = 3
+    app.config['JOB_RETRY_DELAY'] = 5
+    # 执行中的任务超过这个时间（秒）没有报告进度时视为执行它的进程已经退出，重新排队
+    app.config['JOB_LEASE_SECONDS'] = 300
+    # 已结束的任务保留的天数
+    app.config['JOB_KEEP_DAYS'] = 7
+    # 通过 /api/import 上传的待导入文件
+    app.config['JOB_UPLOAD_DIR'] = os.path.join(app.instance_path, 'uploads')
+    # 合并提交，见 GroupCommitWriter：并发请求添加的条目合并到一个事务中提交，
+    # 批次写入磁盘后才返回（synchronous=NORMAL时提交者的连接临时改为FULL）
+    app.config['GROUP_COMMIT'] = bool(os.getenv('WATCHLIST_GROUP_COMMIT'))
+    # 一个事务最多包含的写入数，以及第一个写入最多等待其他写入的时间（秒）
+    app.config['GROUP_COMMIT_MAX_BATCH'] = 64
+    app.config['GROUP_COMMIT_MAX_DELAY'] = 0.002
+    # 电影海报，见 store_poster：原图和缩略图按内容散列保存的目录
+    app.config['POSTER_DIR'] = os.path.join(app.instance_path, 'posters')
+    # 缩略图的宽度（像素），按2:3裁剪并转为WebP，页面通过srcset让浏览器按显示尺寸和屏幕密度选择
+    app.config['POSTER_WIDTHS'] = (92, 185, 342)
+    app.config['POSTER_QUALITY'] = 80
+    # 上传文件的大小和图片像素数上限，超过像素数的图片不解码
+    app.config['POSTER_MAX_BYTES'] = 10 * 1024 * 1024
+    app.config['POSTER_MAX_PIXELS'] = 40 * 1000 * 1000
+    # 生成缩略图的进程数，为0时在任务线程中直接处理
+    app.config['POSTER_WORKERS'] = int(os.getenv('WATCHLIST_POSTER_WORKERS', 2))
+    app.config['POSTER_TIMEOUT'] = 60
+    # 缩略图文件信息（路径和大小）缓存的条目数，命中时发送文件前不需要访问文件系统
+    app.config['POSTER_CACHE_SIZE'] = 10000
+    # 线上请求的性能分析，见 ProfilingMiddleware：关闭时不安装中间件
+    app.config['PROFILING'] = bool(os.getenv('WATCHLIST_PROFILING'))
+    # 按比例随机分析请求（0到1），以及这些请求使用的分析方式（sample 或 cprofile）
+    app.config['PROFILE_SAMPLE_RATE'] = float(os.getenv('WATCHLIST_PROFILE_SAMPLE_RATE', 0))
+    app.config['PROFILE_MODE'] = 'sample'
+    # 只分析这些视图的请求
+    app.config['PROFILE_ENDPOINTS'] = ('main.index', 'main.user_watchlist', 'main.edit', 'main.login', 'main.settings')
+    # 栈采样的间隔（秒）
+    app.config['PROFILE_INTERVAL'] = 0.005
+    # 分析结果的保存目录和保留的数量，超出时删除最早的结果
+    app.config['PROFILE_DIR'] = os.path.join(app.instance_path, 'profiles')
+    app.config['PROFILE_KEEP'] = 200
+    if config:
+        app.config.update(config)
+
+    # 初始化扩展，传入程序实例app
+    db.init_app(app)
+    app.extensions['watchlist_reads'] = ReadRouter(app)
+    app.extensions['watchlist_live'] = ChangeBroadcaster(app)
+    app.extensions['watchlist_jobs'] = JobQueue(app)
+    app.extensions['watchlist_writes'] = GroupCommitWriter(app)
+    login_manager.init_app(app)
+    app.register_blueprint(bp)
+    # 用支持预压缩文件的视图替换默认的静态文件视图
+    app.view_functions['static'] = static_file
+    app.wsgi_app = CompressionMiddleware(app.wsgi_app, app.config)
+    if app.config['PROFILING']:
+        app.wsgi_app = ProfilingMiddleware(app.wsgi_app, app)
+    before_render_template.connect(template_started, app)
+    template_rendered.connect(template_finished, app)
+    setup_templates(app)
+    if app.config['SESSION_STORE']:
+        app.session_interface = ServerSessionInterface(app.config)
+
+    with app.app_context():
+        load_asset_manifest()
+        if app.config['PRECOMPILE_TEMPLATES']:
+            compile_templates()
+        # 模型映射在第一次查询时才配置，这里提前完成
+        db.configure_mappers()
+    return app
+
+# 开启优化时使用的连接池参数，内存数据库只有一个连接，保持扩展的默认设置
+def sqlite_engine_options(pragmas, pool_size, max_overflow):
+    if not pragmas:
+        return {}
+    return {
+        'poolclass': QueuePool,
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        # 连接池中的连接会被不同线程使用
+        'connect_args': {'check_same_thread': False},
+    }
+
+# 每个新连接建立时执行PRAGMA，连接被连接池复用后不再重复执行
+def listen_sqlite_pragmas(engine, pragmas):
+    @db.event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+    # 临时提高过同步级别的连接（见 GroupCommitWriter）归还连接池时恢复原来的设置
+    @db.event.listens_for(engine, 'checkin')
+    def restore_synchronous(dbapi_connection, connection_record):
+        level = connection_record.info.pop('restore_synchronous', None)
+        if level is not None and dbapi_connection is not None:
+            cursor = dbapi_connection.cursor()
+            cursor.execute('PRAGMA synchronous = %s' % level)
+            cursor.close()
+
+def sqlite_pragmas(config):
+    if config['SQLITE_PRAGMAS'] is not None:
+        return config['SQLITE_PRAGMAS']
+    return SQLITE_PROFILES[config['SQLITE_PROFILE']]
+
+class WatchlistSQLAlchemy(SQLAlchemy):
+    def apply_driver_hacks(self, app, sa_url, options):
+        # 扩展在没有设置pool_size时会为SQLite文件数据库使用NullPool，这里先填入连接池参数，
+        # SQLALCHEMY_ENGINE_OPTIONS 中显式给出的参数会在之后覆盖这些默认值
+        if sa_url.drivername == 'sqlite' and sa_url.database not in (None, '', ':memory:'):
+            options.update(sqlite_engine_options(sqlite_pragmas(app.config), app.config['SQLITE_POOL_SIZE'],
+                                                 app.config['SQLITE_MAX_OVERFLOW']))
+        return super(WatchlistSQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+
+    # 会话使用 RoutingSession，按请求把查询分配到主库或只读库
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super(WatchlistSQLAlchemy, self).create_engine(sa_url, engine_opts)
+        if sa_url.drivername.startswith('sqlite'):
+            listen_sqlite_pragmas(engine, sqlite_pragmas(self.get_app().config))
+        listen_query_timing(engine)
+        return engine
+
+# 记录每个请求执行的SQL语句数量和耗时
+def listen_query_timing(engine):
+    @db.event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append((context, time.perf_counter()))
+
+    @db.event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()[1]
+        if has_request_context() and 'timing' in g:
+            g.timing['db'] += elapsed
+            g.timing['queries'] += 1
+
+    # 语句出错（例如违反唯一约束）时不会触发 after_cursor_execute，丢弃这条语句的开始时间，
+    # 否则连接放回连接池后，之后的语句会取到错误的开始时间
+    @db.event.listens_for(engine, 'handle_error')
+    def handle_error(exception_context):
+        connection = exception_context.connection
+        starts = connection.info.get('query_start') if connection is not None else None
+        if starts and starts[-1][0] is exception_context.execution_context:
+            starts.pop()
+
+# 只读请求（g.read_engine 由 route_reads 设置）的查询使用只读库；
+# flush和UPDATE/DELETE等写语句始终使用主库，即使它们出现在GET请求中
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if has_request_context() and g.get('read_engine') is not None \
+                and not self._flushing and not isinstance(clause, UpdateBase):
+            return g.read_engine
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+# 只读库
+# 设置了 SQLALCHEMY_READ_URI 时直接打开该数据库；否则设置了 READ_SNAPSHOT_INTERVAL 时，
+# 用SQLite备份接口把主库复制到快照文件，快照超过间隔时间后在下一个请求中重新生成。
+# 新快照写入临时文件后原子替换旧文件，已经打开旧快照的连接不受影响，随后的请求换用打开新快照的引擎。
+# 快照不会再被修改，以immutable方式打开，读取时不需要加锁
+class ReadRouter(object):
+    def __init__(self, app):
+        self.app = app
+        self._lock = threading.Lock()
+        self._engine = None
+        self._stamp = None # 当前引擎打开的快照文件的 (inode, 修改时间)
+
+    @property
+    def enabled(self):
+        config = self.app.config
+        return bool(config['SQLALCHEMY_READ_URI'] or config['READ_SNAPSHOT_INTERVAL'])
+
+    def get_engine(self):
+        if self.app.config['SQLALCHEMY_READ_URI']:
+            if self._engine is None:
+                with self._lock:
+                    if self._engine is None:
+                        self._engine = self.create_engine(self.app.config['SQLALCHEMY_READ_URI'])
+            return self._engine
+        return self._snapshot_engine()
+
+    def create_engine(self, uri):
+        # 只读连接不能修改日志模式
+        pragmas = OrderedDict((name, value) for name, value in sqlite_pragmas(self.app.config).items()
+                              if name != 'journal_mode')
+        engine = sa_create_engine(uri, **sqlite_engine_options(
+            pragmas, self.app.config['SQLITE_POOL_SIZE'], self.app.config['SQLITE_MAX_OVERFLOW']))
+        listen_sqlite_pragmas(engine, pragmas)
+        listen_query_timing(engine)
+        return engine
+
+    def _snapshot_engine(self):
+        path = self.app.config['READ_SNAPSHOT_PATH']
+        stat = self._stat(path)
+        if stat is None or time.time() - stat.st_mtime >= self.app.config['READ_SNAPSHOT_INTERVAL']:
+            with self._lock:
+                # 其他线程（或共用快照文件的其他进程）可能已经生成了新快照
+                stat = self._stat(path)
+                if stat is None or time.time() - stat.st_mtime >= self.app.config['READ_SNAPSHOT_INTERVAL']:
+                    self.take_snapshot()
+                    stat = os.stat(path)
+        stamp = (stat.st_ino, stat.st_mtime_ns)
+        if stamp != self._stamp:
+            with self._lock:
+                if stamp != self._stamp:
+                    old, self._engine = self._engine, self.create_engine(
+                        'sqlite:///file:%s?immutable=1&uri=true' % path)
+                    self._stamp = stamp
+                    if old is not None:
+                        old.dispose() # 正在使用的连接归还后关闭
+        return self._engine
+
+    @staticmethod
+    def _stat(path):
+        try:
+            return os.stat(path)
+        except FileNotFoundError:
+            return None
 
-# 初始化扩展，传入程序实例app
-db = SQLAlchemy(app)
+    # 生成主库的快照，备份接口读取的是一致的数据，不会阻塞其他连接的写入
+    def take_snapshot(self):
+        path = self.app.config['READ_SNAPSHOT_PATH']
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        target = sqlite3.connect(tmp_path)
+        source = db.get_engine(self.app).raw_connection()
+        try:
+            source.connection.backup(target)
+            # 快照以immutable方式打开，不能是WAL模式
+            target.execute('PRAGMA journal_mode = DELETE')
+        finally:
+            source.close()
+            target.close()
+        os.replace(tmp_path, path)
 
-# 实例化扩展类
-login_manager = LoginManager(app)
+# 实例化扩展类，在 create_app 中通过 init_app 绑定程序实例
+db = WatchlistSQLAlchemy()
+
+# 当前请求向主库提交过数据，用于读写分离的粘滞；同时唤醒本进程中等待实时更新的连接
+@db.event.listens_for(RoutingSession, 'after_commit')
+def mark_primary_write(session):
+    if has_request_context():
+        g.wrote_primary = True
+    if has_app_context():
+        live = current_app.extensions.get('watchlist_live')
+        if live is not None:
+            live.notify()
+
+login_manager = LoginManager()
 # 添加了@login_required装饰器后，如果未登录的用户访问对应的 URL，Flask-Login 会把用户重定向到登录页面，并显示一个错误提示
 # 为了让这个重定向操作正确执行，我们还需要把 login_manager.login_view 的值设为我们程序的登录视图端点
-login_manager.login_view = 'login'
+login_manager.login_view = 'main.login'
+
+# 视图函数、命令和钩子都注册在蓝本上，由 create_app 注册到程序实例
+# cli_group=None 让命令保持 flask admin、flask forge 这样的用法
+bp = Blueprint('main', __name__, cli_group=None)
 
 @login_manager.user_loader
 # 创建用户加载回调函数，接受user_id作为参数
 def load_user(user_id):
+    user = prefetched('user', int(user_id))
+    if user is not NOT_PREFETCHED:
+        return user
+    # 使用服务端session时，GET请求直接使用session中缓存的用户资料；
+    # 修改名字（settings）和重置密码（admin）都会递增 users 版本号，缓存随之失效。
+    # 其他请求可能修改用户记录，需要查询数据库得到会话中的模型对象
+    server_session = isinstance(session._get_current_object(), ServerSession)
+    if server_session and request.method in ('GET', 'HEAD'):
+        cached = session.get('_user_snapshot')
+        if cached is not None and cached['id'] == int(user_id) and cached['version'] == cache_version('users'):
+            return User(id=cached['id'], name=cached['name'], username=cached['username'])
     # 用ID作为User模型的主键查询对应的用户
     user = User.query.get(int(user_id))
+    if user is not None and server_session:
+        cached = {'id': user.id, 'name': user.name, 'username': user.username, 'version': cache_version('users')}
+        if session.get('_user_snapshot') != cached:
+            session['_user_snapshot'] = cached
     return user
 
+# 密码散列计算
+# PBKDF2是CPU密集型计算，放到独立的进程池中执行，请求线程只等待结果；
+# 排队的任务数有上限，突发的登录请求不会让所有worker都卡在散列计算上；
+# 队列已满、等待超时或进程池不可用时抛出 HashQueueFull，登录返回503
+class HashQueueFull(Exception):
+    pass
+
+class PasswordHasher(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # 进程池第一次用到时才导入
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                # 使用spawn启动子进程，避免在多线程的服务器进程中fork
+                self._executor = ProcessPoolExecutor(max_workers=current_app.config['HASH_WORKERS'],
+                                                     mp_context=multiprocessing.get_context('spawn'))
+                if self._slots is None:
+                    self._slots = threading.BoundedSemaphore(current_app.config['HASH_QUEUE_SIZE'])
+            return self._executor
+
+    # 子进程异常退出后进程池不能再使用，丢弃它，下一个请求重新创建
+    def _discard(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def _run(self, func, *args):
+        # 命令行等非请求环境下直接计算
+        if not has_request_context() or not current_app.config['HASH_WORKERS']:
+            return func(*args)
+        from concurrent.futures import TimeoutError as FutureTimeoutError
+        from concurrent.futures.process import BrokenProcessPool
+        executor = self._get_executor()
+        if not self._slots.acquire(blocking=False):
+            raise HashQueueFull()
+        try:
+            future = executor.submit(func, *args)
+        except (BrokenProcessPool, RuntimeError):
+            self._slots.release()
+            self._discard(executor)
+            raise HashQueueFull()
+        # 任务结束时才归还名额：等待超时后任务仍在进程池中排队，提前归还会让排队的任务数超过上限
+        future.add_done_callback(lambda future: self._slots.release())
+        try:
+            return future.result(timeout=current_app.config['HASH_TIMEOUT'])
+        except FutureTimeoutError:
+            raise HashQueueFull()
+        except BrokenProcessPool:
+            self._discard(executor)
+            raise HashQueueFull()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, current_app.config['PASSWORD_HASH_METHOD'])
+
+    def check(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+password_hasher = PasswordHasher()
+
+# 登录失败次数限制，按IP统计时间窗口内的失败次数
+class LoginRateLimiter(object):
+    MAX_KEYS = 10000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._failures = OrderedDict()
+
+    def _recent(self, key, now):
+        window = current_app.config['LOGIN_RATE_WINDOW']
+        failures = [t for t in self._failures.get(key, ()) if now - t < window]
+        if failures:
+            self._failures[key] = failures
+        else:
+            self._failures.pop(key, None)
+        return failures
+
+    def blocked(self, key):
+        with self._lock:
+            return len(self._recent(key, time.monotonic())) >= current_app.config['LOGIN_RATE_LIMIT']
+
+    def record_failure(self, key):
+        with self._lock:
+            now = time.monotonic()
+            failures = self._recent(key, now)
+            failures.append(now)
+            self._failures[key] = failures
+            self._failures.move_to_end(key)
+            # 限制内存占用，丢弃最久没有失败记录的IP
+            while len(self._failures) > self.MAX_KEYS:
+                self._failures.popitem(last=False)
+
+    def reset(self, key=None):
+        with self._lock:
+            if key is None:
+                self._failures.clear()
+            else:
+                self._failures.pop(key, None)
+
+login_limiter = LoginRateLimiter()
+
+# 服务端session
+# session数据保存在服务端，Cookie中只有一个随机的session ID，请求头更小；
+# session中同时缓存登录用户的资料，load_user 在用户资料没有变化时不查询user表
+class ServerSession(SecureCookieSession):
+    def __init__(self, initial=None, sid=None):
+        super(ServerSession, self).__init__(initial)
+        self.sid = sid
+        self.rotate = False # 登录后更换session ID，防止会话固定攻击
+
+class MemorySessionStore(object):
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict() # session ID -> (过期时间, 序列化后的数据)
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            item = self._items.get(sid)
+            if item is None:
+                return None
+            if item[0] <= time.time():
+                del self._items[sid]
+                return None
+            self._items.move_to_end(sid)
+            return item[1]
+
+    def set(self, sid, data, lifetime):
+        with self._lock:
+            self._items[sid] = (time.time() + lifetime, data)
+            self._items.move_to_end(sid)
+            # 超出数量上限时丢弃最久没有使用的session
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._items.pop(sid, None)
+
+# 每个线程使用自己的连接，过期的session在写入时定期清理
+class SQLiteSessionStore(object):
+    PRUNE_INTERVAL = 60 # 秒
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._pruned_at = 0
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, isolation_level=None, timeout=5)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS session '
+                               '(id TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)')
+            self._local.connection = connection
+        return connection
+
+    def get(self, sid):
+        row = self._connection().execute('SELECT data FROM session WHERE id = ? AND expires > ?',
+                                         (sid, time.time())).fetchone()
+        return row[0] if row is not None else None
+
+    def set(self, sid, data, lifetime):
+        now = time.time()
+        connection = self._connection()
+        connection.execute('INSERT OR REPLACE INTO session (id, data, expires) VALUES (?, ?, ?)',
+                           (sid, data, now + lifetime))
+        if now - self._pruned_at > self.PRUNE_INTERVAL:
+            self._pruned_at = now
+            connection.execute('DELETE FROM session WHERE expires <= ?', (now,))
+
+    def delete(self, sid):
+        self._connection().execute('DELETE FROM session WHERE id = ?', (sid,))
+
+class ServerSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer() # 与签名Cookie相同的序列化方式，支持闪现消息等数据类型
+
+    def __init__(self, config):
+        if config['SESSION_STORE'] == 'sqlite':
+            self.store = SQLiteSessionStore(config['SESSION_STORE_PATH'])
+        else:
+            self.store = MemorySessionStore(config['SESSION_STORE_SIZE'])
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.store.get(sid)
+            if data is not None:
+                return ServerSession(self.serializer.loads(data), sid=sid)
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        # session被清空时删除服务端数据和Cookie
+        if not session:
+            if session.sid is not None and session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=secure, samesite=samesite,
+                                       httponly=httponly)
+            return
+        if session.rotate and session.sid is not None:
+            self.store.delete(session.sid)
+            session.sid = None
+        new = session.sid is None
+        if not (new or self.should_set_cookie(app, session)):
+            return
+        if new:
+            session.sid = secrets.token_urlsafe(32)
+        self.store.set(session.sid, self.serializer.dumps(dict(session)),
+                       app.permanent_session_lifetime.total_seconds())
+        # 已有的session ID不变，只有新建或需要刷新过期时间时才发送Cookie
+        if new or session.permanent:
+            response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                                httponly=httponly, domain=domain, path=path, secure=secure, samesite=samesite)
+
+@user_logged_in.connect
+def rotate_session_id(sender, user, **extra):
+    if isinstance(session._get_current_object(), ServerSession):
+        session.rotate = True
+
 # 创建数据库模型
 # ORM中，类名即表名，自动生成并进行小写处理，表名即user
 # 模型类声明要继承db.Model
@@ -56,26 +707,982 @@ class User(db.Model, UserMixin):
     # ORM中，类属性即列名
     id = db.Column(db.Integer,primary_key=True) # 主键
     name = db.Column(db.String(20)) # 名字
-    username = db.Column(db.String(20)) #用户名
+    username = db.Column(db.String(20), unique=True, index=True) #用户名，登录和用户页面按用户名查找
     password_hash = db.Column(db.String(128)) #密码散列值
 
     # 用来设置密码的方法，接受密码作为参数
     def set_password(self, password):
         # 将生成的密码保持到对应字段
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
     # 用来验证密码的方法，接受密码作为参数
     def validate_password(self, password):
         # 返回布尔值
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.check(self.password_hash, password)
+    # 散列方法与当前配置不同时需要重新散列
+    def password_needs_rehash(self):
+        return self.password_hash.split('$', 1)[0] != current_app.config['PASSWORD_HASH_METHOD']
+
+# 电影年份的取值范围，与标题长度一起由 clean_movie 校验，并作为movie表上的CHECK约束
+MOVIE_YEAR_MIN = 1000
+MOVIE_YEAR_MAX = 9999
 
 # 同上，表名即movie
 class Movie(db.Model):
+    # 每个用户的列表都按 (user_id, ...) 索引读取，只扫描该用户自己的记录，耗时与总用户数无关
+    # SQLite的索引末尾隐含rowid（即id），所以 (user_id, year) 索引同时按 (year, id) 排好了序
+    __table_args__ = (
+        db.CheckConstraint('year BETWEEN %d AND %d' % (MOVIE_YEAR_MIN, MOVIE_YEAR_MAX), name='ck_movie_year'),
+        db.CheckConstraint('length(title) BETWEEN 1 AND 60', name='ck_movie_title'),
+        db.Index('ix_movie_user_id_id', 'user_id', 'id'), # 列表分页和计数
+        db.Index('ix_movie_user_id_year', 'user_id', 'year'), # 按年份筛选和排序
+    )
     id = db.Column(db.Integer, primary_key=True) # 主键
-    title = db.Column(db.String(60)) # 电影标题
-    year = db.Column(db.String(4)) # 电影年份
+    title = db.Column(db.String(60), nullable=False) # 电影标题
+    year = db.Column(db.Integer, nullable=False) # 电影年份
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id')) # 所属用户
+    poster = db.Column(db.String(64)) # 海报原图的SHA-256，见 store_poster
+
+# 按标题排序（不区分大小写），表达式索引需要在类定义之后引用列
+db.Index('ix_movie_user_id_title', Movie.user_id, db.func.lower(Movie.title))
+
+# 可选的唯一索引：同一个列表中不能有标题（不区分大小写）和年份都相同的条目，由 flask unique-titles 创建或删除
+MOVIE_UNIQUE_DDL = 'CREATE UNIQUE INDEX IF NOT EXISTS ux_movie_user_id_title_year ON movie (user_id, lower(title), year)'
+
+# 标题全文索引，使用SQLite的FTS5外部内容表，不重复保存标题文本
+# 由触发器保持与movie表同步，因此表单、API和批量导入的写入都会自动更新索引
+# user_id 也作为一列建立索引，搜索时按用户过滤在全文索引内完成，不需要回表筛选其他用户的匹配结果
+MOVIE_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS movie_fts USING fts5("
+    "title, user_id, content='movie', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS movie_fts_insert AFTER INSERT ON movie BEGIN "
+    "INSERT INTO movie_fts(rowid, title, user_id) VALUES (new.id, new.title, new.user_id); END",
+    "CREATE TRIGGER IF NOT EXISTS movie_fts_delete AFTER DELETE ON movie BEGIN "
+    "INSERT INTO movie_fts(movie_fts, rowid, title, user_id) VALUES ('delete', old.id, old.title, old.user_id); END",
+    "CREATE TRIGGER IF NOT EXISTS movie_fts_update AFTER UPDATE OF title, user_id ON movie BEGIN "
+    "INSERT INTO movie_fts(movie_fts, rowid, title, user_id) VALUES ('delete', old.id, old.title, old.user_id); "
+    "INSERT INTO movie_fts(rowid, title, user_id) VALUES (new.id, new.title, new.user_id); END",
+]
+
+def create_search_index(target, connection, **kwargs):
+    for statement in MOVIE_SEARCH_DDL:
+        connection.exec_driver_sql(statement)
+
+def drop_search_index(target, connection, **kwargs):
+    for trigger in ('movie_fts_insert', 'movie_fts_delete', 'movie_fts_update'):
+        connection.exec_driver_sql('DROP TRIGGER IF EXISTS %s' % trigger)
+    connection.exec_driver_sql('DROP TABLE IF EXISTS movie_fts')
+
+db.event.listen(Movie.__table__, 'after_create', create_search_index)
+db.event.listen(Movie.__table__, 'before_drop', drop_search_index)
+
+# 变更记录，客户端按序号增量同步（/api/changes），只需要下载上次同步之后的变化
+# 由movie表上的触发器写入，表单、API、批量导入和命令行的写入都会被记录；
+# 序号使用AUTOINCREMENT，压缩删除旧记录后也不会被重新使用
+class MovieChange(db.Model):
+    __table_args__ = (
+        db.Index('ix_movie_change_user_id_seq', 'user_id', 'seq'), # 按用户读取某个序号之后的变化
+        {'sqlite_autoincrement': True},
+    )
+    seq = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    movie_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(1), nullable=False) # i：新增，u：修改，d：删除
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+# 条目被移到其他用户的列表时，对原来的用户相当于删除
+CHANGE_LOG_DDL = [
+    "CREATE TRIGGER IF NOT EXISTS movie_change_insert AFTER INSERT ON movie BEGIN "
+    "INSERT INTO movie_change (user_id, movie_id, op, changed_at) VALUES (new.user_id, new.id, 'i', CURRENT_TIMESTAMP); END",
+    "CREATE TRIGGER IF NOT EXISTS movie_change_update AFTER UPDATE ON movie BEGIN "
+    "INSERT INTO movie_change (user_id, movie_id, op, changed_at) VALUES (new.user_id, new.id, 'u', CURRENT_TIMESTAMP); "
+    "INSERT INTO movie_change (user_id, movie_id, op, changed_at) "
+    "SELECT old.user_id, old.id, 'd', CURRENT_TIMESTAMP WHERE old.user_id IS NOT new.user_id; END",
+    "CREATE TRIGGER IF NOT EXISTS movie_change_delete AFTER DELETE ON movie BEGIN "
+    "INSERT INTO movie_change (user_id, movie_id, op, changed_at) VALUES (old.user_id, old.id, 'd', CURRENT_TIMESTAMP); END",
+]
+
+def create_change_log_triggers(target, connection, **kwargs):
+    for statement in CHANGE_LOG_DDL:
+        connection.exec_driver_sql(statement)
+
+def drop_change_log_triggers(target, connection, **kwargs):
+    for trigger in ('movie_change_insert', 'movie_change_update', 'movie_change_delete'):
+        connection.exec_driver_sql('DROP TRIGGER IF EXISTS %s' % trigger)
+
+# 触发器建在movie表上；触发器中引用的movie_change表在执行时才检查，两张表的创建顺序不影响
+db.event.listen(Movie.__table__, 'after_create', create_change_log_triggers)
+db.event.listen(Movie.__table__, 'before_drop', drop_change_log_triggers)
+
+# 后台任务，见 JobQueue
+# status：queued 等待执行（run_at 之后），running 执行中，done 已完成，failed 重试次数用完后失败；
+# progress/total 是任务自己报告的进度，updated_at 同时是执行中任务的心跳
+class Job(db.Model):
+    __table_args__ = (
+        db.Index('ix_job_status_run_at', 'status', 'run_at'), # 领取到期的任务
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(40), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}') # JSON格式的参数
+    user_id = db.Column(db.Integer) # 发起任务的用户，只有该用户能查看任务状态
+    status = db.Column(db.String(10), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+    result = db.Column(db.Text) # JSON格式
+    error = db.Column(db.Text)
+    locked_by = db.Column(db.String(60))
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    @property
+    def params(self):
+        return json.loads(self.payload)
+
+    @property
+    def result_data(self):
+        return json.loads(self.result) if self.result else None
+
+    # 报告进度，与任务处理函数的下一次提交一起写入数据库
+    def report(self, progress, total=None, result=None):
+        self.progress = progress
+        if total is not None:
+            self.total = total
+        if result is not None:
+            self.result = json.dumps(result)
+        self.updated_at = datetime.utcnow()
+
+# 数据库结构版本，保存在SQLite的 PRAGMA user_version 中
+# 新建的数据库直接是最新版本；已有的数据库通过 flask upgradedb 依次执行尚未执行的迁移。
+# SQLite中的DDL语句不在事务里执行，所以每个迁移都要能安全地重复执行
+def migrate_user_watchlists(connection):
+    # 电影条目归属到用户，已有的条目都属于原来唯一的用户（站点主人）
+    columns = [row[1] for row in connection.exec_driver_sql('PRAGMA table_info(movie)')]
+    if 'user_id' not in columns:
+        connection.exec_driver_sql('ALTER TABLE movie ADD COLUMN user_id INTEGER REFERENCES user (id)')
+    connection.exec_driver_sql('UPDATE movie SET user_id = (SELECT min(id) FROM user) WHERE user_id IS NULL')
+    connection.exec_driver_sql('DROP INDEX IF EXISTS ix_movie_year')
+    connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_movie_user_id_id ON movie (user_id, id)')
+    connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_movie_user_id_year ON movie (user_id, year)')
+    connection.exec_driver_sql('CREATE UNIQUE INDEX IF NOT EXISTS ix_user_username ON user (username)')
+    # 全文索引增加了 user_id 列，需要重建
+    drop_search_index(Movie.__table__, connection)
+    create_search_index(Movie.__table__, connection)
+    connection.exec_driver_sql("INSERT INTO movie_fts(movie_fts) VALUES ('rebuild')")
+    # 缓存版本号改为按用户区分
+    connection.exec_driver_sql("DELETE FROM cache_version WHERE name IN ('owner', 'watchlist')")
+
+def migrate_change_log(connection):
+    # 已有的条目各记一条新增，从序号0同步时得到完整列表
+    MovieChange.__table__.create(connection, checkfirst=True)
+    create_change_log_triggers(MovieChange.__table__, connection)
+    if not connection.exec_driver_sql('SELECT 1 FROM movie_change LIMIT 1').first():
+        connection.exec_driver_sql("INSERT INTO movie_change (user_id, movie_id, op, changed_at) "
+                                   "SELECT user_id, id, 'i', CURRENT_TIMESTAMP FROM movie ORDER BY id")
+
+def migrate_movie_constraints(connection):
+    columns = {row[1]: row[2] for row in connection.exec_driver_sql('PRAGMA table_info(movie)')}
+    if columns['year'].upper() != 'INTEGER':
+        # 先检查全部已有条目，有不符合新约束的条目时不修改数据库
+        invalid = [row for row in connection.exec_driver_sql('SELECT id, title, year FROM movie')
+                   if clean_movie(row.title, row.year) is None]
+        if invalid:
+            raise click.ClickException('Fix or delete these movies before upgrading: %s' % ', '.join(
+                '#%d %r (%s)' % (row.id, row.title, row.year) for row in invalid))
+        unique = connection.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'ux_movie_user_id_title_year'").first()
+        # SQLite不能修改列的类型和约束：按新的结构建一张表，复制数据后替换原表，
+        # 原表上的索引和触发器随原表删除，之后重新创建；条目ID不变，全文索引和变更记录仍然对应
+        metadata = db.MetaData()
+        User.__table__.to_metadata(metadata) # 外键引用的表
+        new_table = Movie.__table__.to_metadata(metadata, name='movie_new')
+        connection.exec_driver_sql('DROP TABLE IF EXISTS movie_new')
+        connection.execute(CreateTable(new_table))
+        connection.exec_driver_sql('INSERT INTO movie_new (id, title, year, user_id) '
+                                   'SELECT id, trim(title), CAST(trim(year) AS INTEGER), user_id FROM movie')
+        connection.exec_driver_sql('DROP TABLE movie')
+        connection.exec_driver_sql('ALTER TABLE movie_new RENAME TO movie')
+        for index in Movie.__table__.indexes:
+            index.create(connection)
+        if unique:
+            connection.exec_driver_sql(MOVIE_UNIQUE_DDL)
+        create_search_index(Movie.__table__, connection)
+        connection.exec_driver_sql("INSERT INTO movie_fts(movie_fts) VALUES ('rebuild')")
+        create_change_log_triggers(Movie.__table__, connection)
+    else:
+        for index in Movie.__table__.indexes:
+            index.create(connection, checkfirst=True)
+
+def migrate_job_queue(connection):
+    Job.__table__.create(connection, checkfirst=True)
+
+def migrate_movie_posters(connection):
+    # 从版本2直接升级时，版本3重建的movie表已经有这一列
+    columns = [row[1] for row in connection.exec_driver_sql('PRAGMA table_info(movie)')]
+    if 'poster' not in columns:
+        connection.exec_driver_sql('ALTER TABLE movie ADD COLUMN poster VARCHAR(64)')
+
+MIGRATIONS = [migrate_user_watchlists, migrate_change_log, migrate_movie_constraints, migrate_job_queue,
+              migrate_movie_posters]
+
+def set_schema_version(target, connection, **kwargs):
+    connection.exec_driver_sql('PRAGMA user_version = %d' % len(MIGRATIONS))
+
+db.event.listen(Movie.__table__, 'after_create', set_schema_version)
+
+# 把用户输入转换为FTS5查询：每个词都加引号避免语法错误，并在末尾加*做前缀匹配
+# 标题中的词只匹配title列，并限定为指定用户的条目
+def fts_query(q, user_id):
+    terms = re.findall(r'\w+', q, re.UNICODE)
+    if not terms:
+        return ''
+    return 'user_id : "%d" AND title : (%s)' % (user_id, ' '.join('"%s"*' % term for term in terms))
+
+def search_movies(user_id, q, year=None, limit=50):
+    match = fts_query(q, user_id)
+    if not match:
+        # 只按年份筛选时直接走 (user_id, year) 索引
+        if not year:
+            return []
+        return Movie.query.filter_by(user_id=user_id, year=year).order_by(Movie.id).limit(limit).all()
+    sql = ('SELECT movie.id, movie.title, movie.year FROM movie_fts '
+           'JOIN movie ON movie.id = movie_fts.rowid WHERE movie_fts MATCH :match')
+    if year:
+        sql += ' AND movie.year = :year'
+    sql += ' ORDER BY movie_fts.rank LIMIT :limit' # rank即bm25相关度，越小越相关
+    return db.session.execute(db.text(sql), {'match': match, 'year': year, 'limit': limit}).fetchall()
+
+# 校验并规范化电影标题和年份，表单、API、批量导入和迁移共用同一套规则（与movie表上的约束相同）
+# 返回 (标题, 整数年份)，无效时返回None
+def clean_movie(title, year):
+    title = str(title).strip() if title is not None else ''
+    year = str(year).strip() if year is not None else ''
+    if not 1 <= len(title) <= 60 or not re.match(r'[0-9]{4}\Z', year):
+        return None
+    if not MOVIE_YEAR_MIN <= int(year) <= MOVIE_YEAR_MAX:
+        return None
+    return title, int(year)
+
+# 缓存版本号，每个名称对应一类缓存数据：users 表示所有用户的资料，watchlist:<用户ID> 表示该用户的电影列表
+# 写操作在同一个事务里递增版本号，其他进程（包括命令行）的写入也能让缓存失效
+# changes 记录变更记录压缩到的序号，见 compact_changes
+class CacheVersion(db.Model):
+    name = db.Column(db.String(40), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+def watchlist_key(user_id):
+    return 'watchlist:%d' % user_id
+
+# 读取缓存版本号和最后修改时间，同一个请求内只查询一次
+def _cache_version_row(name):
+    versions = g.setdefault('cache_versions', {})
+    if name not in versions:
+        row = CacheVersion.query.get(name)
+        versions[name] = (row.version, row.updated_at) if row is not None else (0, None)
+    return versions[name]
+
+def cache_version(name):
+    return _cache_version_row(name)[0]
+
+def cache_updated_at(*names):
+    stamps = [_cache_version_row(name)[1] for name in names]
+    stamps = [stamp for stamp in stamps if stamp is not None]
+    return max(stamps) if stamps else None
+
+# 递增缓存版本号，需要随后提交数据库会话
+def bump_cache_version(name):
+    updated = CacheVersion.query.filter_by(name=name).update(
+        {'version': CacheVersion.version + 1, 'updated_at': datetime.utcnow()})
+    if not updated:
+        db.session.add(CacheVersion(name=name, version=1, updated_at=datetime.utcnow()))
+    g.pop('cache_versions', None)
+
+# LRU缓存，键里包含版本号，所以旧条目不需要主动删除，会被逐渐挤出
+class FragmentCache(object):
+    def __init__(self, size_option='FRAGMENT_CACHE_SIZE'):
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.size_option = size_option # 最大条目数对应的配置名
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > current_app.config[self.size_option]:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+# 渲染好的电影列表HTML片段
+fragment_cache = FragmentCache()
+# 用户资料和每个用户的电影数量
+user_cache = FragmentCache('USER_CACHE_SIZE')
+
+# 用户资料，模板中只需要用到名字，所以缓存一个轻量的快照而不是模型对象
+OwnerProfile = namedtuple('OwnerProfile', ['id', 'name', 'username'])
+
+def user_snapshot(user):
+    return OwnerProfile(user.id, user.name, user.username)
+
+# 按用户名查找用户资料，用户资料没有变化时不查询user表
+def user_profile(username):
+    key = ('user', cache_version('users'), username)
+    profile = user_cache.get(key)
+    if profile is None:
+        profile = prefetched('profile', username)
+        if profile is NOT_PREFETCHED:
+            user = User.query.filter_by(username=username).first()
+            profile = user_snapshot(user) if user is not None else None
+        if profile is None:
+            return None
+        user_cache.set(key, profile)
+    return profile
+
+# 站点主人，即最早创建的用户，未登录访问主页时显示站点主人的列表
+def default_owner():
+    key = ('owner', cache_version('users'))
+    profile = user_cache.get(key)
+    if profile is None:
+        profile = prefetched('owner', None)
+        if profile is NOT_PREFETCHED:
+            user = User.query.order_by(User.id).first()
+            profile = user_snapshot(user) if user is not None else None
+        if profile is None:
+            return None
+        user_cache.set(key, profile)
+    return profile
+
+# 当前页面显示的是谁的列表，用户页面通过 g.owner 指定；
+# 其他页面（主页、设置页面、404页面等）是当前登录用户自己，未登录时是站点主人
+def get_owner():
+    if 'owner' not in g:
+        g.owner = user_snapshot(current_user) if current_user.is_authenticated else default_owner()
+    return g.owner
+
+# 重新建表（initdb --drop、测试）后版本号会从0开始，需要清空进程内的缓存
+def clear_caches(*args, **kwargs):
+    fragment_cache.clear()
+    user_cache.clear()
+
+db.event.listen(CacheVersion.__table__, 'after_create', clear_caches)
+
+# 每个用户的电影数量缓存，避免每次渲染列表都执行 COUNT(*)
+# 添加、编辑、删除条目都会递增该用户的 watchlist 版本号，版本号变化后重新计数
+def movie_count(user_id):
+    key = ('count', user_id, cache_version(watchlist_key(user_id)))
+    value = user_cache.get(key)
+    if value is None:
+        value = prefetched('count', user_id)
+        if value is NOT_PREFETCHED:
+            value = db.session.query(db.func.count(Movie.id)).filter(Movie.user_id == user_id).scalar()
+        user_cache.set(key, value)
+    return value
+
+# 渲染列表页面时该用户最后一条变更记录的序号，页面从这个序号之后开始接收实时更新
+# 与数量一样按 watchlist 版本号缓存；没有递增版本号的写入（直接执行的SQL）最多让页面多收到几条已经显示的变化
+def latest_change(user_id):
+    key = ('changes', user_id, cache_version(watchlist_key(user_id)))
+    value = user_cache.get(key)
+    if value is None:
+        value = prefetched('changes', user_id)
+        if value is NOT_PREFETCHED:
+            value = db.session.query(db.func.max(MovieChange.seq)).filter(MovieChange.user_id == user_id).scalar() or 0
+        user_cache.set(key, value)
+    return value
+
+# 静态文件构建
+# flask build-assets 把static下的文件按内容散列复制到 static/dist（例如 style.3f2a9c1b5e7d.css），
+# 并预先生成gzip/brotli压缩版本和GIF的WebP/MP4版本，文件名与原文件的对应关系写入manifest.json。
+# 由于文件名随内容变化，可以让浏览器永久缓存这些文件
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml', 'image/vnd.microsoft.icon', 'image/x-icon')
+
+def asset_dist_path():
+    return os.path.join(current_app.static_folder, current_app.config['ASSET_DIST_DIR'])
+
+asset_manifest = {}
+
+def load_asset_manifest():
+    path = os.path.join(asset_dist_path(), 'manifest.json')
+    asset_manifest.clear()
+    if os.path.exists(path):
+        with open(path) as f:
+            asset_manifest.update(json.load(f))
+
+def fingerprint_asset(source, name, dist, manifest):
+    with open(source, 'rb') as f:
+        content = f.read()
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    base, ext = os.path.splitext(name)
+    hashed = '%s.%s%s' % (base, digest, ext)
+    target = os.path.join(dist, hashed)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, 'wb') as f:
+        f.write(content)
+    mimetype = mimetypes.guess_type(name)[0] or ''
+    if mimetype.startswith(COMPRESSIBLE_TYPES):
+        with open(target + '.gz', 'wb') as f:
+            f.write(gzip.compress(content, 9))
+        if brotli is not None:
+            with open(target + '.br', 'wb') as f:
+                f.write(brotli.compress(content))
+    manifest[name.replace(os.sep, '/')] = hashed.replace(os.sep, '/')
+
+# 把GIF动图转换为体积更小的动画WebP（需要Pillow）和MP4（需要ffmpeg）
+def convert_animation(source, name, dist, manifest):
+    base = os.path.splitext(source)[0]
+    tmpdir = os.path.join(dist, '.tmp')
+    os.makedirs(tmpdir, exist_ok=True)
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+    if Image is not None:
+        webp = os.path.join(tmpdir, os.path.basename(base) + '.webp')
+        with Image.open(source) as image:
+            image.save(webp, 'WEBP', save_all=True, quality=80, method=6)
+            # 第一帧的静态图片作为视频的 poster，浏览器会立即下载它，不能用原GIF
+            image.seek(0)
+            still = os.path.join(tmpdir, os.path.basename(base) + '-poster.webp')
+            image.convert('RGBA').save(still, 'WEBP', quality=80, method=6)
+        fingerprint_asset(webp, os.path.splitext(name)[0] + '.webp', dist, manifest)
+        fingerprint_asset(still, os.path.splitext(name)[0] + '-poster.webp', dist, manifest)
+    if shutil.which('ffmpeg'):
+        mp4 = os.path.join(tmpdir, os.path.basename(base) + '.mp4')
+        subprocess.check_call(['ffmpeg', '-y', '-loglevel', 'error', '-i', source, '-movflags', 'faststart',
+                               '-pix_fmt', 'yuv420p', '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2', mp4])
+        fingerprint_asset(mp4, os.path.splitext(name)[0] + '.mp4', dist, manifest)
+    shutil.rmtree(tmpdir)
+
+@bp.cli.command('build-assets')
+def build_assets():
+    """Fingerprint and pre-compress static files"""
+    dist = asset_dist_path()
+    if os.path.exists(dist):
+        shutil.rmtree(dist)
+    manifest = {}
+    for root, dirs, files in os.walk(current_app.static_folder):
+        if os.path.abspath(root) == os.path.abspath(current_app.static_folder):
+            dirs[:] = [d for d in dirs if d != current_app.config['ASSET_DIST_DIR']]
+        for filename in files:
+            source = os.path.join(root, filename)
+            name = os.path.relpath(source, current_app.static_folder)
+            fingerprint_asset(source, name, dist, manifest)
+            if filename.endswith('.gif'):
+                convert_animation(source, name, dist, manifest)
+    with open(os.path.join(dist, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    load_asset_manifest()
+    click.echo('Built %d assets%s.' % (len(manifest), '' if brotli is not None else ' (brotli not installed, gzip only)'))
+
+# url_for('static', filename='style.css') 自动替换为构建后的文件名，模板不需要修改
+@bp.app_url_defaults
+def fingerprint_static_url(endpoint, values):
+    if endpoint == 'static' and values.get('filename') in asset_manifest:
+        values['filename'] = current_app.config['ASSET_DIST_DIR'] + '/' + asset_manifest[values['filename']]
+
+# 模板中判断某个构建产物是否存在，例如GIF是否有WebP版本
+@bp.app_template_global()
+def has_asset(name):
+    return name in asset_manifest
+
+# 构建后的文件名包含内容散列，使用永久缓存；客户端支持时直接发送预先压缩好的文件
+def static_file(filename):
+    prefix = current_app.config['ASSET_DIST_DIR'] + '/'
+    if not filename.startswith(prefix):
+        return current_app.send_static_file(filename)
+    mimetype = mimetypes.guess_type(filename)[0]
+    encoding = None
+    for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if candidate in request.accept_encodings and os.path.isfile(os.path.join(current_app.static_folder, filename + suffix)):
+            encoding = candidate
+            filename += suffix
+            break
+    response = send_from_directory(current_app.static_folder, filename, mimetype=mimetype, max_age=current_app.config['ASSET_MAX_AGE'])
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+# 响应压缩中间件
+# 根据 Accept-Encoding 选择brotli或gzip；有 Content-Length 的普通响应整体压缩，
+# 流式响应（没有 Content-Length）逐块压缩并立即刷新，不会因为压缩而推迟发送第一个字节
+COMPRESSIBLE_MIMETYPES = ('text/', 'application/json', 'application/javascript', 'image/svg+xml')
+
+class CompressionMiddleware(object):
+    def __init__(self, wsgi_app, config):
+        self.wsgi_app = wsgi_app
+        self.config = config
+
+    def choose_encoding(self, environ):
+        if not self.config['COMPRESSION_ENABLED'] or environ['REQUEST_METHOD'] == 'HEAD':
+            return None
+        accept = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))
+        if brotli is not None and accept['br']:
+            return 'br'
+        if accept['gzip']:
+            return 'gzip'
+        return None
+
+    def compressible(self, status, headers):
+        headers = {name.lower(): value for name, value in headers}
+        if int(status.split(' ', 1)[0]) in (204, 206, 304) or 'content-encoding' in headers:
+            return False
+        # 事件流的每条消息都要立即发出，压缩后代理和浏览器可能攒够数据才处理
+        if not headers.get('content-type', '').startswith(COMPRESSIBLE_MIMETYPES) or \
+                headers['content-type'].startswith('text/event-stream'):
+            return False
+        length = headers.get('content-length')
+        return length is None or int(length) >= self.config['COMPRESSION_MIN_SIZE']
+
+    def compressor(self, encoding):
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=min(self.config['COMPRESSION_LEVEL'], 11))
+            return compressor.process, compressor.flush, compressor.finish
+        # wbits=31表示带gzip头部
+        compressor = zlib.compressobj(self.config['COMPRESSION_LEVEL'], zlib.DEFLATED, 31)
+        return compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+    def __call__(self, environ, start_response):
+        encoding = self.choose_encoding(environ)
+        if encoding is None:
+            return self.wsgi_app(environ, start_response)
+
+        captured = []
+        def capture_start_response(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return lambda data: None # 不支持旧式的write()，Flask也不会使用
+
+        body = self.wsgi_app(environ, capture_start_response)
+        status, headers, exc_info = captured
+        if status.startswith('304'):
+            # 与压缩后的200响应使用相同的弱ETag
+            start_response(status, self.weaken_etag(headers), exc_info)
+            return body
+        if not self.compressible(status, headers):
+            start_response(status, headers, exc_info)
+            return body
+
+        streaming = not any(name.lower() == 'content-length' for name, value in headers)
+        vary = [value for name, value in headers if name.lower() == 'vary']
+        headers = [(name, value) for name, value in self.weaken_etag(headers)
+                   if name.lower() not in ('content-length', 'vary')]
+        headers.append(('Content-Encoding', encoding))
+        headers.append(('Vary', ', '.join(vary + ['Accept-Encoding'])))
+        compress, flush, finish = self.compressor(encoding)
+
+        if streaming:
+            start_response(status, headers, exc_info)
+            return self.stream(body, compress, flush, finish)
+        try:
+            data = compress(b''.join(body)) + finish()
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+        headers.append(('Content-Length', str(len(data))))
+        start_response(status, headers, exc_info)
+        return [data]
+
+    # 压缩后的内容与原内容字节不同，ETag改为弱校验
+    def weaken_etag(self, headers):
+        return [(name, 'W/' + value if name.lower() == 'etag' and not value.startswith('W/') else value)
+                for name, value in headers]
+
+    # 第一块立即发送以保证首字节时间，之后每积累一定数据量才刷新一次，
+    # 避免模板逐段输出的小块数据各自刷新导致压缩率下降
+    FLUSH_SIZE = 16 * 1024
+
+    def stream(self, body, compress, flush, finish):
+        try:
+            first = True
+            pending = 0
+            for chunk in body:
+                data = compress(chunk)
+                pending += len(chunk)
+                if first or pending >= self.FLUSH_SIZE:
+                    data += flush()
+                    first = False
+                    pending = 0
+                if data:
+                    yield data
+            yield finish()
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+# 线上请求的性能分析
+# 开启 PROFILING 后，带有签名令牌的请求（X-Profile 请求头或 ?_profile= 参数，令牌由 flask profile-token 生成），
+# 以及按 PROFILE_SAMPLE_RATE 随机选中的请求，如果由 PROFILE_ENDPOINTS 中的视图处理，就记录这次请求的分析结果：
+# sample 每隔 PROFILE_INTERVAL 秒在另一个线程中读取请求线程的调用栈，开销小，结果可以直接生成火焰图；
+# cprofile 记录每个函数的调用次数和耗时，开销较大，同一时间只分析一个请求，其他请求改用sample。
+# 分析覆盖到响应体发送完为止（包括流式渲染），结果保存在 PROFILE_DIR 中，响应头 X-Profile-Id 给出结果的ID，
+# 用 flask profiles 查看。其他请求只多一次判断，不受影响
+PROFILE_MODES = ('sample', 'cprofile')
+
+def profile_serializer(app):
+    return URLSafeSerializer(app.secret_key, salt='watchlist-profile')
+
+# 在另一个线程中定时读取目标线程的调用栈，按折叠格式（从外到内用分号连接的栈帧）计数
+class StackSampler(threading.Thread):
+    def __init__(self, thread_id, interval):
+        super(StackSampler, self).__init__(name='profile-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if frames:
+                stack = ';'.join(reversed(frames))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+class ProfilingMiddleware(object):
+    def __init__(self, wsgi_app, app):
+        self.wsgi_app = wsgi_app
+        self.app = app
+        self._cprofile_lock = threading.Lock()
+
+    # 这次请求的分析方式，不分析时返回None
+    def requested_mode(self, environ):
+        config = self.app.config
+        token = environ.get('HTTP_X_PROFILE')
+        if token is None and '_profile=' in environ.get('QUERY_STRING', ''):
+            token = url_decode(environ['QUERY_STRING']).get('_profile')
+        if token:
+            try:
+                data = profile_serializer(self.app).loads(token)
+            except BadSignature:
+                return None
+            if data.get('expires', 0) < time.time() or data.get('mode') not in PROFILE_MODES:
+                return None
+            return data['mode']
+        if config['PROFILE_SAMPLE_RATE'] and random.random() < config['PROFILE_SAMPLE_RATE']:
+            return config['PROFILE_MODE']
+        return None
+
+    def endpoint(self, environ):
+        try:
+            return self.app.url_map.bind_to_environ(environ).match()[0]
+        except HTTPException:
+            return None
+
+    def __call__(self, environ, start_response):
+        mode = self.requested_mode(environ)
+        if mode is None:
+            return self.wsgi_app(environ, start_response)
+        endpoint = self.endpoint(environ)
+        if endpoint not in self.app.config['PROFILE_ENDPOINTS']:
+            return self.wsgi_app(environ, start_response)
+        if mode == 'cprofile' and not self._cprofile_lock.acquire(blocking=False):
+            mode = 'sample'
+
+        # ID带微秒，按名称排序即按时间排序，轮换时不会误删同一秒内较新的结果
+        started_at = time.time()
+        profile_id = '%s-%06d-%s' % (time.strftime('%Y%m%d-%H%M%S', time.localtime(started_at)),
+                                     started_at % 1 * 1000000, secrets.token_hex(3))
+        meta = {'id': profile_id, 'mode': mode, 'endpoint': endpoint, 'method': environ['REQUEST_METHOD'],
+                'path': environ.get('PATH_INFO', ''), 'started_at': started_at, 'status': None}
+
+        def profiled_start_response(status, headers, exc_info=None):
+            meta['status'] = int(status.split(' ', 1)[0])
+            return start_response(status, headers + [('X-Profile-Id', profile_id)], exc_info)
+
+        start = time.perf_counter()
+        if mode == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            profiler = StackSampler(threading.get_ident(), self.app.config['PROFILE_INTERVAL'])
+            profiler.start()
+        finished = []
+
+        def finish():
+            if finished:
+                return
+            finished.append(True)
+            if mode == 'cprofile':
+                profiler.disable()
+                self._cprofile_lock.release()
+            else:
+                profiler.stop()
+            meta['duration_ms'] = (time.perf_counter() - start) * 1000
+            try:
+                save_profile(self.app.config, meta, profiler)
+            except OSError:
+                self.app.logger.exception('Could not save profile %s', profile_id)
+
+        try:
+            body = self.wsgi_app(environ, profiled_start_response)
+        except Exception:
+            finish()
+            raise
+        return ClosingIterator(body, finish)
+
+# 每个结果保存为 <ID>.json（请求信息，sample方式还包括折叠的调用栈和次数），cprofile方式另外保存pstats格式的 <ID>.prof
+# ID以时间开头，按文件名排序就是时间顺序；保存后删除超出 PROFILE_KEEP 的最早的结果
+def save_profile(config, meta, profiler):
+    directory = config['PROFILE_DIR']
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, meta['id'])
+    if isinstance(profiler, StackSampler):
+        meta['samples'] = sum(profiler.stacks.values())
+        meta['stacks'] = profiler.stacks
+    else:
+        profiler.dump_stats(path + '.prof')
+    with open(path + '.json.tmp', 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(path + '.json.tmp', path + '.json')
+
+    names = sorted(name for name in os.listdir(directory) if name.endswith('.json'))
+    for name in names[:max(0, len(names) - config['PROFILE_KEEP'])]:
+        for suffix in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(directory, name[:-len('.json')] + suffix))
+            except FileNotFoundError:
+                pass # 其他进程已经删除
+
+def load_profile(profile_id):
+    path = os.path.join(current_app.config['PROFILE_DIR'], os.path.basename(profile_id) + '.json')
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise click.ClickException('Profile %s not found.' % profile_id)
+
+# 生成分析请求用的令牌，例如：curl -H "X-Profile: $(flask profile-token)" http://localhost:5000/
+@bp.cli.command('profile-token')
+@click.option('--mode', type=click.Choice(PROFILE_MODES), default='sample', show_default=True)
+@click.option('--hours', default=1.0, show_default=True, help='Hours until the token expires')
+def profile_token(mode, hours):
+    """Create a signed token that turns on profiling for a request"""
+    if not current_app.config['PROFILING']:
+        click.echo('Warning: PROFILING is off, set WATCHLIST_PROFILING=1 on the server.', err=True)
+    click.echo(profile_serializer(current_app).dumps({'mode': mode, 'expires': time.time() + hours * 3600}))
+
+# 列出保存的分析结果；指定ID时输出折叠格式的调用栈（sample，可以直接交给flamegraph.pl或speedscope），
+# 或者按累计耗时排序的函数列表（cprofile，完整结果可以用snakeviz打开 <ID>.prof）
+@bp.cli.command()
+@click.argument('profile_id', required=False)
+@click.option('--limit', default=20, show_default=True, help='Profiles to list, or functions to show for cProfile')
+def profiles(profile_id, limit):
+    """List recorded request profiles or dump one as collapsed stacks"""
+    directory = current_app.config['PROFILE_DIR']
+    if profile_id is None:
+        names = sorted((name for name in os.listdir(directory) if name.endswith('.json')), reverse=True) \
+            if os.path.isdir(directory) else []
+        for name in names[:limit]:
+            meta = load_profile(name[:-len('.json')])
+            click.echo('%s  %-8s  %-22s  %s %s -> %s  %.1f ms' % (
+                meta['id'], meta['mode'], meta['endpoint'], meta['method'], meta['path'], meta['status'],
+                meta['duration_ms']))
+        return
+    meta = load_profile(profile_id)
+    if meta['mode'] == 'sample':
+        for stack, count in sorted(meta['stacks'].items()):
+            click.echo('%s %d' % (stack, count))
+        return
+    stream = io.StringIO()
+    pstats.Stats(os.path.join(directory, meta['id'] + '.prof'), stream=stream).sort_stats('cumulative').print_stats(limit)
+    click.echo(stream.getvalue())
+
+# 模板压缩扩展
+# 在模板编译前去掉HTML注释（模板里大量的中文注释只给开发者看）和每行的缩进、空行，
+# 处理只在编译时进行一次，渲染时没有额外开销。模板中不要使用依赖空白的<pre>和<textarea>内容
+class HTMLMinifyExtension(Extension):
+    COMMENT_RE = re.compile(r'<!--(?!\[if).*?-->', re.S)
+    INDENT_RE = re.compile(r'\n\s+')
+
+    def preprocess(self, source, name, filename=None):
+        if not self.environment.minify_templates or not (name or '').endswith('.html'):
+            return source
+        source = self.COMMENT_RE.sub('', source)
+        return self.INDENT_RE.sub('\n', source).strip()
+
+# 模板字节码缓存
+# 模板的编译结果写入磁盘，其他worker和重启后的进程直接读取，不需要重新解析和编译模板
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    def get_bucket(self, environment, name, filename, source):
+        # 压缩设置会改变编译结果，需要作为缓存键的一部分，切换设置后不会读到旧的编译结果
+        flags = (environment.minify_templates, environment.trim_blocks, environment.lstrip_blocks)
+        return super(TemplateBytecodeCache, self).get_bucket(environment, name, '%s%r' % (filename, flags), source)
+
+def setup_templates(app):
+    minify = app.config['MINIFY_TEMPLATES']
+    app.jinja_env.add_extension(HTMLMinifyExtension)
+    app.jinja_env.minify_templates = minify
+    # 同时去掉块标签（{% if %}等）所在行留下的空行
+    app.jinja_env.trim_blocks = app.jinja_env.lstrip_blocks = minify
+    cache_dir = app.config['TEMPLATE_CACHE_DIR']
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        app.jinja_env.bytecode_cache = TemplateBytecodeCache(cache_dir)
+
+# 加载全部模板：缓存目录中有编译结果时直接读取，否则编译并写入缓存目录
+def compile_templates():
+    names = current_app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        current_app.jinja_env.get_template(name)
+    return names
+
+# 模板和程序代码的修改时间，部署新版本后ETag随之变化
+_deploy_stamp = max(os.path.getmtime(os.path.join(root, name))
+                    for root, dirs, files in os.walk(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
+                    for name in files)
+_deploy_stamp = max(_deploy_stamp, os.path.getmtime(__file__))
+
+# 根据缓存版本号和请求参数计算列表页面的ETag，登录用户和匿名用户的页面内容不同，需要分开
+def index_etag(owner):
+    viewer = current_user.get_id() if current_user.is_authenticated else 'anonymous'
+    parts = [_deploy_stamp, sorted(asset_manifest.items()), cache_version(watchlist_key(owner.id)),
+             cache_version('users'), owner.id, viewer, request.path, request.query_string]
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+# 列表的排序和筛选，来自查询参数：
+# ?sort=added|title|year（前面加-表示倒序），?year=<年份> 或 ?year_min=&year_max= 按年份范围筛选
+# 每种排序都以id作为最后一个排序键，顺序是唯一的，所以键集分页的 after/before 仍然是条目ID：
+# 用 (排序键, id) > (该条目的排序键, id) 这样的行值比较从这个条目之后继续，SQLite可以直接在索引中定位。
+# 按添加顺序和年份排序分别使用 (user_id, id) 和 (user_id, year) 索引，按标题排序使用 (user_id, lower(title)) 索引，
+# 都是按索引顺序读取一页，不需要排序整个列表
+MOVIE_SORTS = ('added', 'title', 'year')
+
+class MovieListing(namedtuple('MovieListing', 'sort descending year_min year_max')):
+    @classmethod
+    def from_args(cls, args):
+        sort = args.get('sort', 'added')
+        descending = sort.startswith('-')
+        sort = sort[1:] if descending else sort
+        if sort not in MOVIE_SORTS:
+            sort, descending = 'added', False
+        year = args.get('year', type=int)
+        return cls(sort, descending, args.get('year_min', year, type=int), args.get('year_max', year, type=int))
+
+    @property
+    def default(self):
+        return self == DEFAULT_LISTING
+
+    # 翻页和排序链接中需要保留的查询参数
+    def args(self, **changes):
+        listing = self._replace(**changes)
+        args = {}
+        if listing.sort != 'added' or listing.descending:
+            args['sort'] = ('-' if listing.descending else '') + listing.sort
+        if listing.year_min is not None and listing.year_min == listing.year_max:
+            args['year'] = listing.year_min
+        else:
+            args['year_min'], args['year_max'] = listing.year_min, listing.year_max
+        return args
+
+    def keys(self, table):
+        if self.sort == 'title':
+            return [db.func.lower(table.c.title), table.c.id]
+        if self.sort == 'year':
+            return [table.c.year, table.c.id]
+        return [table.c.id]
+
+    # 返回查询条件和排序方式；向前翻页（before）时按相反的顺序读取，取出后再反转
+    def clauses(self, table, user_id, after=None, before=None):
+        keys = self.keys(table)
+        where = [table.c.user_id == user_id]
+        if self.year_min is not None:
+            where.append(table.c.year >= self.year_min)
+        if self.year_max is not None:
+            where.append(table.c.year <= self.year_max)
+        cursor = before or after
+        if cursor:
+            greater = bool(before) == self.descending
+            if len(keys) == 1:
+                where.append(keys[0] > cursor if greater else keys[0] < cursor)
+            else:
+                position = db.tuple_(*keys)
+                value = db.select(*keys).where(table.c.id == cursor).scalar_subquery()
+                # 另外给出第一个排序键的范围，表达式索引上的行值比较不会用来定位
+                first = db.select(keys[0]).where(table.c.id == cursor).scalar_subquery()
+                where.append(db.and_(keys[0] >= first, position > value) if greater
+                             else db.and_(keys[0] <= first, position < value))
+        backwards = bool(before) != self.descending
+        return where, [key.desc() if backwards else key for key in keys]
+
+DEFAULT_LISTING = MovieListing('added', False, None, None)
+
+# 列表页面的一页电影记录
+# 使用键集分页（WHERE user_id = ? AND id > after ORDER BY id LIMIT n），翻页代价与页码无关
+# 记录在迭代时才逐条取出，因此流式渲染时模板可以边查询边输出
+class MoviePage(object):
+    def __init__(self, movies, limit, has_prev=False, has_next=None):
+        self._movies = movies
+        self.limit = limit
+        self.has_prev = has_prev
+        self.has_next = has_next # None表示需要迭代到末尾才能确定
+        self.first_id = None
+        self.last_id = None
+
+    def __iter__(self):
+        count = 0
+        for movie in self._movies:
+            # 多取的一条只用来判断是否还有下一页
+            if count == self.limit:
+                self.has_next = True
+                break
+            if self.first_id is None:
+                self.first_id = movie.id
+            self.last_id = movie.id
+            count += 1
+            yield movie
+        else:
+            if self.has_next is None:
+                self.has_next = False
+
+def paginate_movies(user_id, after=None, before=None, limit=None, stream=False, listing=DEFAULT_LISTING):
+    limit = limit or current_app.config['MOVIES_PER_PAGE']
+    # 预先查询的记录与下面的查询相同（向前翻页时同样是倒序）
+    movies = prefetched('page', (user_id, after, before, limit, listing))
+    where, order_by = listing.clauses(Movie.__table__, user_id, after, before)
+    query = Movie.query.filter(*where).order_by(*order_by).limit(limit + 1)
+    if before:
+        # 向前翻页：倒序取出后再反转，数量不超过一页
+        if movies is NOT_PREFETCHED:
+            movies = query.all()
+        has_prev = len(movies) > limit
+        return MoviePage(movies[:limit][::-1], limit, has_prev=has_prev, has_next=True)
+    if movies is NOT_PREFETCHED:
+        movies = query.yield_per(100) if stream else query.all()
+    return MoviePage(movies, limit, has_prev=bool(after))
+
+# 流式渲染模板，第一部分HTML生成后立即发送，不必等待整个列表查询完成
+def stream_template(template_name, **context):
+    # 闪现消息保存在session中，而流式响应的头部（包括Cookie）会先于模板内容发出，
+    # 所以需要提前取出消息，否则消息会在下次请求中重复显示
+    get_flashed_messages()
+    current_app.update_template_context(context)
+    template = current_app.jinja_env.get_template(template_name)
+    return Response(stream_with_context(template.generate(context)))
 
 # 生成管理员账户
-@app.cli.command()
+@bp.cli.command()
 @click.option('--username', prompt=True, help='The username to login')
 # hide_input会隐藏输入
 # confirmation_prompt=True会要求二次确认密码输入
@@ -84,7 +1691,11 @@ def admin(username, password):
     """create admin user"""
     db.create_all()
 
-    user = User.query.first()
+    # 管理员即站点主人，也就是最早创建的用户
+    user = User.query.order_by(User.id).first()
+    taken = User.query.filter_by(username=username).first()
+    if taken is not None and taken is not user:
+        raise click.ClickException('Username %s is already taken.' % username)
     if user is not None:
         click.echo("Updating user...")
         user.username = username
@@ -95,11 +1706,98 @@ def admin(username, password):
         user.set_password(password) # 设置密码
         db.session.add(user)
 
+    bump_cache_version('users')
     db.session.commit()
     click.echo("Done.")
 
+# 添加普通用户，每个用户有自己的电影列表，页面地址为 /u/<username>
+@bp.cli.command('adduser')
+@click.option('--username', prompt=True, help='The username to login')
+@click.option('--password', prompt=True, hide_input=True, confirmation_prompt=True, help='The password to login')
+@click.option('--name', help='Display name, defaults to the username')
+def add_user(username, password, name):
+    """Create a user with their own watchlist"""
+    db.create_all()
+    if User.query.filter_by(username=username).first() is not None:
+        raise click.ClickException('Username %s is already taken.' % username)
+    user = User(username=username, name=name or username)
+    user.set_password(password)
+    db.session.add(user)
+    bump_cache_version('users')
+    db.session.commit()
+    click.echo("Created user %s." % username)
+
+# 升级已有的数据库文件到当前的表结构
+@bp.cli.command()
+def upgradedb():
+    """Upgrade the database schema"""
+    db.create_all() # 创建新增的表
+    with db.engine.begin() as connection:
+        version = connection.exec_driver_sql('PRAGMA user_version').scalar()
+        for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+            migration(connection)
+            connection.exec_driver_sql('PRAGMA user_version = %d' % number)
+            click.echo("Upgraded database to version %d." % number)
+    click.echo("Database is up to date.")
+
+# 创建（或重建）标题全文索引
+@bp.cli.command('search-index')
+def search_index():
+    """Create or rebuild the title search index"""
+    db.create_all()
+    with db.engine.begin() as connection:
+        create_search_index(Movie.__table__, connection)
+        connection.exec_driver_sql("INSERT INTO movie_fts(movie_fts) VALUES ('rebuild')")
+    click.echo("Search index rebuilt.")
+
+# 开启或关闭标题唯一约束
+# 开启后同一个列表中不能添加标题（不区分大小写）和年份都相同的条目，表单会提示已存在，API返回409，批量导入跳过这些行
+@bp.cli.command('unique-titles')
+@click.option('--off', is_flag=True, help='Allow duplicate titles again')
+def unique_titles(off):
+    """Reject movies with the same title and year in one watchlist"""
+    with db.engine.begin() as connection:
+        if off:
+            connection.exec_driver_sql('DROP INDEX IF EXISTS ux_movie_user_id_title_year')
+            click.echo("Duplicate titles are allowed.")
+            return
+        # 已有重复的条目时无法创建唯一索引，列出这些条目，由用户先处理
+        duplicates = connection.exec_driver_sql(
+            'SELECT user_id, min(title), year, count(*) FROM movie '
+            'GROUP BY user_id, lower(title), year HAVING count(*) > 1').fetchall()
+        if duplicates:
+            raise click.ClickException('Remove duplicate movies first: %s' % ', '.join(
+                '%r (%s) x%d in watchlist %d' % (title, year, count, user_id) for user_id, title, year, count in duplicates))
+        connection.exec_driver_sql(MOVIE_UNIQUE_DDL)
+    click.echo("Duplicate titles are rejected.")
+
+# 压缩变更记录
+# 同一个条目只保留最新的一条记录，不影响任何序号开始的同步结果；
+# 超过保留天数的删除记录（墓碑）被删除，并记下删除到的序号，更早的 since 需要从0重新同步
+@bp.cli.command('compact-changes')
+@click.option('--days', default=30, show_default=True, help='Keep tombstones for this many days')
+def compact_changes(days):
+    """Compact the change log used by /api/changes"""
+    db.create_all()
+    latest = db.session.query(db.func.max(MovieChange.seq)).group_by(MovieChange.user_id, MovieChange.movie_id)
+    superseded = MovieChange.query.filter(MovieChange.seq.notin_(latest)).delete(synchronize_session=False)
+    live = db.exists().where(Movie.id == MovieChange.movie_id).where(Movie.user_id == MovieChange.user_id)
+    tombstones = MovieChange.query.filter(MovieChange.changed_at < datetime.utcnow() - timedelta(days=days), ~live)
+    horizon = tombstones.with_entities(db.func.max(MovieChange.seq)).scalar()
+    expired = 0
+    if horizon is not None:
+        expired = tombstones.delete(synchronize_session=False)
+        row = CacheVersion.query.get('changes')
+        if row is None:
+            db.session.add(CacheVersion(name='changes', version=horizon, updated_at=datetime.utcnow()))
+        elif horizon > row.version:
+            row.version = horizon
+            row.updated_at = datetime.utcnow()
+    db.session.commit()
+    click.echo("Removed %d superseded and %d expired changes." % (superseded, expired))
+
 # 删除并初始化DB
-@app.cli.command()
+@bp.cli.command()
 @click.option('--drop', is_flag=True, help='drop database')
 def initdb(drop):
     """initialize the database"""
@@ -109,7 +1807,7 @@ def initdb(drop):
     click.echo("Initialized database.")
 
 # 代码模拟数据
-@app.cli.command()
+@bp.cli.command()
 def forge():
     """Generate fake data"""
     db.create_all()
@@ -117,29 +1815,167 @@ def forge():
     # 将原来的模拟数据移动到下面
     name = 'Jason Du'
     movies = [
-        {'title': 'My Neighbor Totoro', 'year': '1988'},
-        {'title': 'Dead Poets Society', 'year': '1989'},
-        {'title': 'A Perfect World', 'year': '1993'},
-        {'title': 'Leon', 'year': '1994'},
-        {'title': 'Mahjong', 'year': '1996'},
-        {'title': 'Swallowtail Butterfly', 'year': '1996'},
-        {'title': 'King of Comedy', 'year': '1999'},
-        {'title': 'Devils on the Doorstep', 'year': '1999'},
-        {'title': 'WALL-E', 'year': '2008'},
-        {'title': 'The Pork of Music', 'year': '2012'},
+        {'title': 'My Neighbor Totoro', 'year': 1988},
+        {'title': 'Dead Poets Society', 'year': 1989},
+        {'title': 'A Perfect World', 'year': 1993},
+        {'title': 'Leon', 'year': 1994},
+        {'title': 'Mahjong', 'year': 1996},
+        {'title': 'Swallowtail Butterfly', 'year': 1996},
+        {'title': 'King of Comedy', 'year': 1999},
+        {'title': 'Devils on the Doorstep', 'year': 1999},
+        {'title': 'WALL-E', 'year': 2008},
+        {'title': 'The Pork of Music', 'year': 2012},
     ]
 
     # 对创建的两个类（表名）进行实例化
     user = User(name=name)
     db.session.add(user)
+    db.session.flush() # 生成用户ID
 
     for m in movies:
-        movie = Movie(title=m['title'],year=m['year'])
+        movie = Movie(title=m['title'],year=m['year'], user_id=user.id)
         db.session.add(movie)
 
+    bump_cache_version('users')
+    bump_cache_version(watchlist_key(user.id))
     db.session.commit()
     click.echo('Done.')
 
+# 命令行中按用户名指定用户，没有指定时使用站点主人
+def find_user(username):
+    if username:
+        user = User.query.filter_by(username=username).first()
+    else:
+        user = User.query.order_by(User.id).first()
+    if user is None:
+        raise click.ClickException('User %s not found.' % username if username else 'No users yet, run flask admin first.')
+    return user
+
+# 按文件扩展名推断导入导出格式
+def movie_file_format(path, fmt):
+    if fmt:
+        return fmt
+    return 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+# 逐行读取电影记录，不会把整个文件读入内存
+def read_movie_rows(f, fmt):
+    if fmt == 'csv':
+        for row in csv.DictReader(f):
+            yield row.get('title'), row.get('year')
+    else:
+        for line in f:
+            if line.strip():
+                row = json.loads(line)
+                yield row.get('title'), row.get('year')
+
+# 把文件中的电影逐批导入一个用户的列表，返回 (导入条数, 跳过条数)
+# start 表示跳过文件开头已经处理过的行数，任务重试时从上次提交的位置继续；
+# 每批提交前调用 on_batch(已处理的行数, 导入条数, 跳过条数)，任务借此把进度和这批数据在同一个事务里提交
+def import_movie_file(f, fmt, user_id, batch_size, start=0, on_batch=None):
+    # 开启了 flask unique-titles 时跳过重复的条目
+    insert = Movie.__table__.insert().prefix_with('OR IGNORE')
+    imported = skipped = 0
+    rows = start
+    batch = []
+
+    # 每批使用一条 executemany 形式的 INSERT 语句，并在批次结束时提交
+    def flush():
+        nonlocal imported, skipped
+        if batch:
+            inserted = db.session.execute(insert, batch).rowcount
+            imported += inserted
+            skipped += len(batch) - inserted
+            del batch[:]
+        if on_batch is not None:
+            on_batch(rows, imported, skipped)
+        db.session.commit()
+
+    for title, year in itertools.islice(read_movie_rows(f, fmt), start, None):
+        rows += 1
+        fields = clean_movie(title, year)
+        if fields is None:
+            skipped += 1
+            continue
+        batch.append({'title': fields[0], 'year': fields[1], 'user_id': user_id})
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+
+    bump_cache_version(watchlist_key(user_id))
+    db.session.commit()
+    return imported, skipped
+
+# 文件中的记录数，用作导入任务的进度总数
+def count_movie_rows(f, fmt):
+    count = sum(1 for line in f if line.strip())
+    return count - 1 if fmt == 'csv' and count else count # 去掉CSV的表头
+
+# 批量导入电影
+# 加上 --background 时只创建导入任务，由 flask worker 或程序进程内的任务线程执行
+@bp.cli.command('import-movies')
+@click.argument('path', type=click.Path(dir_okay=False, allow_dash=True))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='File format, guessed from the extension by default')
+@click.option('--batch-size', default=5000, show_default=True, help='Rows per INSERT batch and commit')
+@click.option('--user', 'username', help='Owner of the imported movies, defaults to the admin')
+@click.option('--background', is_flag=True, help='Queue the import as a background job')
+def import_movies(path, fmt, batch_size, username, background):
+    """Import movies from a CSV or JSON Lines file"""
+    db.create_all()
+    user_id = find_user(username).id
+    fmt = movie_file_format(path, fmt)
+    if background:
+        if path == '-':
+            raise click.ClickException('Background imports need a file path.')
+        job = current_app.extensions['watchlist_jobs'].enqueue('import-movies', {
+            'path': os.path.abspath(path), 'format': fmt, 'user_id': user_id, 'batch_size': batch_size})
+        click.echo('Queued import job %d.' % job.id)
+        return
+
+    start = time.perf_counter()
+    with click.open_file(path, encoding='utf-8') as f:
+        imported, skipped = import_movie_file(f, fmt, user_id, batch_size)
+    elapsed = time.perf_counter() - start
+    click.echo('Imported %d movies, skipped %d invalid rows in %.2fs (%d rows/sec).'
+               % (imported, skipped, elapsed, imported / elapsed if elapsed else 0))
+
+# 批量导出电影
+@bp.cli.command('export-movies')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True, allow_dash=True))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='File format, guessed from the extension by default')
+@click.option('--batch-size', default=5000, show_default=True, help='Rows fetched per query')
+@click.option('--user', 'username', help='Only export this user\'s movies')
+def export_movies(path, fmt, batch_size, username):
+    """Export movies to a CSV or JSON Lines file"""
+    fmt = movie_file_format(path, fmt)
+    table = Movie.__table__
+    condition = table.c.user_id == find_user(username).id if username else db.true()
+    exported = 0
+    last_id = 0
+    start = time.perf_counter()
+
+    with click.open_file(path, 'w', encoding='utf-8') as f:
+        writer = csv.writer(f, lineterminator='\n') if fmt == 'csv' else None
+        if writer:
+            writer.writerow(['title', 'year'])
+        # 按主键分批读取，每批只保留在内存中的这一部分
+        while True:
+            rows = db.session.execute(
+                db.select(table.c.id, table.c.title, table.c.year)
+                .where(condition, table.c.id > last_id).order_by(table.c.id).limit(batch_size)).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                if writer:
+                    writer.writerow([row.title, row.year])
+                else:
+                    f.write(json.dumps({'title': row.title, 'year': row.year}, ensure_ascii=False) + '\n')
+            exported += len(rows)
+            last_id = rows[-1].id
+
+    elapsed = time.perf_counter() - start
+    click.echo('Exported %d movies in %.2fs (%d rows/sec).'
+               % (exported, elapsed, exported / elapsed if elapsed else 0), err=path == '-')
+
 # 模拟数据
 # name = 'Jason Du'
 # movies = [
@@ -155,83 +1991,452 @@ def forge():
 #     {'title': 'The Pork of Music', 'year': '2012'},
 # ]
 
+# 请求耗时统计
+# 每个进程单独统计，耗时按处理函数、数据库、模板三部分拆分
+class RequestMetrics(object):
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._statuses = {}
+
+    def observe(self, endpoint, status, timing, total):
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = {
+                    'buckets': [0] * len(self.BUCKETS), 'count': 0, 'sum': 0.0,
+                    'db': 0.0, 'template': 0.0, 'queries': 0,
+                }
+            for i, bound in enumerate(self.BUCKETS):
+                if total <= bound:
+                    stats['buckets'][i] += 1
+                    break
+            stats['count'] += 1
+            stats['sum'] += total
+            stats['db'] += timing['db']
+            stats['template'] += timing['template']
+            stats['queries'] += timing['queries']
+            key = (endpoint, status)
+            self._statuses[key] = self._statuses.get(key, 0) + 1
+
+    # Prometheus文本格式
+    def render(self):
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+            statuses = sorted(self._statuses.items())
+        lines = [
+            '# HELP watchlist_request_duration_seconds Request latency by endpoint.',
+            '# TYPE watchlist_request_duration_seconds histogram',
+        ]
+        for endpoint, stats in endpoints:
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS, stats['buckets']):
+                cumulative += count
+                lines.append('watchlist_request_duration_seconds_bucket{endpoint="%s",le="%s"} %d' % (endpoint, bound, cumulative))
+            lines.append('watchlist_request_duration_seconds_bucket{endpoint="%s",le="+Inf"} %d' % (endpoint, stats['count']))
+            lines.append('watchlist_request_duration_seconds_sum{endpoint="%s"} %.6f' % (endpoint, stats['sum']))
+            lines.append('watchlist_request_duration_seconds_count{endpoint="%s"} %d' % (endpoint, stats['count']))
+        for name, key, help_text in (
+                ('watchlist_db_duration_seconds_total', 'db', 'Time spent executing SQL.'),
+                ('watchlist_template_duration_seconds_total', 'template', 'Time spent rendering templates.'),
+                ('watchlist_db_queries_total', 'queries', 'SQL statements executed.')):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s counter' % name)
+            for endpoint, stats in endpoints:
+                value = stats[key]
+                lines.append('%s{endpoint="%s"} %s' % (name, endpoint, '%.6f' % value if isinstance(value, float) else value))
+        lines.append('# HELP watchlist_requests_total Requests by endpoint and status code.')
+        lines.append('# TYPE watchlist_requests_total counter')
+        for (endpoint, status), count in statuses:
+            lines.append('watchlist_requests_total{endpoint="%s",status="%d"} %d' % (endpoint, status, count))
+        return '\n'.join(lines) + '\n'
+
+request_metrics = RequestMetrics()
+
+@bp.before_app_request
+def start_timing():
+    if current_app.config['METRICS_ENABLED']:
+        g.timing = {'start': time.perf_counter(), 'db': 0.0, 'template': 0.0, 'queries': 0, 'template_start': []}
+
+def template_started(sender, template, context, **extra):
+    if 'timing' in g:
+        g.timing['template_start'].append(time.perf_counter())
+
+def template_finished(sender, template, context, **extra):
+    if 'timing' in g and g.timing['template_start']:
+        g.timing['template'] += time.perf_counter() - g.timing['template_start'].pop()
+
+
+@bp.after_app_request
+def finish_timing(response):
+    timing = g.pop('timing', None)
+    if timing is None:
+        return response
+    total = time.perf_counter() - timing['start']
+    # 流式响应的模板在返回之后才渲染，这里只统计到响应开始发送为止
+    handler = max(0.0, total - timing['db'] - timing['template'])
+    response.headers['Server-Timing'] = (
+        'db;dur=%.2f;desc="%d queries", tpl;dur=%.2f, app;dur=%.2f, total;dur=%.2f'
+        % (timing['db'] * 1000, timing['queries'], timing['template'] * 1000, handler * 1000, total * 1000))
+    request_metrics.observe(request.endpoint or 'unmatched', response.status_code, timing, total)
+    return response
+
+# 读写分离：GET请求（包括其中的 inject_user）从只读库读取，其他请求和命令行使用主库
+# 用户提交写操作后，在 READ_STICKY_SECONDS 内的请求都从主库读取，保证能看到自己刚刚的修改
+@bp.before_app_request
+def route_reads():
+    router = current_app.extensions['watchlist_reads']
+    if not router.enabled or request.method not in ('GET', 'HEAD'):
+        return
+    if session.get('read_primary_until', 0) > time.time():
+        return
+    session.pop('read_primary_until', None)
+    g.read_engine = router.get_engine()
+
+# ASGI入口（asgi.py）在事件循环中用异步驱动预先查询请求需要的数据，放在 environ['watchlist.prefetched'] 中传入，
+# 格式为 {名称: (参数, 结果)}；视图按名称和参数取用，没有对应的数据时（NOT_PREFETCHED）照常查询数据库。
+# 结果为None表示已经查询过、记录不存在，视图直接按不存在处理，不再访问数据库
+NOT_PREFETCHED = object()
+
+@bp.before_app_request
+def load_prefetched():
+    data = request.environ.get('watchlist.prefetched')
+    if data is not None:
+        g.prefetched = data
+        g.cache_versions = dict(data.get('cache_versions', (None, {}))[1])
+
+def prefetched(name, key):
+    data = g.get('prefetched')
+    if data is not None and name in data and data[name][0] == key:
+        return data[name][1]
+    return NOT_PREFETCHED
+
+@bp.after_app_request
+def stick_to_primary(response):
+    if g.pop('wrote_primary', False) and current_app.extensions['watchlist_reads'].enabled:
+        session['read_primary_until'] = time.time() + current_app.config['READ_STICKY_SECONDS']
+    return response
+
 # 模板上下文处理函数
 # 这个函数返回的变量（以字典键值对的形式）将会统一注入到每一个模板的上下文环境中，因此可以直接在模板中使用。
-@app.context_processor
+@bp.app_context_processor
 def inject_user():
-    user = User.query.first()
+    # user = User.query.first()
+    # 从缓存读取，资料未变化时不查询user表
+    # 列表页面中是正在查看的列表的主人，其他页面是站点主人
+    user = get_owner()
     return dict(user=user) # 需要返回字典，等同于return {'user':user},后续视图函数中的user关键字可以删除
 
 # 默认只接受 GET 请求
 # 两种方法的请求有不同的处理逻辑：对于 GET 请求，返回渲染后的页面；对于 POST 请求，则获取提交的表单数据并保存
-@app.route('/', methods=['GET', 'POST'])
-@app.route('/hello', methods=['GET', 'POST'])
-@app.route('/index', methods=['GET', 'POST'])
-@app.route('/home', methods=['GET', 'POST'])
+# 登录用户的主页是自己的列表，未登录时显示站点主人的列表
+@bp.route('/', methods=['GET', 'POST'])
+@bp.route('/hello', methods=['GET', 'POST'])
+@bp.route('/index', methods=['GET', 'POST'])
+@bp.route('/home', methods=['GET', 'POST'])
 def index():
-    # 添加新条目
-    # 判断是否是POST请求
     if request.method == 'POST':
-        # 如果当前用户未认证
-        # 添加新条目的视图不能使用@login_required，因为当前视图同时还处理GET请求
-        if not current_user.is_authenticated:
-            return redirect(url_for('index'))
-        else:
-            # 获取表单数据
-            # 传入表单对应输入字段Name的值
-            title = request.form.get('title')
-            year = request.form.get('year')
-            # 验证数据
-            if not title or not year or len(year) > 4 or len(title) >60:
-                flash("Invalid input.") # 显示错误提示
-                return redirect(url_for('index'))
-            # 保存表单数据到数据库
-            movie = Movie(title=title, year=year) # 创建记录
-            db.session.add(movie) # 添加到数据库会话
-            db.session.commit() # 提交数据库会话
-            flash("Item created.") # 显示成功创建提示
-            return redirect(url_for('index')) # 重定向回主页
+        return create_movie(url_for('main.index'))
     # return "Welcome to my watchlist!"
     # user = User.query.first() # 读取用户记录
-    movies = Movie.query.all() # 读取所有电影记录
+    # movies = Movie.query.all() # 读取所有电影记录
     # return render_template('index.html',user=user, movies=movies)
-    return render_template('index.html', movies=movies)
+    owner = get_owner()
+    if owner is None:
+        abort(404) # 还没有创建任何用户
+    return show_watchlist(owner)
+
+# 每个用户的列表页面，只查询这个用户的条目
+@bp.route('/u/<username>', methods=['GET', 'POST'])
+def user_watchlist(username):
+    if request.method == 'POST':
+        return create_movie(url_for('main.user_watchlist', username=username))
+    owner = user_profile(username)
+    if owner is None:
+        abort(404)
+    return show_watchlist(owner)
+
+# 添加新条目，条目总是加到当前用户自己的列表中
+def create_movie(next_url):
+    # 如果当前用户未认证
+    # 添加新条目的视图不能使用@login_required，因为当前视图同时还处理GET请求
+    if not current_user.is_authenticated:
+        return redirect(next_url)
+    # 获取表单数据
+    # 传入表单对应输入字段Name的值
+    # 验证数据，得到去掉首尾空白的标题和整数年份
+    fields = clean_movie(request.form.get('title'), request.form.get('year'))
+    if fields is None:
+        flash("Invalid input.") # 显示错误提示
+        return redirect(next_url)
+    # 保存表单数据到数据库
+    movie = Movie(title=fields[0], year=fields[1], user_id=current_user.id) # 创建记录
+    if not add_movie(movie): # 保存到数据库，同时让列表页面的缓存失效
+        flash("Movie already exists.")
+        return redirect(next_url)
+    flash("Item created.") # 显示成功创建提示
+    return redirect(next_url) # 重定向回列表页面
+
+# 只有列表的主人可以编辑列表
+def can_edit(owner):
+    return current_user.is_authenticated and current_user.id == owner.id
+
+def show_watchlist(owner):
+    g.owner = owner
+    # 有待显示的闪现消息时页面内容不同，不使用缓存
+    cacheable = '_flashes' not in session
+    if cacheable:
+        # 浏览器或反向代理缓存的页面仍然有效时直接返回304，不查询也不渲染
+        etag = index_etag(owner)
+        last_modified = cache_updated_at(watchlist_key(owner.id), 'users')
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response = Response(status=304)
+        else:
+            response = render_index(owner)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        # 登录用户的页面包含编辑按钮，只允许浏览器缓存
+        response.cache_control.no_cache = True
+        if current_user.is_authenticated:
+            response.cache_control.private = True
+        else:
+            response.cache_control.public = True
+        return response
+    return render_index(owner)
+
+def fragment_key(owner_id, version, endpoint, editable, after, before, limit, listing):
+    return (owner_id, version, endpoint, editable, after, before, limit, listing)
+
+def render_index(owner):
+    # 读取一页电影记录，?after=<id> 下一页，?before=<id> 上一页，?limit=<n> 每页条数
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, min(limit, current_app.config['MOVIES_MAX_PER_PAGE']))
+    # ?sort= 排序，?year= 或 ?year_min=&year_max= 按年份筛选，见 MovieListing
+    listing = MovieListing.from_args(request.args)
+    editable = can_edit(owner)
+    stream = request.args.get('stream', type=int, default=int(current_app.config['STREAM_INDEX']))
+    if stream:
+        page = paginate_movies(owner.id, after=after, before=before, limit=limit, stream=stream, listing=listing)
+        return stream_template('index.html', page=page, movie_count=movie_count(owner.id), limit=limit,
+                               can_edit=editable, listing=listing, live_since=live_since(owner))
+    # 电影列表片段按该用户的 watchlist 版本号、是否可编辑、分页和排序参数缓存，
+    # 分页链接指向当前页面，所以键里还要区分主页和用户页面
+    key = fragment_key(owner.id, cache_version(watchlist_key(owner.id)), request.endpoint, editable, after, before, limit,
+                       listing)
+    movie_list = fragment_cache.get(key)
+    if movie_list is None:
+        page = paginate_movies(owner.id, after=after, before=before, limit=limit, listing=listing)
+        movie_list = Markup(render_template('_movie_list.html', page=page, limit=limit, can_edit=editable,
+                                            listing=listing))
+        fragment_cache.set(key, movie_list)
+    return Response(render_template('index.html', movie_list=movie_list, movie_count=movie_count(owner.id),
+                                    can_edit=editable, listing=listing, live_since=live_since(owner)))
+
+def live_since(owner):
+    return latest_change(owner.id) if current_app.config['LIVE_UPDATES'] else None
+
+# 提交新增或修改的条目，并让该用户列表页面的缓存失效
+# 开启了 flask unique-titles 时，与列表中已有条目重复的写入会违反唯一索引，这时回滚并返回False
+def commit_movies(user_id):
+    try:
+        bump_cache_version(watchlist_key(user_id)) # 读取版本号前会先写入（flush）新增和修改的条目
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return False
+    return True
+
+# 保存新条目（表单和API共用），返回是否保存成功，成功后 movie.id 为新条目的ID
+# 开启 GROUP_COMMIT 时由 GroupCommitWriter 与其他请求的新条目一起提交，movie不加入会话
+def add_movie(movie):
+    writer = current_app.extensions['watchlist_writes']
+    if not writer.enabled:
+        db.session.add(movie)
+        return commit_movies(movie.user_id)
+    try:
+        movie.id = writer.submit(movie.user_id, Movie.__table__.insert().values(
+            title=movie.title, year=movie.year, user_id=movie.user_id))
+    except IntegrityError:
+        return False
+    g.pop('cache_versions', None)
+    g.wrote_primary = True
+    return True
+
+# 合并提交（group commit）
+# 每次提交都要等SQLite写完日志（synchronous=FULL时还要fsync），并且同一时间只有一个连接能写入，
+# 并发添加条目时大部分时间花在排队提交上。开启后每个请求把要执行的INSERT交给写入器，
+# 排在最前面的请求线程成为提交者：最近有并发写入时等待至多 GROUP_COMMIT_MAX_DELAY 秒或凑满 GROUP_COMMIT_MAX_BATCH 条，
+# 把这一批写入和缓存版本号的递增放在一个事务中执行，提交完成后才让这批请求返回，其余请求线程在此期间排队等待下一批。
+# 不需要后台线程；一批中有写入失败（例如违反唯一约束）时整批回滚，再逐条单独提交，只有失败的请求收到异常。
+# 请求返回时所在的批次已经写入磁盘：WAL模式下synchronous=NORMAL的提交不fsync（检查点时才写入），
+# 所以提交者的连接在执行这一批之前改为FULL，一次fsync由整批写入分摊
+class PendingWrite(object):
+    __slots__ = ('user_id', 'statement', 'result', 'error', 'done')
+
+    def __init__(self, user_id, statement):
+        self.user_id = user_id
+        self.statement = statement
+        self.result = self.error = None
+        self.done = False
+
+class GroupCommitWriter(object):
+    def __init__(self, app):
+        self.app = app
+        self._cond = threading.Condition()
+        self._pending = []
+        self._committing = False
+        self._last_batch = 1
+        self.batches = 0 # 已提交的事务数和写入数，用于观察合并的效果
+        self.writes = 0
+
+    @property
+    def enabled(self):
+        return self.app.config['GROUP_COMMIT']
+
+    # 执行一条INSERT并等待所在的批次提交，返回新记录的主键
+    def submit(self, user_id, statement):
+        config = self.app.config
+        entry = PendingWrite(user_id, statement)
+        with self._cond:
+            self._pending.append(entry)
+            self._cond.notify_all()
+            while not entry.done:
+                if self._committing:
+                    self._cond.wait()
+                    continue
+                self._committing = True
+                # 上一批只有一条写入时说明最近没有并发的写入，直接提交，单独的写入不增加延迟
+                deadline = time.time() + (config['GROUP_COMMIT_MAX_DELAY'] if self._last_batch > 1 else 0)
+                while len(self._pending) < config['GROUP_COMMIT_MAX_BATCH']:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[:config['GROUP_COMMIT_MAX_BATCH']]
+                del self._pending[:len(batch)]
+                self._last_batch = len(batch)
+                self._cond.release()
+                try:
+                    self._commit(batch)
+                finally:
+                    self._cond.acquire()
+                    self._committing = False
+                    self._cond.notify_all()
+        if entry.error is not None:
+            raise entry.error
+        return entry.result
+
+    def _commit(self, batch):
+        try:
+            self._execute(batch)
+            self.batches += 1
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].error = e
+            else:
+                for entry in batch:
+                    try:
+                        self._execute([entry])
+                        self.batches += 1
+                    except Exception as error:
+                        entry.error = error
+        for entry in batch:
+            entry.done = True
+        self.writes += len(batch)
+
+    # 使用提交者自己的会话（和它已经占用的连接）执行，排队的请求各自占用一个连接，
+    # 如果再从连接池取一个连接，并发写入的请求占满连接池时会互相等待
+    def _execute(self, batch):
+        versions = CacheVersion.__table__
+        now = datetime.utcnow()
+        try:
+            self._make_durable(db.session.connection(bind_arguments={'clause': batch[0].statement}))
+            results = [db.session.execute(entry.statement).inserted_primary_key[0] for entry in batch]
+            for name in sorted(set(watchlist_key(entry.user_id) for entry in batch)):
+                updated = db.session.execute(versions.update().where(versions.c.name == name)
+                                             .values(version=versions.c.version + 1, updated_at=now)).rowcount
+                if not updated:
+                    db.session.execute(versions.insert().values(name=name, version=1, updated_at=now))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        for entry, result in zip(batch, results):
+            entry.result = result
+
+    # 同步级别只能在事务之外修改，写入器的会话在执行这一批之前没有写入；连接归还连接池时恢复，见 listen_sqlite_pragmas
+    def _make_durable(self, connection):
+        level = sqlite_pragmas(self.app.config).get('synchronous')
+        if connection.dialect.name != 'sqlite' or str(level).upper() not in ('NORMAL', '1'):
+            return
+        if 'restore_synchronous' not in connection.info:
+            connection.exec_driver_sql('PRAGMA synchronous = FULL')
+            connection.info['restore_synchronous'] = level
 
 # 编辑条目
 # <int:movie_id> 部分表示 URL 变量，而 int 则是将变量转换成整型的 URL 变量转换器
-@app.route('/movie/edit/<int:movie_id>', methods=['GET','POST'])
+@bp.route('/movie/edit/<int:movie_id>', methods=['GET','POST'])
 @login_required
 def edit(movie_id):
-    # get_or_404会返回对应主键的记录，如果没有找到，则返回 404 错误响应
-    movie = Movie.query.get_or_404(movie_id)
+    # first_or_404会返回查询到的第一条记录，如果没有找到，则返回 404 错误响应
+    # 只能编辑自己列表中的条目
+    movie = prefetched('movie', (movie_id, current_user.id)) if request.method == 'GET' else NOT_PREFETCHED
+    if movie is NOT_PREFETCHED:
+        movie = Movie.query.filter_by(id=movie_id, user_id=current_user.id).first_or_404()
+    elif movie is None:
+        abort(404)
 
     if request.method == 'POST': # 处理编辑表单的提交请求
-        title = request.form['title']
-        year = request.form['year']
-
-        if not title or not year or len(year) > 4 or len(title) > 60:
+        fields = clean_movie(request.form['title'], request.form['year'])
+        if fields is None:
             flash("Invalid input.")
-            return redirect(url_for('edit', movie_id=movie_id))  # 重定向回对应的编辑页面
-        movie.title = title # 更新标题
-        movie.year = year # 更新年份
-        db.session.commit() # 提交数据库会话
+            return redirect(url_for('main.edit', movie_id=movie_id))  # 重定向回对应的编辑页面
+        movie.title, movie.year = fields # 更新标题和年份
+        if not commit_movies(current_user.id): # 提交数据库会话
+            flash("Movie already exists.")
+            return redirect(url_for('main.edit', movie_id=movie_id))
         flash("Item updated.")
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
     return render_template('edit.html', movie=movie) # 传入被编辑的电影记录
 
 # 删除条目
-@app.route('/movie/delete/<int:movie_id>', methods=['POST']) # 限定只接受POST请求
+@bp.route('/movie/delete/<int:movie_id>', methods=['POST']) # 限定只接受POST请求
 @login_required
 def delete(movie_id):
-    movie = Movie.query.get_or_404(movie_id) # 获取电影记录
+    movie = Movie.query.filter_by(id=movie_id, user_id=current_user.id).first_or_404() # 获取自己列表中的电影记录
     db.session.delete(movie) # 删除对应记录
+    bump_cache_version(watchlist_key(current_user.id))
     db.session.commit() # 提交数据库会话
     flash("Item deleted.")
-    return redirect(url_for('index')) # 重定向回主页
+    return redirect(url_for('main.index')) # 重定向回主页
+
+# 搜索和列表接口查看的用户：?user=<用户名> 指定的用户，否则与主页相同
+def list_owner():
+    username = request.args.get('user')
+    if username:
+        g.owner = user_profile(username)
+    return get_owner()
+
+# 搜索条目，?q= 按标题搜索（支持前缀匹配），?year= 按年份筛选，只在一个用户的列表中搜索
+@bp.route('/search')
+def search():
+    owner = list_owner()
+    if owner is None:
+        abort(404)
+    q = request.args.get('q', '').strip()
+    year = request.args.get('year', '').strip()
+    limit = max(1, min(request.args.get('limit', 50, type=int), current_app.config['MOVIES_MAX_PER_PAGE']))
+    movies = search_movies(owner.id, q, year, limit) if q or year else []
+    return render_template('search.html', q=q, year=year, movies=movies, can_edit=can_edit(owner))
 
 # 用户登录
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
@@ -239,31 +2444,47 @@ def login():
 
         if not username or not password:
             flash("Invalid input.")
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
+
+        # 失败次数过多的IP直接拒绝，不再计算散列
+        if login_limiter.blocked(request.remote_addr):
+            flash("Too many failed login attempts, please try again later.")
+            return render_template('login.html'), 429
 
-        user = User.query.first()
+        # 按用户名查找用户（username列有唯一索引）
+        user = User.query.filter_by(username=username).first()
         # 验证用户名密码是否一致
-        if username == user.username and user.validate_password(password):
+        try:
+            valid = user is not None and user.validate_password(password)
+        except HashQueueFull:
+            flash("Server busy, please try again later.")
+            return render_template('login.html'), 503
+        if valid:
+            # 散列强度配置变化后，用本次提交的明文密码重新散列
+            if user.password_needs_rehash():
+                user.set_password(password)
+                db.session.commit()
             login_user(user) # 登入用户
             flash("Login success.")
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         # 如果验证失败
         else:
+            login_limiter.record_failure(request.remote_addr)
             flash("Invalid username or password.")
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
 
     return render_template('login.html')
 
 # 用户登出
-@app.route('/logout')
+@bp.route('/logout')
 @login_required # 用于视图保护
 def logout():
     logout_user()
     flash("Goodbye.")
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
 # 编辑
-@app.route('/settings', methods=['GET', 'POST'])
+@bp.route('/settings', methods=['GET', 'POST'])
 @login_required
 def settings():
     if request.method == 'POST':
@@ -272,44 +2493,914 @@ def settings():
 
         if not name or len(name) > 20:
             flash("Invalid input.")
-            return redirect(url_for('settings'))
+            return redirect(url_for('main.settings'))
 
         # current_user 会返回当前登录用户的数据库记录对象
         # 等同于下面的用法
         # user = User.query.first()
         # user.name = name
         current_user.name = name
+        bump_cache_version('users')
         db.session.commit()
         flash("Settings updated.")
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
     return render_template('settings.html')
 
 
+# JSON API
+# 与表单视图使用相同的校验规则，写操作同样会递增当前用户的 watchlist 版本号让列表页面的缓存失效
+# 读取接口是公开的，写操作只能修改当前用户自己的条目
+def movie_to_dict(movie):
+    return {'id': movie.id, 'title': movie.title, 'year': movie.year}
+
+def api_error(message, status):
+    return jsonify(error=message), status
+
+def own_movies():
+    return Movie.query.filter_by(user_id=current_user.id)
+
+# API专用的登录保护：未登录时返回401而不是重定向到登录页面
+# 写操作要求JSON请求体，跨站表单无法伪造这种请求
+def api_login_required(func):
+    @wraps(func)
+    def decorated_view(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return api_error('Authentication required.', 401)
+        if request.method != 'DELETE' and not request.is_json:
+            return api_error('Expected a JSON body.', 415)
+        return func(*args, **kwargs)
+    return decorated_view
+
+# 从JSON对象中取出并校验标题和年份，传入movie时缺少的字段沿用原值（用于PATCH）
+def movie_fields(data, movie=None):
+    if not isinstance(data, dict):
+        return None
+    title = data.get('title', movie.title if movie is not None else None)
+    year = data.get('year', movie.year if movie is not None else None)
+    return clean_movie(title, year)
+
+@bp.route('/api/movies', methods=['GET'])
+def api_list_movies():
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, min(limit, current_app.config['MOVIES_MAX_PER_PAGE']))
+    owner = list_owner()
+    if owner is None:
+        return api_error('User not found.', 404)
+    page = paginate_movies(owner.id, after=request.args.get('after', type=int), limit=limit,
+                           listing=MovieListing.from_args(request.args))
+    movies = [movie_to_dict(movie) for movie in page]
+    return jsonify(movies=movies, next=page.last_id if page.has_next else None)
+
+@bp.route('/api/movies', methods=['POST'])
+@api_login_required
+def api_create_movie():
+    fields = movie_fields(request.get_json(silent=True))
+    if fields is None:
+        return api_error('Invalid input.', 400)
+    movie = Movie(title=fields[0], year=fields[1], user_id=current_user.id)
+    if not add_movie(movie):
+        return api_error('Movie already exists.', 409)
+    return jsonify(movie_to_dict(movie)), 201
+
+@bp.route('/api/movies/<int:movie_id>', methods=['GET'])
+def api_get_movie(movie_id):
+    movie = prefetched('movie', (movie_id, None))
+    if movie is NOT_PREFETCHED:
+        movie = Movie.query.get(movie_id)
+    if movie is None:
+        return api_error('Movie not found.', 404)
+    return jsonify(movie_to_dict(movie))
+
+@bp.route('/api/movies/<int:movie_id>', methods=['PUT', 'PATCH'])
+@api_login_required
+def api_update_movie(movie_id):
+    movie = own_movies().filter_by(id=movie_id).first()
+    if movie is None:
+        return api_error('Movie not found.', 404)
+    fields = movie_fields(request.get_json(silent=True), movie if request.method == 'PATCH' else None)
+    if fields is None:
+        return api_error('Invalid input.', 400)
+    movie.title, movie.year = fields
+    if not commit_movies(current_user.id):
+        return api_error('Movie already exists.', 409)
+    return jsonify(movie_to_dict(movie))
+
+@bp.route('/api/movies/<int:movie_id>', methods=['DELETE'])
+@api_login_required
+def api_delete_movie(movie_id):
+    movie = own_movies().filter_by(id=movie_id).first()
+    if movie is None:
+        return api_error('Movie not found.', 404)
+    db.session.delete(movie)
+    bump_cache_version(watchlist_key(current_user.id))
+    db.session.commit()
+    return '', 204
+
+# 批量操作，请求体格式：
+# {"create": [{"title": ..., "year": ...}], "update": [{"id": ..., "title": ..., "year": ...}], "delete": [id, ...]}
+# 所有操作在同一个事务里执行，任何一项失败都会整体回滚
+@bp.route('/api/movies/batch', methods=['POST'])
+@api_login_required
+def api_batch_movies():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return api_error('Invalid input.', 400)
+    creates = data.get('create') or []
+    updates = data.get('update') or []
+    deletes = data.get('delete') or []
+    if not all(isinstance(items, list) for items in (creates, updates, deletes)):
+        return api_error('Invalid input.', 400)
+    if not all(isinstance(movie_id, int) for movie_id in deletes):
+        return api_error('Invalid input.', 400)
+
+    created = []
+    for index, item in enumerate(creates):
+        fields = movie_fields(item)
+        if fields is None:
+            db.session.rollback()
+            return api_error('Invalid input in create[%d].' % index, 400)
+        movie = Movie(title=fields[0], year=fields[1], user_id=current_user.id)
+        db.session.add(movie)
+        created.append(movie)
+
+    # 一次查询取出所有要修改和删除的记录
+    update_ids = [item.get('id') if isinstance(item, dict) else None for item in updates]
+    ids = [movie_id for movie_id in update_ids if isinstance(movie_id, int)] + deletes
+    # 新增的条目在提交时才写入，查询前不自动flush，违反唯一约束时统一由 commit_movies 处理
+    with db.session.no_autoflush:
+        movies = {movie.id: movie for movie in own_movies().filter(Movie.id.in_(ids))} if ids else {}
+
+    updated = []
+    for index, item in enumerate(updates):
+        movie_id = update_ids[index]
+        movie = movies.get(movie_id) if isinstance(movie_id, int) else None
+        if movie is None:
+            db.session.rollback()
+            return api_error('Movie not found in update[%d].' % index, 404)
+        fields = movie_fields(item, movie)
+        if fields is None:
+            db.session.rollback()
+            return api_error('Invalid input in update[%d].' % index, 400)
+        movie.title, movie.year = fields
+        updated.append(movie)
+
+    for index, movie_id in enumerate(deletes):
+        movie = movies.get(movie_id)
+        if movie is None:
+            db.session.rollback()
+            return api_error('Movie not found in delete[%d].' % index, 404)
+        db.session.delete(movie)
+
+    if not commit_movies(current_user.id):
+        return api_error('Movie already exists.', 409)
+    return jsonify(created=[movie_to_dict(movie) for movie in created],
+                   updated=[movie_to_dict(movie) for movie in updated],
+                   deleted=deletes)
+
+# 增量同步：?since=<序号> 返回该序号之后新增、修改和删除的条目，每个条目只返回最新的状态；
+# 返回的 next 作为下次请求的 since，has_more 为true时继续请求。since=0 返回完整的列表。
+# 删除记录（墓碑）被压缩后，早于压缩序号的 since 会得到410，客户端需要从0重新同步
+@bp.route('/api/changes', methods=['GET'])
+def api_changes():
+    since = max(0, request.args.get('since', 0, type=int))
+    limit = max(1, min(request.args.get('limit', current_app.config['MOVIES_PER_PAGE'], type=int),
+                       current_app.config['MOVIES_MAX_PER_PAGE']))
+    owner = list_owner()
+    if owner is None:
+        return api_error('User not found.', 404)
+    if 0 < since < cache_version('changes'):
+        return api_error('Changes before %d have been compacted, sync again from 0.' % cache_version('changes'), 410)
+    changes, next_seq, has_more = collect_changes(owner.id, since, limit)
+    return jsonify(changes=changes, next=next_seq, has_more=has_more)
+
+# 读取某个用户在序号since之后的至多limit条变化，返回 (变化列表, 下次同步的序号, 是否还有更多)
+def collect_changes(user_id, since, limit):
+    rows = MovieChange.query.filter(MovieChange.user_id == user_id, MovieChange.seq > since) \
+        .order_by(MovieChange.seq).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    # 同一个条目的多次变化只保留最后一次
+    latest = OrderedDict()
+    for row in rows:
+        latest.pop(row.movie_id, None)
+        latest[row.movie_id] = row.seq
+    movies = {movie.id: movie for movie in Movie.query.filter(Movie.id.in_(list(latest)), Movie.user_id == user_id)} \
+        if latest else {}
+    changes = [dict(movie_to_dict(movies[movie_id]), seq=seq) if movie_id in movies
+               else {'id': movie_id, 'seq': seq, 'deleted': True}
+               for movie_id, seq in latest.items()]
+    return changes, rows[-1].seq if rows else since, has_more
+
+# 实时更新的进程内广播
+# 每个进程最多每 LIVE_POLL_INTERVAL 秒查询一次变更记录，把新的变化分发给本进程中等待的全部连接，
+# 所以其他worker、命令行和批量导入写入的变化同样会推送，查询次数也与连接数无关。
+# 查询由正在等待的连接线程顺带执行，没有连接时不查询，也不需要后台线程；
+# 本进程提交写入后立即唤醒等待的连接，不必等到下一次轮询
+LiveEvent = namedtuple('LiveEvent', 'seq user_id data')
+
+class ChangeBroadcaster(object):
+    def __init__(self, app):
+        self.app = app
+        self._cond = threading.Condition()
+        self._poll_lock = threading.Lock()
+        self._events = deque(maxlen=app.config['LIVE_BUFFER_SIZE'])
+        self._polled_at = 0
+        self.last_seq = None # 已经读取的最大序号
+        self.floor = None # 缓冲区中最早的变化之前的序号
+        self.clients = 0
+        self.threaded = 0 # 其中占用线程的连接数
+        self.thread_limit = None # 占用线程的连接数上限，见 WatchlistASGI
+        self.listeners = [] # 写入后的回调，asgi.py 用来唤醒事件循环中的连接
+
+    # threaded：连接是否在等待期间占用一个线程
+    def connect(self, threaded=True):
+        with self._cond:
+            if self.clients >= self.app.config['LIVE_MAX_CLIENTS']:
+                return False
+            if threaded and self.thread_limit is not None and self.threaded >= self.thread_limit:
+                return False
+            self.clients += 1
+            self.threaded += threaded
+            return True
+
+    def disconnect(self, threaded=True):
+        with self._cond:
+            self.clients -= 1
+            self.threaded -= threaded
+
+    def notify(self):
+        with self._cond:
+            self._polled_at = 0
+            self._cond.notify_all()
+        for listener in list(self.listeners):
+            listener()
+
+    def poll(self, force=False):
+        if not force and time.time() - self._polled_at < self.app.config['LIVE_POLL_INTERVAL']:
+            return
+        # 其他线程正在查询时不重复查询，等待它的结果
+        if not self._poll_lock.acquire(blocking=False):
+            return
+        try:
+            self._polled_at = time.time()
+            changes = MovieChange.__table__
+            movies = Movie.__table__
+            with db.get_engine(self.app).connect() as conn:
+                if self.last_seq is None:
+                    # 第一次查询只记录当前进度，之前的变化由连接自己从数据库补齐
+                    self.last_seq = self.floor = conn.execute(db.select(db.func.max(changes.c.seq))).scalar() or 0
+                    return
+                limit = self.app.config['LIVE_BUFFER_SIZE']
+                rows = conn.execute(
+                    db.select(changes.c.seq, changes.c.user_id, changes.c.movie_id, movies.c.title, movies.c.year)
+                    .select_from(changes.outerjoin(movies, db.and_(movies.c.id == changes.c.movie_id,
+                                                                   movies.c.user_id == changes.c.user_id)))
+                    .where(changes.c.seq > self.last_seq).order_by(changes.c.seq).limit(limit)).all()
+                if not rows:
+                    return
+                user_ids = set(row.user_id for row in rows)
+                counts = dict(conn.execute(db.select(movies.c.user_id, db.func.count(movies.c.id))
+                                           .where(movies.c.user_id.in_(user_ids)).group_by(movies.c.user_id)).all())
+            events = []
+            for row in rows:
+                if row.title is None:
+                    data = {'id': row.movie_id, 'seq': row.seq, 'deleted': True}
+                else:
+                    data = {'id': row.movie_id, 'title': row.title, 'year': row.year, 'seq': row.seq}
+                data['count'] = counts.get(row.user_id, 0)
+                events.append(LiveEvent(row.seq, row.user_id, json.dumps(data)))
+            with self._cond:
+                for event in events:
+                    if len(self._events) == self._events.maxlen:
+                        self.floor = self._events[0].seq
+                    self._events.append(event)
+                self.last_seq = rows[-1].seq
+                if len(rows) == limit:
+                    self._polled_at = 0 # 还有没读完的变化
+                self._cond.notify_all()
+        finally:
+            self._poll_lock.release()
+
+    # 缓冲区中某个用户在序号since之后的变化，返回 (变化列表, 广播进度)，不查询数据库；
+    # 缓冲区中已经没有since之后的全部变化时变化列表为None
+    def pending(self, user_id, since):
+        with self._cond:
+            # 还没有完成第一次查询（其他线程正在查询）时也从数据库补齐
+            if self.floor is None or since < self.floor:
+                return None, self.last_seq or since
+            events = []
+            for event in reversed(self._events):
+                if event.seq <= since:
+                    break
+                if event.user_id == user_id:
+                    events.append(event)
+            return events[::-1], self.last_seq
+
+    # 等待某个用户在序号since之后的变化，返回值与 pending 相同
+    def wait(self, user_id, since, timeout):
+        interval = self.app.config['LIVE_POLL_INTERVAL']
+        deadline = time.time() + timeout
+        while True:
+            self.poll()
+            with self._cond:
+                events, latest = self.pending(user_id, since)
+                now = time.time()
+                if events is None or events or now >= deadline:
+                    return events, latest
+                # 等到超时、被唤醒或者该查询的时候
+                self._cond.wait(max(0.01, min(deadline, self._polled_at + interval) - now))
+
+# 实时更新的消息格式，asgi.py 在事件循环中保持连接时使用相同的函数
+RESET_MESSAGE = 'event: reset\ndata: {}\n\n'
+
+def live_retry_message(config):
+    return 'retry: %d\n\n' % (config['LIVE_POLL_INTERVAL'] * 1000 + 1000)
+
+# 缓冲区中的变化，返回 (消息列表, 新的序号)
+def live_messages(events, cursor, latest):
+    messages = ['id: %d\nevent: movie\ndata: %s\n\n' % (event.seq, event.data) for event in events]
+    if latest > (events[-1].seq if events else cursor):
+        # 其他用户的变化只推进序号，浏览器重连时从这里继续
+        messages.append('id: %d\n: ping\n\n' % latest)
+    elif not events:
+        messages.append(': ping\n\n')
+    return messages, latest
+
+# 缓冲区中已经没有序号cursor之后的全部变化，从数据库补齐，返回 (消息列表, 新的序号)；
+# 早于压缩边界或者变化太多时让页面重新加载，新的序号为None
+def replay_changes(owner_id, cursor, latest, horizon):
+    if 0 < cursor < horizon:
+        return [RESET_MESSAGE], None
+    changes, next_seq, has_more = collect_changes(owner_id, cursor, current_app.config['MOVIES_MAX_PER_PAGE'])
+    count = db.session.query(db.func.count(Movie.id)).filter(Movie.user_id == owner_id).scalar()
+    db.session.close()
+    if has_more:
+        return [RESET_MESSAGE], None
+    # 读取时已经包含了广播进度之前的全部变化
+    return ['id: %d\nevent: movie\ndata: %s\n\n' % (change['seq'], json.dumps(dict(change, count=count)))
+            for change in changes], max(next_seq, latest)
+
+# 实时更新，浏览器用 EventSource 连接 /events?user=<用户名>&since=<序号>，
+# 收到的每条消息是一个条目的最新状态（与 /api/changes 中的格式相同，另外带上列表的条目数），
+# 消息的id是变更序号，重连时浏览器通过 Last-Event-ID 请求头从断开的位置继续
+@bp.route('/events')
+def movie_events():
+    config = current_app.config
+    if not config['LIVE_UPDATES']:
+        abort(404)
+    owner = list_owner()
+    if owner is None:
+        abort(404)
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', type=int)
+    live = current_app.extensions['watchlist_live']
+    if not live.connect():
+        response = Response('Too many live connections.\n', 503, mimetype='text/plain')
+        response.headers['Retry-After'] = str(config['LIVE_HEARTBEAT'])
+        return response
+    owner_id = owner.id
+    horizon = cache_version('changes')
+
+    def generate():
+        # 变更记录总是从主库读取；连接期间不占用数据库连接，补齐时再临时取用
+        g.pop('read_engine', None)
+        cursor = since
+        if cursor is None:
+            cursor = db.session.query(db.func.max(MovieChange.seq)).scalar() or 0
+        db.session.close()
+        yield live_retry_message(config)
+        deadline = time.time() + config['LIVE_MAX_SECONDS']
+        while True:
+            timeout = min(config['LIVE_HEARTBEAT'], deadline - time.time())
+            events, latest = live.wait(owner_id, cursor, max(0, timeout))
+            if events is None:
+                messages, cursor = replay_changes(owner_id, cursor, latest, horizon)
+                for message in messages:
+                    yield message
+                if cursor is None:
+                    return
+                continue
+            messages, cursor = live_messages(events, cursor, latest)
+            for message in messages:
+                yield message
+            if time.time() >= deadline:
+                return
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.call_on_close(live.disconnect)
+    response.headers['Cache-Control'] = 'no-cache'
+    # 让nginx等反向代理不要缓冲响应
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# 后台任务队列
+# 任务保存在job表中，批量导入、重建全文索引、预热缓存等耗时的工作放到后台执行，请求立即返回任务ID，
+# 客户端通过 /api/jobs/<ID> 查看进度。任务由程序进程内的任务线程（JOB_WORKER_THREADS）或单独的 flask worker 进程执行，
+# 多个进程同时领取时由 UPDATE ... WHERE status = 'queued' 保证每个任务只被一个线程领取。
+# 处理函数抛出异常时回滚这次执行中没有提交的修改，稍后重试；处理函数分批提交并报告进度时，重试从上次提交的位置继续
+JOB_HANDLERS = {}
+
+def job_handler(kind):
+    def decorator(func):
+        JOB_HANDLERS[kind] = func
+        return func
+    return decorator
+
+class JobQueue(object):
+    def __init__(self, app):
+        self.app = app
+        self._cond = threading.Condition()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._stopping = False
+        self._maintained_at = 0
+
+    def enqueue(self, kind, params=None, user_id=None, total=None, max_attempts=None):
+        if kind not in JOB_HANDLERS:
+            raise ValueError('Unknown job kind: %s' % kind)
+        job = Job(kind=kind, payload=json.dumps(params or {}), user_id=user_id, total=total,
+                  max_attempts=max_attempts or self.app.config['JOB_MAX_ATTEMPTS'])
+        db.session.add(job)
+        db.session.commit()
+        with self._cond:
+            self._cond.notify()
+        return job
+
+    # 领取一个到期的任务，其他线程或进程先领取了同一个任务时换下一个
+    def claim(self):
+        worker = '%d/%s' % (os.getpid(), threading.current_thread().name)
+        while True:
+            now = datetime.utcnow()
+            job = Job.query.filter(Job.status == 'queued', Job.run_at <= now).order_by(Job.run_at, Job.id).first()
+            if job is None:
+                db.session.commit()
+                return None
+            claimed = Job.query.filter(Job.id == job.id, Job.status == 'queued').update(
+                {'status': 'running', 'attempts': Job.attempts + 1, 'locked_by': worker, 'updated_at': now},
+                synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                return job
+
+    def execute(self, job):
+        handler = JOB_HANDLERS.get(job.kind)
+        try:
+            if handler is None:
+                raise LookupError('Unknown job kind: %s' % job.kind)
+            result = handler(job)
+            if result is not None:
+                job.result = json.dumps(result)
+            job.status = 'done'
+            job.error = None
+            job.finished_at = job.updated_at = datetime.utcnow()
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            self.app.logger.exception('Job %d (%s) failed', job.id, job.kind)
+            now = datetime.utcnow()
+            job.error = '%s: %s' % (type(e).__name__, e)
+            job.updated_at = now
+            if job.attempts >= job.max_attempts:
+                job.status = 'failed'
+                job.finished_at = now
+            else:
+                job.status = 'queued'
+                job.run_at = now + timedelta(seconds=self.app.config['JOB_RETRY_DELAY'] * 2 ** (job.attempts - 1))
+            db.session.commit()
+
+    # 重新排队心跳超时的任务，删除过期的已结束任务；每个进程最多每分钟执行一次
+    def maintain(self):
+        if time.time() - self._maintained_at < 60:
+            return
+        self._maintained_at = time.time()
+        config = self.app.config
+        now = datetime.utcnow()
+        stale = Job.query.filter(Job.status == 'running',
+                                 Job.updated_at < now - timedelta(seconds=config['JOB_LEASE_SECONDS']))
+        stale.filter(Job.attempts >= Job.max_attempts).update(
+            {'status': 'failed', 'error': 'Worker lost.', 'finished_at': now}, synchronize_session=False)
+        stale.update({'status': 'queued', 'error': 'Worker lost.', 'run_at': now}, synchronize_session=False)
+        Job.query.filter(Job.status.in_(('done', 'failed')),
+                         Job.finished_at < now - timedelta(days=config['JOB_KEEP_DAYS'])).delete(synchronize_session=False)
+        db.session.commit()
+
+    # 执行一个任务，没有到期的任务时返回False；每个任务在单独的程序上下文中执行
+    def run_next(self):
+        with self.app.app_context():
+            self.maintain()
+            job = self.claim()
+            if job is None:
+                return False
+            self.execute(job)
+            return True
+
+    # 在当前线程中执行全部到期的任务，返回执行的任务数
+    def run_pending(self):
+        count = 0
+        while self.run_next():
+            count += 1
+        return count
+
+    def start(self, threads=None):
+        threads = self.app.config['JOB_WORKER_THREADS'] if threads is None else threads
+        with self._lock:
+            if self._threads:
+                return
+            self._stopping = False
+            for number in range(threads):
+                thread = threading.Thread(target=self._work, name='job-worker-%d' % number, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        with self._lock:
+            with self._cond:
+                self._stopping = True
+                self._cond.notify_all()
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+
+    def _work(self):
+        while not self._stopping:
+            try:
+                ran = self.run_next()
+            except Exception:
+                self.app.logger.exception('Job worker error')
+                ran = False
+            if not ran:
+                with self._cond:
+                    if not self._stopping:
+                        self._cond.wait(self.app.config['JOB_POLL_INTERVAL'])
+
+# 处理第一个请求时启动程序进程内的任务线程（gunicorn预加载程序时，fork之后才启动）
+# 内存数据库的每个线程使用各自的数据库，任务线程看不到请求中创建的任务
+@bp.before_app_request
+def start_job_workers():
+    jobs = current_app.extensions['watchlist_jobs']
+    if jobs._threads or not current_app.config['JOB_WORKER_THREADS'] or current_app.testing:
+        return
+    if db.engine.url.database in (None, '', ':memory:'):
+        return
+    jobs.start()
+
+def job_to_dict(job):
+    def timestamp(value):
+        return value.isoformat() + 'Z' if value is not None else None
+    return {'id': job.id, 'kind': job.kind, 'status': job.status, 'progress': job.progress, 'total': job.total,
+            'attempts': job.attempts, 'result': job.result_data, 'error': job.error,
+            'created_at': timestamp(job.created_at), 'finished_at': timestamp(job.finished_at)}
+
+# 导入文件中的电影，进度是已经处理的行数，导入和跳过的条数累计在任务结果中
+# 参数：path、format、user_id、batch_size，remove为true时导入完成后删除文件（上传的文件）
+@job_handler('import-movies')
+def run_import_job(job):
+    params = job.params
+    done = job.result_data or {}
+    if job.total is None:
+        with open(params['path'], encoding='utf-8') as f:
+            job.report(job.progress, total=count_movie_rows(f, params['format']))
+
+    def on_batch(rows, imported, skipped):
+        job.report(rows, result={'imported': done.get('imported', 0) + imported,
+                                 'skipped': done.get('skipped', 0) + skipped})
+
+    with open(params['path'], encoding='utf-8') as f:
+        import_movie_file(f, params['format'], params['user_id'], params.get('batch_size', 5000),
+                          start=job.progress, on_batch=on_batch)
+    if params.get('remove'):
+        os.remove(params['path'])
+
+@job_handler('search-index')
+def run_search_index_job(job):
+    connection = db.session.connection()
+    create_search_index(Movie.__table__, connection)
+    connection.exec_driver_sql("INSERT INTO movie_fts(movie_fts) VALUES ('rebuild')")
+    job.report(1, total=1)
+
+# 预热缓存：编译模板（写入多个进程共用的模板缓存目录），需要时更新只读快照，
+# 并渲染每个用户（至多 FRAGMENT_CACHE_SIZE 个）列表的第一页，填充执行任务的进程中的列表片段和用户资料缓存
+@job_handler('warm-cache')
+def run_warm_cache_job(job):
+    compile_templates()
+    if current_app.config['READ_SNAPSHOT_INTERVAL'] and not current_app.config['SQLALCHEMY_READ_URI']:
+        current_app.extensions['watchlist_reads'].take_snapshot()
+    # 没有用户名的用户（例如 forge 创建的）没有 /user/<username> 页面
+    usernames = [row.username for row in User.query.with_entities(User.username).filter(User.username.isnot(None))
+                 .order_by(User.id).limit(current_app.config['FRAGMENT_CACHE_SIZE'])]
+    job.report(0, total=len(usernames))
+    for number, username in enumerate(usernames, 1):
+        with current_app.test_request_context():
+            path = url_for('main.user_watchlist', username=username)
+        # 与匿名访问该用户的页面时缓存的内容相同
+        with current_app.test_request_context(path):
+            owner = user_profile(username)
+            g.owner = owner
+            render_index(owner)
+        job.report(number)
+    return {'users': len(usernames)}
+
+# 查看任务状态，只有发起任务的用户可以查看
+@bp.route('/api/jobs/<int:job_id>', methods=['GET'])
+def api_get_job(job_id):
+    if not current_user.is_authenticated:
+        return api_error('Authentication required.', 401)
+    # 进度由任务线程写入主库，只读库可能还没有同步
+    g.pop('read_engine', None)
+    job = Job.query.get(job_id)
+    if job is None or job.user_id != current_user.id:
+        return api_error('Job not found.', 404)
+    return jsonify(job_to_dict(job))
+
+# 后台导入：请求体为 {"movies": [{"title": ..., "year": ...}, ...]}，写入上传目录后创建导入任务，
+# 返回202和任务状态，Location指向任务状态接口；无效的条目在导入时跳过
+@bp.route('/api/import', methods=['POST'])
+@api_login_required
+def api_import_movies():
+    data = request.get_json(silent=True)
+    movies = data.get('movies') if isinstance(data, dict) else None
+    if not isinstance(movies, list) or not movies:
+        return api_error('Invalid input.', 400)
+    upload_dir = current_app.config['JOB_UPLOAD_DIR']
+    os.makedirs(upload_dir, exist_ok=True)
+    path = os.path.join(upload_dir, 'import-%s.jsonl' % secrets.token_hex(8))
+    with open(path, 'w', encoding='utf-8') as f:
+        for item in movies:
+            f.write(json.dumps(item if isinstance(item, dict) else {}) + '\n')
+    job = current_app.extensions['watchlist_jobs'].enqueue(
+        'import-movies', {'path': path, 'format': 'jsonl', 'user_id': current_user.id, 'remove': True},
+        user_id=current_user.id, total=len(movies))
+    return jsonify(job_to_dict(job)), 202, {'Location': url_for('main.api_get_job', job_id=job.id)}
+
+# 单独的任务进程，--burst 执行完到期的任务后退出（适合cron）
+@bp.cli.command()
+@click.option('--threads', default=1, show_default=True, help='Number of worker threads')
+@click.option('--burst', is_flag=True, help='Run the jobs that are due and exit')
+def worker(threads, burst):
+    """Run queued background jobs"""
+    db.create_all()
+    jobs = current_app.extensions['watchlist_jobs']
+    if burst:
+        click.echo('Processed %d jobs.' % jobs.run_pending())
+        return
+    jobs.start(threads)
+    click.echo('Worker started with %d threads, press Ctrl+C to stop.' % threads)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        jobs.stop()
+
+# 列出最近的任务
+@bp.cli.command()
+@click.option('--limit', default=20, show_default=True, help='Number of jobs to show')
+def jobs(limit):
+    """List recent background jobs"""
+    db.create_all()
+    for job in Job.query.order_by(Job.id.desc()).limit(limit):
+        progress = '%d/%s' % (job.progress, job.total if job.total is not None else '?')
+        line = '#%d %s %s %s attempts=%d' % (job.id, job.kind, job.status, progress, job.attempts)
+        if job.error:
+            line += ' error=%s' % job.error
+        click.echo(line)
+
+@bp.cli.command()
+@click.argument('kind', type=click.Choice(['search-index', 'warm-cache']))
+def enqueue(kind):
+    """Queue a search index rebuild or cache warm-up"""
+    db.create_all()
+    job = current_app.extensions['watchlist_jobs'].enqueue(kind)
+    click.echo('Queued %s job %d.' % (kind, job.id))
+
+# 电影海报
+# 上传的原图按SHA-256保存为 <POSTER_DIR>/<前两位>/<散列>，缩略图为同一目录下的 <散列>-<宽度>.webp；
+# 内容相同的图片只保存和处理一次，文件名随内容变化，所以可以让浏览器永久缓存。
+# 上传请求只保存原图并创建缩略图任务，解码和缩放在任务线程提交给进程池（image_processor）执行，
+# 不占用请求线程，也不和请求线程争用GIL；缩略图全部生成后才把海报设置到条目上
+POSTER_SIGNATURES = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n', b'GIF87a', b'GIF89a')
+
+def poster_path(digest, width=None):
+    name = digest if width is None else '%s-%d.webp' % (digest, width)
+    return os.path.join(current_app.config['POSTER_DIR'], digest[:2], name)
+
+def poster_ready(digest):
+    return all(os.path.isfile(poster_path(digest, width)) for width in current_app.config['POSTER_WIDTHS'])
+
+def is_poster_image(data):
+    return data.startswith(POSTER_SIGNATURES) or (data[:4] == b'RIFF' and data[8:12] == b'WEBP')
+
+# 保存原图，返回内容散列；先写入临时文件再改名，并发上传同一张图片时不会读到写了一半的文件
+def store_poster(data):
+    digest = hashlib.sha256(data).hexdigest()
+    path = poster_path(digest)
+    if not os.path.isfile(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return digest
+
+# 在进程池中执行：解码原图，按每个宽度裁剪为2:3并保存为WebP
+def render_poster(source, widths, quality, max_pixels):
+    from PIL import Image, ImageOps
+    # Pillow在打开时只检查2倍以上的像素数（1到2倍之间只发出警告），这里按读取到的尺寸检查，
+    # 打开图片只读取文件头，超过上限时不会解码
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    with Image.open(source) as image:
+        if image.width * image.height > max_pixels:
+            raise Image.DecompressionBombError('Image size (%d pixels) exceeds limit of %d pixels.'
+                                               % (image.width * image.height, max_pixels))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        for width in widths:
+            target = '%s-%d.webp' % (source, width)
+            tmp_path = '%s.%d.tmp' % (target, os.getpid())
+            ImageOps.fit(image, (width, width * 3 // 2), Image.LANCZOS).save(tmp_path, 'WEBP', quality=quality, method=4)
+            os.replace(tmp_path, target)
+
+# 图片处理进程池，与 PasswordHasher 一样第一次用到时才创建，使用spawn启动子进程
+class ImageProcessor(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                self._executor = ProcessPoolExecutor(max_workers=current_app.config['POSTER_WORKERS'],
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def run(self, func, *args):
+        if not current_app.config['POSTER_WORKERS']:
+            return func(*args)
+        return self._get_executor().submit(func, *args).result(timeout=current_app.config['POSTER_TIMEOUT'])
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+image_processor = ImageProcessor()
+
+# 生成缩略图后设置条目的海报；参数：digest、movie_id、user_id
+# 图片无法解码时重试也没有用，上传时创建的任务只执行一次
+@job_handler('poster-thumbnails')
+def run_poster_job(job):
+    params = job.params
+    widths = current_app.config['POSTER_WIDTHS']
+    job.report(0, total=len(widths))
+    if not poster_ready(params['digest']):
+        image_processor.run(render_poster, poster_path(params['digest']), widths,
+                            current_app.config['POSTER_QUALITY'], current_app.config['POSTER_MAX_PIXELS'])
+    movie = Movie.query.filter_by(id=params['movie_id'], user_id=params['user_id']).first()
+    if movie is not None: # 条目可能已经被删除
+        movie.poster = params['digest']
+        bump_cache_version(watchlist_key(movie.user_id))
+    job.report(len(widths))
+
+# 上传海报，表单字段为poster
+@bp.route('/movie/<int:movie_id>/poster', methods=['POST'])
+@login_required
+def upload_poster(movie_id):
+    movie = Movie.query.filter_by(id=movie_id, user_id=current_user.id).first_or_404()
+    next_url = url_for('main.edit', movie_id=movie_id)
+    max_bytes = current_app.config['POSTER_MAX_BYTES']
+    # 请求体明显过大时不解析表单，不把上传的文件写入临时文件
+    if request.content_length and request.content_length > max_bytes + 64 * 1024:
+        flash("Poster is too large.")
+        return redirect(next_url)
+    upload = request.files.get('poster')
+    data = upload.read(max_bytes + 1) if upload else b''
+    if not data:
+        flash("No poster selected.")
+        return redirect(next_url)
+    if len(data) > max_bytes:
+        flash("Poster is too large.")
+        return redirect(next_url)
+    if not is_poster_image(data):
+        flash("Poster must be a JPEG, PNG, GIF or WebP image.")
+        return redirect(next_url)
+    if importlib.util.find_spec('PIL') is None:
+        flash("Poster uploads need Pillow.")
+        return redirect(next_url)
+
+    digest = store_poster(data)
+    if poster_ready(digest):
+        movie.poster = digest
+        commit_movies(current_user.id)
+        flash("Poster updated.")
+    else:
+        current_app.extensions['watchlist_jobs'].enqueue(
+            'poster-thumbnails', {'digest': digest, 'movie_id': movie.id, 'user_id': current_user.id},
+            user_id=current_user.id, total=len(current_app.config['POSTER_WIDTHS']), max_attempts=1)
+        flash("Poster uploaded, it will appear in a moment.")
+    return redirect(next_url)
+
+@bp.app_template_global()
+def poster_url(digest, width=None):
+    return url_for('main.poster_file', name='%s-%d.webp' % (digest, width or current_app.config['POSTER_WIDTHS'][0]))
+
+@bp.app_template_global()
+def poster_srcset(digest):
+    return ', '.join('%s %dw' % (poster_url(digest, width), width) for width in current_app.config['POSTER_WIDTHS'])
+
+# 缩略图文件的 (路径, 大小)，文件内容不会变化，缓存命中时不需要访问文件系统
+poster_files = FragmentCache('POSTER_CACHE_SIZE')
+
+# 发送缩略图：文件名就是ETag；文件交给服务器的 wsgi.file_wrapper（gunicorn使用sendfile），
+# 设置了 USE_X_SENDFILE 时只返回 X-Sendfile 头，由前面的nginx/Apache发送文件
+@bp.route('/posters/<name>')
+def poster_file(name):
+    meta = poster_files.get(name)
+    if meta is None:
+        match = re.match(r'([0-9a-f]{64})-([0-9]+)\.webp\Z', name)
+        if match is None or int(match.group(2)) not in current_app.config['POSTER_WIDTHS']:
+            abort(404)
+        path = poster_path(match.group(1), int(match.group(2)))
+        try:
+            meta = (path, os.path.getsize(path))
+        except OSError:
+            abort(404)
+        poster_files.set(name, meta)
+    path, size = meta
+    if not is_resource_modified(request.environ, etag=name):
+        response = Response(status=304)
+    elif current_app.config['USE_X_SENDFILE']:
+        response = Response(mimetype='image/webp', headers={'X-Sendfile': path})
+        response.content_length = size
+    else:
+        try:
+            f = open(path, 'rb')
+        except OSError: # 文件已经被 flask prune-posters 删除
+            abort(404)
+        response = Response(wrap_file(request.environ, f), mimetype='image/webp', direct_passthrough=True)
+        response.content_length = size
+    response.set_etag(name)
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['ASSET_MAX_AGE']
+    response.cache_control.immutable = True
+    return response
+
+# 删除没有条目引用的海报文件（条目被删除或更换了海报）
+# 最近修改的文件可能属于还没有完成的上传，保留到 --hours 小时之后
+@bp.cli.command('prune-posters')
+@click.option('--hours', default=24, show_default=True, help='Keep files younger than this')
+def prune_posters(hours):
+    """Delete poster files no movie refers to"""
+    root = current_app.config['POSTER_DIR']
+    used = set(digest for digest, in db.session.query(Movie.poster).filter(Movie.poster.isnot(None)).distinct())
+    cutoff = time.time() - hours * 3600
+    removed = 0
+    for directory, dirs, files in os.walk(root):
+        for name in files:
+            path = os.path.join(directory, name)
+            if name[:64] not in used and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+    poster_files.clear()
+    click.echo("Removed %d poster files." % removed)
+
+# Prometheus抓取接口，统计数据包含各接口的耗时和错误数，只对持有令牌的抓取程序开放
+@bp.route('/metrics')
+def metrics():
+    token = current_app.config['METRICS_TOKEN']
+    if not token:
+        abort(404)
+    if not secrets.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token):
+        abort(403)
+    return Response(request_metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # 错误处理函数，当404错误发生时，这个函数会被触发，返回值会作为响应主体返回给客户端
-@app.errorhandler(404) #传入要处理的错误代码
+@bp.app_errorhandler(404) #传入要处理的错误代码
 def page_not_found(e): #接受异常对象作为参数
-    user = User.query.first()
+    # user = User.query.first() # 已由inject_user统一注入
     # return render_template('404.html', user=user), 404 #返回模板和状态码，普通函数不需要写出状态码，因为默认是200
     return render_template('404.html'), 404
 
-@app.route('/totoro')
+@bp.route('/totoro')
 def totoro():
     return '<h1>Hello Totoro!</h1><img src="http://helloflask.com/totoro.gif">'
 
-@app.route('/user/<name>')
+@bp.route('/user/<name>')
 def user_page(name):
     return "Hello %s" % name
 
-@app.route('/')
+@bp.route('/')
 def test_url_for():
-    print(url_for('index'))
-    print(url_for('user_page', name='duj4'))
-    print(url_for('user_page', name='jason'))
-    print(url_for('test_url_for'))
-    print(url_for('test_url_for',num=2))
+    print(url_for('main.index'))
+    print(url_for('main.user_page', name='duj4'))
+    print(url_for('main.user_page', name='jason'))
+    print(url_for('main.test_url_for'))
+    print(url_for('main.test_url_for',num=2))
 
     return "Test Page"
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0',port=5000)
\ No newline at end of file
+    create_app().run(debug=True, host='0.0.0.0',port=5000)
\ No newline at end of file
@@ -0,0 +1,506 @@
+# ASGI入口：uvicorn --factory asgi:create_asgi_app --workers 4
+# 主页、用户列表页面、编辑页面和列表接口的GET请求在事件循环中用异步SQLite驱动（aiosqlite）查询数据库，
+# 再把结果随请求交给Flask程序处理（见 app.prefetched），确定视图和模板不需要再访问数据库或文件时直接在事件循环中执行；
+# 其他请求（以及需要同步I/O的预查询请求）在线程池中按WSGI方式处理。连接在等待客户端和数据库时只占用一个协程而不是一个线程，
+# 每个进程可以保持大量keep-alive连接和实时更新（/events）的长连接。登录状态仍然由Flask-Login从同一个session中读取。
+import asyncio
+import io
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_login import COOKIE_NAME
+from sqlalchemy import select, func
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from werkzeug.exceptions import HTTPException
+from werkzeug.wrappers import Request
+
+from app import create_app, Movie, MovieChange, User, CacheVersion, OwnerProfile, MovieListing, watchlist_key, fragment_key
+from app import user_cache, fragment_cache
+from app import sqlite_pragmas, listen_sqlite_pragmas
+from app import live_messages, live_retry_message, replay_changes
+
+# 可选依赖：没有安装异步驱动时，全部请求都在线程池中处理
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+
+users = User.__table__
+movies = Movie.__table__
+versions = CacheVersion.__table__
+changes = MovieChange.__table__
+
+
+def create_asgi_app(config=None):
+    return WatchlistASGI(create_app(config))
+
+
+# 异步引擎只用于SQLite文件数据库，内存数据库无法在两个驱动之间共享
+def create_async_sqlite_engine(app, uri):
+    url = make_url(uri)
+    if aiosqlite is None or not url.drivername.startswith('sqlite') or url.database in (None, '', ':memory:'):
+        return None
+    # 日志模式已经由同步引擎设置，只读库也不能修改
+    pragmas = OrderedDict((name, value) for name, value in sqlite_pragmas(app.config).items()
+                          if name != 'journal_mode')
+    engine = create_async_engine(url.set(drivername='sqlite+aiosqlite'), poolclass=AsyncAdaptedQueuePool,
+                                 pool_size=app.config['ASGI_POOL_SIZE'], max_overflow=0)
+    listen_sqlite_pragmas(engine.sync_engine, pragmas)
+    return engine
+
+
+# 与 paginate_movies 中的查询相同，向前翻页时倒序取出
+def page_select(user_id, after, before, limit, listing):
+    where, order_by = listing.clauses(movies, user_id, after, before)
+    return select(movies.c.id, movies.c.title, movies.c.year, movies.c.poster).where(*where).order_by(*order_by).limit(limit + 1)
+
+
+def profile_from_row(row):
+    return OwnerProfile(row.id, row.name, row.username) if row is not None else None
+
+
+# 把ASGI请求转换为WSGI的environ
+def build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    # 请求内容已经完整读取（包括分块传输的请求）
+    environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+
+def encode_headers(headers):
+    return [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+
+# 请求内容读完之后，receive() 只会在客户端断开时返回
+async def wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+class WatchlistASGI(object):
+    def __init__(self, app):
+        self.app = app
+        self.executor = ThreadPoolExecutor(app.config['ASGI_THREADS'], thread_name_prefix='watchlist-wsgi')
+        self.engine = create_async_sqlite_engine(app, app.config['SQLALCHEMY_DATABASE_URI'])
+        read_uri = app.config['SQLALCHEMY_READ_URI']
+        self.read_engine = create_async_sqlite_engine(app, read_uri) if read_uri else None
+        # 在事件循环中处理的端点和对应的预查询函数
+        self.prefetchers = {
+            'main.index': self.prefetch_watchlist,
+            'main.user_watchlist': self.prefetch_watchlist,
+            'main.api_list_movies': self.prefetch_watchlist,
+            'main.edit': self.prefetch_movie,
+            'main.api_get_movie': self.prefetch_movie,
+        }
+        # 实时更新的连接在事件循环中等待，所有连接共用一个轮询任务；
+        # 不能在事件循环中处理时（没有异步驱动、用记住我Cookie登录）每个连接占用一个线程，最多占用线程池的一半
+        self.live = app.extensions['watchlist_live']
+        self.live.thread_limit = max(1, app.config['ASGI_THREADS'] // 2)
+        self.live_clients = 0
+        self.live_poller = None
+        self.live_changed = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        body = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        environ = build_environ(scope, b''.join(body))
+
+        match = self.match(environ) if self.engine is not None else None
+        if match is None:
+            return await self.call_threaded(environ, receive, send)
+        endpoint, view_args = match
+        request = Request(environ)
+        session = await self.open_session(request)
+        if endpoint == 'main.movie_events':
+            return await self.serve_events(environ, request, session, receive, send)
+        # 刚提交过修改的用户从主库读取，与 app.route_reads 相同
+        engine = self.engine
+        if self.read_engine is not None and session.get('read_primary_until', 0) <= time.time():
+            engine = self.read_engine
+        async with engine.connect() as conn:
+            data = environ['watchlist.prefetched'] = await self.prefetchers[endpoint](
+                conn, endpoint, view_args, request, session)
+        if self.can_inline(request, session, data):
+            await self.call_inline(environ, send)
+        else:
+            await self.call_threaded(environ, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def close(self):
+        if self.live_poller is not None:
+            self.live_poller.cancel()
+        for engine in (self.engine, self.read_engine):
+            if engine is not None:
+                await engine.dispose()
+        self.executor.shutdown(wait=False)
+
+    # 只有GET/HEAD请求并且端点有预查询函数时在事件循环中处理；
+    # 使用只读快照时，请求中可能要用SQLite备份接口重新生成快照，全部交给线程池处理。
+    # 实时更新的变更记录总是从主库读取，不受只读快照影响
+    def match(self, environ):
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return None
+        try:
+            endpoint, view_args = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return None
+        if endpoint == 'main.movie_events':
+            if environ['REQUEST_METHOD'] != 'GET' or not self.app.config['LIVE_UPDATES']:
+                return None
+            return endpoint, view_args
+        if endpoint not in self.prefetchers:
+            return None
+        if self.app.config['READ_SNAPSHOT_INTERVAL'] and not self.app.config['SQLALCHEMY_READ_URI']:
+            return None
+        return endpoint, view_args
+
+    # sqlite session存储读取文件，在线程池中打开session
+    async def open_session(self, request):
+        interface = self.app.session_interface
+        if self.app.config['SESSION_STORE'] == 'sqlite':
+            loop = asyncio.get_running_loop()
+            session = await loop.run_in_executor(self.executor, interface.open_session, self.app, request)
+        else:
+            session = interface.open_session(self.app, request)
+        return session or {}
+
+    # 事件循环中不能有阻塞I/O，否则其他连接都要等待。以下请求预查询之后仍然交给线程池处理：
+    # sqlite session存储在响应时写文件；开启分析时结果保存到文件；
+    # 用记住我Cookie恢复登录时，Flask-Login会同步查询用户
+    def can_inline(self, request, session, data):
+        config = self.app.config
+        if config['SESSION_STORE'] == 'sqlite' or config['PROFILING']:
+            return False
+        if session.get('_user_id') is not None:
+            return 'user' in data
+        return config.get('REMEMBER_COOKIE_NAME', COOKIE_NAME) not in request.cookies
+
+    # 预查询的数据，格式见 app.load_prefetched
+    async def prefetch_viewer(self, conn, session, data):
+        try:
+            user_id = int(session.get('_user_id'))
+        except (TypeError, ValueError):
+            return None
+        row = (await conn.execute(select(users).where(users.c.id == user_id))).first()
+        user = User(**row._mapping) if row is not None else None
+        data['user'] = (user_id, user)
+        return user
+
+    async def prefetch_default_owner(self, conn, data, users_version):
+        owner = user_cache.get(('owner', users_version))
+        if owner is None:
+            owner = profile_from_row((await conn.execute(select(users).order_by(users.c.id).limit(1))).first())
+            data['owner'] = (None, owner)
+        return owner
+
+    async def prefetch_versions(self, conn, data, *names):
+        known = data.setdefault('cache_versions', (None, {}))[1]
+        names = [name for name in names if name not in known]
+        if names:
+            rows = await conn.execute(select(versions).where(versions.c.name.in_(names)))
+            found = {row.name: (row.version, row.updated_at) for row in rows}
+            for name in names:
+                known[name] = found.get(name, (0, None))
+        return known
+
+    async def prefetch_watchlist(self, conn, endpoint, view_args, request, session):
+        data = {}
+        config = self.app.config
+        viewer = await self.prefetch_viewer(conn, session, data)
+        known = await self.prefetch_versions(conn, data, 'users', *([watchlist_key(viewer.id)] if viewer else []))
+        users_version = known['users'][0]
+
+        # 与 user_watchlist、list_owner 和 get_owner 确定的列表主人相同
+        username = view_args.get('username') or (request.args.get('user') if endpoint == 'main.api_list_movies' else None)
+        if username:
+            owner = user_cache.get(('user', users_version, username))
+            if owner is None:
+                owner = profile_from_row((await conn.execute(select(users).where(users.c.username == username))).first())
+                data['profile'] = (username, owner)
+            if owner is None and viewer is None:
+                # 用户不存在时返回的404页面中显示站点主人
+                await self.prefetch_default_owner(conn, data, users_version)
+        elif viewer is not None:
+            owner = OwnerProfile(viewer.id, viewer.name, viewer.username)
+        else:
+            owner = await self.prefetch_default_owner(conn, data, users_version)
+        if owner is None:
+            return data
+        version = (await self.prefetch_versions(conn, data, watchlist_key(owner.id)))[watchlist_key(owner.id)][0]
+
+        after = request.args.get('after', type=int)
+        before = request.args.get('before', type=int) if endpoint != 'main.api_list_movies' else None
+        listing = MovieListing.from_args(request.args)
+        limit = request.args.get('limit', type=int)
+        if limit is not None:
+            limit = max(1, min(limit, config['MOVIES_MAX_PER_PAGE']))
+        if endpoint != 'main.api_list_movies':
+            if user_cache.get(('count', owner.id, version)) is None:
+                count = (await conn.execute(select(func.count(movies.c.id)).where(movies.c.user_id == owner.id))).scalar()
+                data['count'] = (owner.id, count)
+            if config['LIVE_UPDATES'] and user_cache.get(('changes', owner.id, version)) is None:
+                seq = (await conn.execute(select(func.max(changes.c.seq)).where(changes.c.user_id == owner.id))).scalar()
+                data['changes'] = (owner.id, seq or 0)
+            editable = viewer is not None and viewer.id == owner.id
+            stream = request.args.get('stream', type=int, default=int(config['STREAM_INDEX']))
+            if not stream and fragment_cache.get(fragment_key(owner.id, version, endpoint, editable, after, before, limit,
+                                                                 listing)) is not None:
+                return data
+        page_limit = limit or config['MOVIES_PER_PAGE']
+        rows = (await conn.execute(page_select(owner.id, after, before, page_limit, listing))).all()
+        data['page'] = ((owner.id, after, before, page_limit, listing), rows)
+        return data
+
+    async def prefetch_movie(self, conn, endpoint, view_args, request, session):
+        data = {}
+        movie_id = view_args['movie_id']
+        query = select(movies.c.id, movies.c.title, movies.c.year, movies.c.poster).where(movies.c.id == movie_id)
+        if endpoint == 'main.edit':
+            # 编辑页面只能打开自己列表中的条目
+            viewer = await self.prefetch_viewer(conn, session, data)
+            if viewer is None:
+                return data
+            query = query.where(movies.c.user_id == viewer.id)
+            data['movie'] = ((movie_id, viewer.id), (await conn.execute(query)).first())
+        else:
+            data['movie'] = ((movie_id, None), (await conn.execute(query)).first())
+        return data
+
+    # 实时更新，与 app.movie_events 相同：列表主人和起始序号用异步驱动查询，之后从进程内广播的缓冲区中读取变化，
+    # 只有需要从数据库补齐时才临时占用线程池中的一个线程
+    async def serve_events(self, environ, request, session, receive, send):
+        config = self.app.config
+        username = request.args.get('user')
+        if not username and session.get('_user_id') is None and \
+                config.get('REMEMBER_COOKIE_NAME', COOKIE_NAME) in request.cookies:
+            return await self.call_threaded(environ, receive, send)
+        since = request.headers.get('Last-Event-ID', type=int)
+        if since is None:
+            since = request.args.get('since', type=int)
+        async with self.engine.connect() as conn:
+            # 与 list_owner 和 get_owner 确定的列表主人相同
+            if username:
+                owner = (await conn.execute(select(users.c.id).where(users.c.username == username))).first()
+            else:
+                owner = await self.prefetch_viewer(conn, session, {})
+                if owner is None:
+                    owner = (await conn.execute(select(users.c.id).order_by(users.c.id).limit(1))).first()
+            if owner is None:
+                # 返回与Flask相同的404页面
+                return await self.call_threaded(environ, receive, send)
+            owner_id = owner.id
+            horizon = (await self.prefetch_versions(conn, {}, 'changes'))['changes'][0]
+            cursor = since
+            if cursor is None:
+                cursor = (await conn.execute(select(func.max(changes.c.seq)))).scalar() or 0
+
+        if not self.live.connect(threaded=False):
+            await send({'type': 'http.response.start', 'status': 503,
+                        'headers': encode_headers([('Content-Type', 'text/plain; charset=utf-8'),
+                                                   ('Retry-After', str(config['LIVE_HEARTBEAT']))])})
+            await send({'type': 'http.response.body', 'body': b'Too many live connections.\n'})
+            return
+        self.live_clients += 1
+        if self.live_poller is None:
+            self.live_changed = asyncio.Event()
+            self.live_poller = asyncio.ensure_future(self.poll_live())
+        loop = asyncio.get_running_loop()
+        disconnect = asyncio.ensure_future(wait_disconnect(receive))
+
+        def replay(cursor, latest):
+            with self.app.app_context():
+                return replay_changes(owner_id, cursor, latest, horizon)
+
+        async def send_messages(messages):
+            if messages:
+                await send({'type': 'http.response.body', 'body': ''.join(messages).encode('utf-8'),
+                            'more_body': True})
+
+        try:
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': encode_headers([('Content-Type', 'text/event-stream; charset=utf-8'),
+                                                   ('Cache-Control', 'no-cache'), ('X-Accel-Buffering', 'no')])})
+            await send_messages([live_retry_message(config)])
+            deadline = time.time() + config['LIVE_MAX_SECONDS']
+            while True:
+                timeout = min(config['LIVE_HEARTBEAT'], deadline - time.time())
+                events, latest = await self.wait_live(owner_id, cursor, max(0, timeout), disconnect)
+                if disconnect.done():
+                    return
+                if events is None:
+                    messages, cursor = await loop.run_in_executor(self.executor, replay, cursor, latest)
+                    await send_messages(messages)
+                    if cursor is None:
+                        break
+                    continue
+                messages, cursor = live_messages(events, cursor, latest)
+                await send_messages(messages)
+                if time.time() >= deadline:
+                    break
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnect.cancel()
+            self.live_clients -= 1
+            self.live.disconnect(threaded=False)
+
+    # 与 ChangeBroadcaster.wait 相同，在事件循环中等待轮询任务的通知
+    async def wait_live(self, owner_id, cursor, timeout, disconnect):
+        deadline = time.time() + timeout
+        while True:
+            changed = self.live_changed
+            events, latest = self.live.pending(owner_id, cursor)
+            remaining = deadline - time.time()
+            if events is None or events or remaining <= 0 or disconnect.done():
+                return events, latest
+            waiter = asyncio.ensure_future(changed.wait())
+            await asyncio.wait((waiter, disconnect), timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+
+    # 有连接时每 LIVE_POLL_INTERVAL 秒在线程池中查询一次变更记录，然后唤醒全部连接；
+    # 本进程提交写入后 ChangeBroadcaster.notify 会立即触发一次查询
+    async def poll_live(self):
+        loop = asyncio.get_running_loop()
+        wake = asyncio.Event()
+
+        def listener():
+            loop.call_soon_threadsafe(wake.set)
+
+        self.live.listeners.append(listener)
+        try:
+            while self.live_clients:
+                wake.clear()
+                await loop.run_in_executor(self.executor, self.live.poll, True)
+                changed, self.live_changed = self.live_changed, asyncio.Event()
+                changed.set()
+                try:
+                    await asyncio.wait_for(wake.wait(), self.app.config['LIVE_POLL_INTERVAL'])
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.live.listeners.remove(listener)
+            self.live_poller = None
+
+    # 数据已经查询好，直接在事件循环中调用Flask程序
+    async def call_inline(self, environ, send):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'], response['headers'] = int(status.split(' ', 1)[0]), headers
+
+        iterable = self.app(environ, start_response)
+        try:
+            body = b''.join(iterable)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+        await send({'type': 'http.response.start', 'status': response['status'],
+                    'headers': encode_headers(response['headers'])})
+        await send({'type': 'http.response.body', 'body': body})
+
+    # 其他请求在线程池中处理，响应内容（包括流式响应）生成后逐块发送
+    # 同一个响应只在一个线程中迭代，stream_with_context 推入的上下文不会跨线程
+    # 队列有长度限制，客户端接收慢时工作线程阻塞等待；客户端断开后停止迭代并关闭响应（例如 /events 的长连接）
+    async def call_threaded(self, environ, receive, send):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(self.app.config['ASGI_QUEUE_SIZE'])
+        disconnected = threading.Event()
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def run():
+            try:
+                iterable = self.app(environ, lambda status, headers, exc_info=None: put(('start', (status, headers))))
+                try:
+                    for chunk in iterable:
+                        if disconnected.is_set():
+                            break
+                        if chunk:
+                            put(('body', chunk))
+                finally:
+                    if hasattr(iterable, 'close'):
+                        iterable.close()
+            finally:
+                put(('end', None))
+
+        future = loop.run_in_executor(self.executor, run)
+        disconnect = asyncio.ensure_future(wait_disconnect(receive))
+        start = None
+        started = False
+        kind = None
+        try:
+            while True:
+                get = asyncio.ensure_future(queue.get())
+                await asyncio.wait((get, disconnect), return_when=asyncio.FIRST_COMPLETED)
+                if not get.done():
+                    get.cancel()
+                    return
+                kind, value = get.result()
+                if kind == 'start':
+                    start = value
+                    continue
+                if kind == 'end':
+                    await future # 程序出错时抛出异常，由ASGI服务器返回500
+                if not started:
+                    await send({'type': 'http.response.start', 'status': int(start[0].split(' ', 1)[0]),
+                                'headers': encode_headers(start[1])})
+                    started = True
+                if kind == 'end':
+                    await send({'type': 'http.response.body', 'body': b''})
+                    return
+                await send({'type': 'http.response.body', 'body': value, 'more_body': True})
+        finally:
+            disconnect.cancel()
+            # 客户端断开或发送出错：通知工作线程停止，取出剩余的块让它不再阻塞，直到响应关闭
+            if kind != 'end':
+                disconnected.set()
+                while kind != 'end':
+                    kind = (await queue.get())[0]
@@ -0,0 +1,936 @@
+# 性能测试脚本，不依赖外部服务，直接在本地运行：
+#   python benchmark.py --help
+#   python benchmark.py sqlite --rows 100000 --duration 5
+#   python benchmark.py routes --movies 10000 --clients 8 --server wsgi
+#   python benchmark.py login --hash-workers 0 --hash-workers 4
+#   python benchmark.py compression --movies 100
+#   python benchmark.py coldstart --runs 5
+#   python benchmark.py users --users 1 --users 100 --movies-per-user 1000
+#   python benchmark.py reads --writers 2 --readers 8 --snapshot-interval 1
+#   python benchmark.py writes --clients 1 --clients 8 --clients 32 --synchronous FULL
+#   python benchmark.py asgi --connections 100 --connections 1000 --think 100
+# 加上 --json 参数时输出机器可读的结果，方便在不同提交之间对比
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.client import HTTPConnection
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import build_opener, HTTPCookieProcessor, Request
+
+import click
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from werkzeug.serving import make_server, BaseWSGIServer, ThreadedWSGIServer, WSGIRequestHandler
+
+from app import create_app, db, Movie, MovieChange, User, SQLITE_PROFILES, sqlite_engine_options, listen_sqlite_pragmas, password_hasher
+from app import fragment_cache
+
+
+@click.group()
+def cli():
+    """Watchlist benchmarks"""
+
+
+# 当前提交，写入JSON结果中用于对比
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# 进程的峰值常驻内存（MiB），Linux上ru_maxrss的单位是KiB，macOS上是字节
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+# 输出结果：默认为对齐的表格，--json 时每行一个JSON对象
+def emit(results, as_json):
+    if as_json:
+        commit = git_commit()
+        for result in results:
+            click.echo(json.dumps(dict(result, commit=commit), sort_keys=True))
+        return
+    columns = list(results[0].keys())
+    widths = [max(len(str(column)), *(len(format_value(r[column])) for r in results)) for column in columns]
+    click.echo('  '.join(str(c).ljust(w) for c, w in zip(columns, widths)))
+    for result in results:
+        click.echo('  '.join(format_value(result[c]).ljust(w) for c, w in zip(columns, widths)))
+
+
+def format_value(value):
+    return '%.1f' % value if isinstance(value, float) else str(value)
+
+
+# 在临时文件中创建并填充movie表，条目轮流分配给ID为 1..users 的用户
+# movie表上的触发器会写入变更记录，所以同时创建movie_change表
+def seed_database(engine, rows, users=1, batch_size=10000):
+    Movie.metadata.create_all(engine, tables=[Movie.__table__, MovieChange.__table__])
+    insert = Movie.__table__.insert()
+    with engine.begin() as connection:
+        for start in range(0, rows, batch_size):
+            connection.execute(insert, [
+                {'title': 'Movie %d' % i, 'year': 1900 + i % 120, 'user_id': 1 + i % users}
+                for i in range(start, min(start + batch_size, rows))
+            ])
+
+
+# 读取吞吐量测试：多个线程按主键和键集分页读取，同时一个线程不断插入并提交
+@cli.command()
+@click.option('--rows', default=100000, show_default=True, help='Movies to seed')
+@click.option('--readers', default=4, show_default=True, help='Concurrent reader threads')
+@click.option('--duration', default=5.0, show_default=True, help='Seconds to run each profile')
+@click.option('--profile', 'profiles', multiple=True, type=click.Choice(sorted(SQLITE_PROFILES)),
+              help='Profiles to compare (default: all)')
+@click.option('--json', 'as_json', is_flag=True, help='Emit JSON Lines')
+def sqlite(rows, readers, duration, profiles, as_json):
+    """Read throughput under concurrent writes for each SQLite profile"""
+    results = []
+    for profile in profiles or ('default', 'tuned'):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            pragmas = SQLITE_PROFILES[profile]
+            engine = create_engine('sqlite:///' + os.path.join(tmpdir, 'bench.db'),
+                                   **sqlite_engine_options(pragmas, readers + 1, 0))
+            listen_sqlite_pragmas(engine, pragmas)
+            seed_database(engine, rows)
+            results.append(run_sqlite_workload(engine, profile, rows, readers, duration))
+            engine.dispose()
+        finally:
+            shutil.rmtree(tmpdir)
+    emit(results, as_json)
+
+
+def run_sqlite_workload(engine, profile, rows, readers, duration):
+    table = Movie.__table__
+    stop = threading.Event()
+    counts = {'reads': 0, 'writes': 0, 'read_errors': 0, 'write_errors': 0}
+    lock = threading.Lock()
+
+    def count(name):
+        with lock:
+            counts[name] += 1
+
+    def reader():
+        while not stop.is_set():
+            after = random.randint(0, rows)
+            try:
+                with engine.connect() as connection:
+                    connection.execute(table.select().where(table.c.id == after)).fetchall()
+                    connection.execute(table.select().where(table.c.id > after)
+                                       .order_by(table.c.id).limit(100)).fetchall()
+                count('reads')
+            except OperationalError:
+                count('read_errors')
+
+    def writer():
+        while not stop.is_set():
+            try:
+                with engine.begin() as connection:
+                    connection.execute(table.insert(), {'title': 'New Movie', 'year': 2020, 'user_id': 1})
+                count('writes')
+            except OperationalError:
+                count('write_errors')
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)] + [threading.Thread(target=writer)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    return {
+        'benchmark': 'sqlite',
+        'profile': profile,
+        'rows': rows,
+        'readers': readers,
+        'reads_per_sec': counts['reads'] / duration,
+        'writes_per_sec': counts['writes'] / duration,
+        'read_errors': counts['read_errors'],
+        'write_errors': counts['write_errors'],
+    }
+
+
+# 被测试的路由，{id} 会替换为随机的电影ID，login=True 表示需要先登录
+ROUTES = [
+    {'name': 'index', 'path': '/'},
+    {'name': 'index_page', 'path': '/?after={id}'},
+    {'name': 'login', 'path': '/login'},
+    {'name': 'search', 'path': '/search?q=movie+{id}'},
+    {'name': 'api_list', 'path': '/api/movies?after={id}'},
+    {'name': 'edit', 'path': '/movie/edit/{id}', 'login': True},
+    {'name': 'settings', 'path': '/settings', 'login': True},
+]
+
+
+# 测试客户端：直接在进程内调用WSGI程序，不经过网络
+class TestClient(object):
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def login(self, username, password):
+        response = self.client.post('/login', data={'username': username, 'password': password})
+        response.close()
+        return response.status_code
+
+    def get(self, path):
+        response = self.client.get(path)
+        response.close()
+        return response.status_code
+
+    def post(self, path, data):
+        response = self.client.post(path, data=data)
+        response.close()
+        return response.status_code
+
+    def post_json(self, path, data):
+        response = self.client.post(path, json=data)
+        response.close()
+        return response.status_code
+
+
+# HTTP客户端：请求本地启动的多线程WSGI服务器
+class HTTPClient(object):
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()))
+
+    def login(self, username, password):
+        try:
+            with self.opener.open(self.base_url + '/login',
+                                  urlencode({'username': username, 'password': password}).encode()) as response:
+                response.read()
+                return response.status
+        except HTTPError as e:
+            return e.code
+
+    def get(self, path):
+        try:
+            with self.opener.open(self.base_url + path) as response:
+                response.read()
+                return response.status
+        except HTTPError as e:
+            return e.code
+
+    def post(self, path, data):
+        try:
+            with self.opener.open(self.base_url + path, urlencode(data).encode()) as response:
+                response.read()
+                return response.status
+        except HTTPError as e:
+            return e.code
+
+    def post_json(self, path, data):
+        request = Request(self.base_url + path, json.dumps(data).encode(), {'Content-Type': 'application/json'})
+        try:
+            with self.opener.open(request) as response:
+                response.read()
+                return response.status
+        except HTTPError as e:
+            return e.code
+
+
+# 路由延迟测试：生成指定规模的数据，然后用多个并发客户端依次请求每个路由
+@cli.command()
+@click.option('--movies', default=10000, show_default=True, help='Size of the synthetic watchlist')
+@click.option('--clients', default=8, show_default=True, help='Concurrent clients')
+@click.option('--requests', 'total', default=400, show_default=True, help='Requests per route')
+@click.option('--server', type=click.Choice(['test-client', 'wsgi']), default='test-client', show_default=True,
+              help='Drive the app in-process or through a local threaded WSGI server')
+@click.option('--route', 'names', multiple=True, type=click.Choice([r['name'] for r in ROUTES]),
+              help='Routes to run (default: all)')
+@click.option('--json', 'as_json', is_flag=True, help='Emit JSON Lines')
+def routes(movies, clients, total, server, names, as_json):
+    """Latency and throughput of each route against a synthetic watchlist"""
+    results = []
+    with bench_app(movies, server) as (app, make_client):
+        for route in ROUTES:
+            if names and route['name'] not in names:
+                continue
+            result = run_route(route, make_client, movies, clients, total)
+            result.update(server=server, movies=movies, clients=clients)
+            results.append(result)
+    emit(results, as_json)
+
+
+# 在临时数据库中准备测试数据和用户 bench/bench（ID为1），返回程序实例和用于创建客户端的函数
+# users 大于1时另外创建 user2、user3……，条目平均分配给所有用户；config 中的配置覆盖默认值
+@contextmanager
+def bench_app(movies, server, users=1, config=None):
+    tmpdir = tempfile.mkdtemp()
+    httpd = None
+    try:
+        app = create_app(dict({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tmpdir, 'bench.db'),
+                               'LOGIN_RATE_LIMIT': sys.maxsize}, **(config or {})))
+        with app.app_context():
+            db.create_all()
+            user = User(name='Bench', username='bench')
+            user.set_password('bench')
+            db.session.add(user)
+            db.session.commit()
+            db.session.execute(User.__table__.insert(), [
+                {'name': 'User %d' % i, 'username': 'user%d' % i} for i in range(2, users + 1)])
+            db.session.commit()
+            seed_database(db.engine, movies, users)
+
+        if server == 'wsgi':
+            httpd = make_server('127.0.0.1', 0, app, threaded=True)
+            threading.Thread(target=httpd.serve_forever, daemon=True).start()
+            base_url = 'http://127.0.0.1:%d' % httpd.server_port
+            yield app, lambda: HTTPClient(base_url)
+        else:
+            yield app, lambda: TestClient(app)
+    finally:
+        if httpd is not None:
+            httpd.shutdown()
+        shutil.rmtree(tmpdir)
+
+
+def run_route(route, make_client, movies, clients, total):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    per_client = max(1, total // clients)
+
+    # 每个客户端有自己的会话Cookie，登录不计入测试时间
+    sessions = []
+    for _ in range(clients):
+        client = make_client()
+        if route.get('login'):
+            client.login('bench', 'bench')
+        sessions.append(client)
+
+    def worker(client):
+        local = []
+        failed = 0
+        for _ in range(per_client):
+            path = route['path'].format(id=random.randint(1, movies))
+            start = time.perf_counter()
+            status = client.get(path)
+            local.append(time.perf_counter() - start)
+            if status >= 400:
+                failed += 1
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker, args=(client,)) for client in sessions]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'benchmark': 'routes',
+        'route': route['name'],
+        'requests': len(latencies),
+        'errors': errors[0],
+        'rps': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+# 登录吞吐量测试：一组客户端不断登录，同时另一组客户端请求主页，
+# 对比在请求线程中计算散列和使用散列进程池时两者的吞吐量和主页延迟
+@cli.command()
+@click.option('--movies', default=1000, show_default=True, help='Size of the synthetic watchlist')
+@click.option('--login-clients', default=8, show_default=True, help='Clients posting to /login')
+@click.option('--index-clients', default=8, show_default=True, help='Clients requesting /')
+@click.option('--duration', default=5.0, show_default=True, help='Seconds to run each configuration')
+@click.option('--hash-workers', 'worker_counts', multiple=True, type=int,
+              help='HASH_WORKERS values to compare (default: 0 and the CPU count)')
+@click.option('--server', type=click.Choice(['test-client', 'wsgi']), default='wsgi', show_default=True)
+@click.option('--json', 'as_json', is_flag=True, help='Emit JSON Lines')
+def login(movies, login_clients, index_clients, duration, worker_counts, server, as_json):
+    """Login throughput alongside concurrent / traffic"""
+    results = []
+    with bench_app(movies, server) as (app, make_client):
+        for workers in worker_counts or (0, os.cpu_count() or 1):
+            password_hasher.shutdown()
+            app.config['HASH_WORKERS'] = workers
+            result = run_login_workload(make_client, login_clients, index_clients, duration)
+            result.update(hash_workers=workers, server=server)
+            results.append(result)
+    password_hasher.shutdown()
+    emit(results, as_json)
+
+
+def run_login_workload(make_client, login_clients, index_clients, duration):
+    stop = threading.Event()
+    lock = threading.Lock()
+    logins = []
+    index_latencies = []
+    errors = {'login': 0, 'index': 0}
+
+    def login_worker(client):
+        count = failed = 0
+        while not stop.is_set():
+            if client.login('bench', 'bench') >= 400:
+                failed += 1
+            count += 1
+        with lock:
+            logins.append(count)
+            errors['login'] += failed
+
+    def index_worker(client):
+        local = []
+        failed = 0
+        while not stop.is_set():
+            start = time.perf_counter()
+            if client.get('/') >= 400:
+                failed += 1
+            local.append(time.perf_counter() - start)
+        with lock:
+            index_latencies.extend(local)
+            errors['index'] += failed
+
+    threads = [threading.Thread(target=login_worker, args=(make_client(),)) for _ in range(login_clients)]
+    threads += [threading.Thread(target=index_worker, args=(make_client(),)) for _ in range(index_clients)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    index_latencies.sort()
+    return {
+        'benchmark': 'login',
+        'login_rps': sum(logins) / duration,
+        'login_errors': errors['login'],
+        'index_rps': len(index_latencies) / duration,
+        'index_p95_ms': percentile(index_latencies, 95) * 1000,
+        'index_p99_ms': percentile(index_latencies, 99) * 1000,
+        'index_errors': errors['index'],
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+# 压缩效果测试：分别在关闭/开启模板压缩和响应压缩时请求主页，
+# 记录传输的字节数和首字节时间（TTFB），流式渲染和普通渲染各测一次
+@cli.command()
+@click.option('--movies', default=100, show_default=True, help='Size of the synthetic watchlist')
+@click.option('--limit', default=100, show_default=True, help='Movies per page')
+@click.option('--requests', 'total', default=50, show_default=True, help='Requests per configuration')
+@click.option('--encoding', default='gzip', show_default=True, help='Accept-Encoding sent by the client')
+@click.option('--json', 'as_json', is_flag=True, help='Emit JSON Lines')
+def compression(movies, limit, total, encoding, as_json):
+    """Bytes sent and time-to-first-byte for the list page"""
+    results = []
+    with bench_app(movies, 'wsgi') as (app, make_client):
+        base_url = make_client().base_url
+        for minify, compress in ((False, False), (True, False), (False, True), (True, True)):
+            set_minify(app, minify)
+            app.config['COMPRESSION_ENABLED'] = compress
+            for stream in (0, 1):
+                path = '/?limit=%d&stream=%d' % (limit, stream)
+                result = measure_transfer(base_url, path, encoding, total)
+                result.update(minify=minify, compression=encoding if compress else None, stream=bool(stream))
+                results.append(result)
+    emit(results, as_json)
+
+
+# 模板在编译时压缩，切换设置后需要清空已编译的模板和渲染缓存
+def set_minify(app, enabled):
+    app.jinja_env.minify_templates = enabled
+    app.jinja_env.trim_blocks = app.jinja_env.lstrip_blocks = enabled
+    app.jinja_env.cache.clear()
+    fragment_cache.clear()
+
+
+def measure_transfer(base_url, path, encoding, total):
+    host, port = base_url.rsplit('/', 1)[1].split(':')
+    ttfb = []
+    elapsed = []
+    size = 0
+    for _ in range(total):
+        connection = HTTPConnection(host, int(port))
+        start = time.perf_counter()
+        connection.request('GET', path, headers={'Accept-Encoding': encoding})
+        response = connection.getresponse()
+        first = response.read(1)
+        ttfb.append(time.perf_counter() - start)
+        body = first + response.read()
+        elapsed.append(time.perf_counter() - start)
+        size = len(body)
+        connection.close()
+    ttfb.sort()
+    elapsed.sort()
+    return {
+        'benchmark': 'compression',
+        'bytes': size,
+        'ttfb_p50_ms': percentile(ttfb, 50) * 1000,
+        'ttfb_p95_ms': percentile(ttfb, 95) * 1000,
+        'total_p50_ms': percentile(elapsed, 50) * 1000,
+    }
+
+
+# 多用户测试：每个用户的条目数不变，总用户数（也就是总条目数）增加时，单个用户的列表延迟应该保持不变
+USER_ROUTES = [
+    {'name': 'user_page', 'path': '/u/bench?after={id}'},
+    {'name': 'user_search', 'path': '/search?user=bench&q=movie+{id}'},
+    {'name': 'user_api', 'path': '/api/movies?user=bench&after={id}'},
+]
+
+
+@cli.command()
+@click.option('--movies-per-user', default=1000, show_default=True, help='Movies owned by each user')
+@click.option('--users', 'user_counts', multiple=True, type=int, help='Total users to compare (default: 1, 10 and 100)')
+@click.option('--requests', 'total', default=200, show_default=True, help='Requests per route')
+@click.option('--json', 'as_json', is_flag=True, help='Emit JSON Lines')
+def users(movies_per_user, user_counts, total, as_json):
+    """Per-user list latency as the number of users grows"""
+    results = []
+    for count in user_counts or (1, 10, 100):
+        movies = movies_per_user * count
+        with bench_app(movies, 'test-client', users=count) as (app, make_client):
+            for route in USER_ROUTES:
+                result = run_route(route, make_client, movies, 1, total)
+                result.update(users=count, total_movies=movies)
+                results.append(result)
+    emit(results, as_json)
+
+
+# 冷启动测试：在新的Python进程中依次导入app模块、创建程序实例、处理前两个请求，分别计时
+COLDSTART_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app(json.loads(sys.argv[1]))
+created = time.perf_counter()
+client = application.test_client()
+status = client.get('/').status_code
+first = time.perf_counter()
+client.get('/')
+second = time.perf_counter()
+print(json.dumps({'import': imported - start, 'create_app': created - imported,
+                  'first_request': first - created, 'second_request': second - first, 'status': status}))
+'''
+
+COLDSTART_MODES = [
+    # 模板在第一个请求时才编译，不使用字节码缓存
+    {'name': 'lazy', 'precompile': False, 'cache': None},
+    # 创建实例时编译全部模板，缓存目录为空（部署后的第一个worker）
+    {'name': 'precompile-cold', 'precompile': True, 'cache': 'cold'},
+    # 创建实例时从缓存目录读取编译结果（之后的worker和重启）
+    {'name': 'precompile-warm', 'precompile': True, 'cache': 'warm'},
+]
+
+
+@cli.command()
+@click.option('--movies', default=100, show_default=True, help='Size of the synthetic watchlist')
+@click.option('--runs', default=5, show_default=True, help='Fresh processes per mode')
+@click.option('--json', 'as_json', is_flag=True, help='Emit JSON Lines')
+def coldstart(movies, runs, as_json):
+    """Import, app creation and first-request time in a fresh process"""
+    results = []
+    with bench_app(movies, 'test-client') as (app, make_client):
+        database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+        warm_cache = tempfile.mkdtemp()
+        try:
+            for mode in COLDSTART_MODES:
+                samples = []
+                for _ in range(runs + 1):
+                    cache_dir = warm_cache if mode['cache'] == 'warm' else None
+                    if mode['cache'] == 'cold':
+                        cache_dir = tempfile.mkdtemp()
+                    try:
+                        samples.append(run_coldstart({'SQLALCHEMY_DATABASE_URI': database_uri,
+                                                      'PRECOMPILE_TEMPLATES': mode['precompile'],
+                                                      'TEMPLATE_CACHE_DIR': cache_dir}))
+                    finally:
+                        if mode['cache'] == 'cold':
+                            shutil.rmtree(cache_dir)
+                # 第一次运行用来预热操作系统的文件缓存和warm模式的缓存目录，不计入结果
+                samples = samples[1:]
+                result = {'benchmark': 'coldstart', 'mode': mode['name'], 'runs': runs}
+                for key in ('import', 'create_app', 'first_request', 'second_request'):
+                    values = sorted(sample[key] for sample in samples)
+                    result[key + '_ms'] = percentile(values, 50) * 1000
+                result['ready_ms'] = result['import_ms'] + result['create_app_ms'] + result['first_request_ms']
+                results.append(result)
+        finally:
+            shutil.rmtree(warm_cache)
+    emit(results, as_json)
+
+
+def run_coldstart(config):
+    output = subprocess.check_output([sys.executable, '-c', COLDSTART_SCRIPT, json.dumps(config)],
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+    sample = json.loads(output.decode().strip().splitlines()[-1])
+    if sample['status'] != 200:
+        raise click.ClickException('First request returned %d' % sample['status'])
+    return sample
+
+
+# 读写分离测试：写入客户端不停提交新条目，同时匿名客户端请求主页，
+# 比较全部读取主库和GET请求读取快照时主页的延迟，以及写入的吞吐量
+@cli.command()
+@click.option('--movies', default=10000, show_default=True, help='Size of the synthetic watchlist')
+@click.option('--writers', default=2, show_default=True, help='Logged-in clients posting new movies')
+@click.option('--readers', default=8, show_default=True, help='Anonymous clients requesting /')
+@click.option('--duration', default=5.0, show_default=True, help='Seconds to run each configuration')
+@click.option('--snapshot-interval', default=1.0, show_default=True, help='READ_SNAPSHOT_INTERVAL in seconds')
+@click.option('--server', type=click.Choice(['test-client', 'wsgi']), default='wsgi', show_default=True)
+@click.option('--json', 'as_json', is_flag=True, help='Emit JSON Lines')
+def reads(movies, writers, readers, duration, snapshot_interval, server, as_json):
+    """Index latency under concurrent writes, primary vs read snapshot"""
+    results = []
+    with bench_app(movies, server) as (app, make_client):
+        with app.app_context():
+            app.config['READ_SNAPSHOT_PATH'] = os.path.join(os.path.dirname(db.engine.url.database), 'snapshot.db')
+        for mode, interval in (('primary', None), ('snapshot', snapshot_interval)):
+            app.config['READ_SNAPSHOT_INTERVAL'] = interval
+            result = run_read_workload(make_client, writers, readers, duration)
+            result.update(reads=mode, server=server)
+            results.append(result)
+    emit(results, as_json)
+
+
+def run_read_workload(make_client, writers, readers, duration):
+    stop = threading.Event()
+    lock = threading.Lock()
+    writes = []
+    index_latencies = []
+    errors = {'write': 0, 'index': 0}
+
+    def write_worker(client):
+        count = failed = 0
+        while not stop.is_set():
+            if client.post('/', {'title': 'Written %d' % count, 'year': '2020'}) >= 400:
+                failed += 1
+            count += 1
+        with lock:
+            writes.append(count)
+            errors['write'] += failed
+
+    def index_worker(client):
+        local = []
+        failed = 0
+        while not stop.is_set():
+            start = time.perf_counter()
+            if client.get('/') >= 400:
+                failed += 1
+            local.append(time.perf_counter() - start)
+        with lock:
+            index_latencies.extend(local)
+            errors['index'] += failed
+
+    write_clients = [make_client() for _ in range(writers)]
+    for client in write_clients:
+        client.login('bench', 'bench')
+    threads = [threading.Thread(target=write_worker, args=(client,)) for client in write_clients]
+    threads += [threading.Thread(target=index_worker, args=(make_client(),)) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    index_latencies.sort()
+    return {
+        'benchmark': 'reads',
+        'write_rps': sum(writes) / duration,
+        'write_errors': errors['write'],
+        'index_rps': len(index_latencies) / duration,
+        'index_p50_ms': percentile(index_latencies, 50) * 1000,
+        'index_p95_ms': percentile(index_latencies, 95) * 1000,
+        'index_errors': errors['index'],
+    }
+
+
+# 写入吞吐量测试：多个登录的客户端不停通过 POST /api/movies 添加条目，
+# 比较每个请求单独提交和合并提交（GROUP_COMMIT）的写入速度和延迟；
+# --synchronous FULL 时每次提交都要fsync，更接近数据写入必须落盘的部署；
+# 合并提交保证返回前写入已经落盘，NORMAL时提交者的连接同样使用FULL
+@cli.command()
+@click.option('--movies', default=1000, show_default=True, help='Size of the synthetic watchlist')
+@click.option('--clients', 'client_counts', multiple=True, type=int, help='Concurrent writers to compare (default: 1, 8 and 32)')
+@click.option('--duration', default=5.0, show_default=True, help='Seconds to run each configuration')
+@click.option('--synchronous', type=click.Choice(['OFF', 'NORMAL', 'FULL']), default='NORMAL', show_default=True,
+              help='PRAGMA synchronous for the database')
+@click.option('--max-batch', default=64, show_default=True, help='GROUP_COMMIT_MAX_BATCH')
+@click.option('--max-delay', default=2.0, show_default=True, help='GROUP_COMMIT_MAX_DELAY in milliseconds')
+@click.option('--server', type=click.Choice(['test-client', 'wsgi']), default='wsgi', show_default=True)
+@click.option('--json', 'as_json', is_flag=True, help='Emit JSON Lines')
+def writes(movies, client_counts, duration, synchronous, max_batch, max_delay, server, as_json):
+    """Write throughput, per-request commits vs group commit"""
+    results = []
+    config = {'SQLITE_PRAGMAS': OrderedDict(SQLITE_PROFILES['tuned'], synchronous=synchronous),
+              'GROUP_COMMIT_MAX_BATCH': max_batch, 'GROUP_COMMIT_MAX_DELAY': max_delay / 1000.0}
+    with bench_app(movies, server, config=config) as (app, make_client):
+        for clients in client_counts or (1, 8, 32):
+            for mode in ('per-request', 'group'):
+                app.config['GROUP_COMMIT'] = mode == 'group'
+                writer = app.extensions['watchlist_writes']
+                writer.batches = writer.writes = 0
+                result = run_write_workload(make_client, clients, duration)
+                result.update(commit=mode, clients=clients, synchronous=synchronous, server=server,
+                              avg_batch=writer.writes / writer.batches if writer.batches else 1.0)
+                results.append(result)
+    emit(results, as_json)
+
+
+def run_write_workload(make_client, clients, duration):
+    stop = threading.Event()
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+
+    def write_worker(client, number):
+        local = []
+        failed = 0
+        while not stop.is_set():
+            start = time.perf_counter()
+            if client.post_json('/api/movies', {'title': 'Written %d-%d' % (number, len(local)), 'year': 2020}) >= 400:
+                failed += 1
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    write_clients = [make_client() for _ in range(clients)]
+    for client in write_clients:
+        client.login('bench', 'bench')
+    threads = [threading.Thread(target=write_worker, args=(client, number))
+               for number, client in enumerate(write_clients)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    return {
+        'benchmark': 'writes',
+        'write_rps': len(latencies) / duration,
+        'write_p50_ms': percentile(latencies, 50) * 1000,
+        'write_p95_ms': percentile(latencies, 95) * 1000,
+        'write_errors': errors[0],
+    }
+
+# 并发连接测试：大量客户端各自保持一个连接（服务器支持时使用keep-alive），每隔 --think 毫秒请求一次，
+# 比较同步WSGI服务器（每个连接一个线程；或像 gunicorn --threads 那样使用固定大小的线程池）和ASGI入口（uvicorn）。
+# --slow 模拟慢速客户端：请求头分两次发送，中间等待 --think 毫秒，同步服务器在这段时间里一直占用一个线程
+@cli.command('asgi')
+@click.option('--movies', default=1000, show_default=True, help='Size of the synthetic watchlist')
+@click.option('--connections', 'connection_counts', multiple=True, type=int,
+              help='Concurrent keep-alive connections to compare (default: 10, 100 and 1000)')
+@click.option('--requests', 'per_connection', default=5, show_default=True, help='Requests per connection')
+@click.option('--think', default=100.0, show_default=True, help='Milliseconds each client waits between requests')
+@click.option('--path', default='/', show_default=True, help='Path to request')
+@click.option('--slow', is_flag=True, help='Send each request in two parts, --think ms apart')
+@click.option('--server', 'servers', multiple=True, type=click.Choice(['wsgi-threads', 'wsgi-pool', 'asgi']),
+              help='Servers to compare (default: all)')
+@click.option('--json', 'as_json', is_flag=True, help='Emit JSON Lines')
+def asgi_command(movies, connection_counts, per_connection, think, path, slow, servers, as_json):
+    """Keep-alive concurrency: sync WSGI servers vs the ASGI entry point"""
+    # 客户端和服务器端的连接都需要文件描述符
+    resource.setrlimit(resource.RLIMIT_NOFILE, (resource.getrlimit(resource.RLIMIT_NOFILE)[1],) * 2)
+    results = []
+    with bench_app(movies, 'test-client') as (app, make_client):
+        for server in servers or ('wsgi-threads', 'wsgi-pool', 'asgi'):
+            with serve(server, app) as port:
+                for connections in connection_counts or (10, 100, 1000):
+                    # 客户端在独立的进程中运行，不与服务器争用GIL；同时记录服务器进程的最大线程数
+                    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor, \
+                            ThreadSampler() as sampler:
+                        result = executor.submit(client_process, port, path, connections, per_connection,
+                                                 think / 1000.0, slow).result()
+                    result.update(peak_threads=sampler.peak, peak_rss_mb=peak_rss_mb())
+                    result.update(server=server, connections=connections, slow=slow)
+                    results.append(result)
+    emit(results, as_json)
+
+
+class ThreadSampler(object):
+    def __enter__(self):
+        self.peak = threading.active_count()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def sample(self):
+        while not self.stop.wait(0.01):
+            self.peak = max(self.peak, threading.active_count())
+
+    def __exit__(self, *exc_info):
+        self.stop.set()
+        self.thread.join()
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class ThreadedBenchServer(ThreadedWSGIServer):
+    request_queue_size = 4096
+
+
+# 固定数量的线程处理连接，一个keep-alive连接在关闭之前一直占用一个线程
+class PooledWSGIServer(BaseWSGIServer):
+    multithread = True
+    request_queue_size = 4096
+
+    def __init__(self, host, port, app, threads):
+        super(PooledWSGIServer, self).__init__(host, port, app, handler=QuietHandler)
+        self.executor = ThreadPoolExecutor(threads)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+@contextmanager
+def serve(server, app):
+    if server == 'asgi':
+        try:
+            import uvicorn
+        except ImportError:
+            raise click.ClickException('The asgi server needs uvicorn: pip install uvicorn aiosqlite')
+        from asgi import WatchlistASGI
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        httpd = uvicorn.Server(uvicorn.Config(WatchlistASGI(app), log_level='warning', lifespan='on', backlog=4096))
+        thread = threading.Thread(target=httpd.run, kwargs={'sockets': [sock]}, daemon=True)
+        thread.start()
+        while not httpd.started:
+            time.sleep(0.01)
+        try:
+            yield sock.getsockname()[1]
+        finally:
+            httpd.should_exit = True
+            thread.join()
+        return
+    if server == 'wsgi-pool':
+        httpd = PooledWSGIServer('127.0.0.1', 0, app, app.config['ASGI_THREADS'])
+    else:
+        httpd = ThreadedBenchServer('127.0.0.1', 0, app, handler=QuietHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        yield httpd.server_port
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+async def read_response(reader):
+    head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+    headers = dict((name.strip().lower(), value.strip()) for name, _, value in
+                   (line.partition(':') for line in head[1:] if line))
+    keep_alive = head[0].startswith('HTTP/1.1') and headers.get('connection', '').lower() != 'close'
+    if 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    elif headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    else:
+        await reader.read()
+        keep_alive = False
+    return int(head[0].split()[1]), keep_alive
+
+
+def client_process(port, path, connections, per_connection, think, slow):
+    resource.setrlimit(resource.RLIMIT_NOFILE, (resource.getrlimit(resource.RLIMIT_NOFILE)[1],) * 2)
+    return asyncio.run(run_connections(port, path, connections, per_connection, think, slow))
+
+
+async def run_connections(port, path, connections, per_connection, think, slow=False, timeout=60.0):
+    latencies = []
+    errors = [0]
+    request = ('GET %s HTTP/1.1\r\nHost: 127.0.0.1\r\n' % path).encode('latin-1')
+
+    async def client():
+        writer = None
+        if slow:
+            await asyncio.sleep(random.uniform(0, think)) # 慢速客户端的请求错开到达
+        for i in range(per_connection):
+            if i and not slow:
+                await asyncio.sleep(think)
+            start = time.perf_counter()
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+                writer.write(request)
+                if slow:
+                    await writer.drain()
+                    await asyncio.sleep(think)
+                writer.write(b'\r\n')
+                status, keep_alive = await asyncio.wait_for(read_response(reader), timeout)
+            except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                errors[0] += 1
+                if writer is not None:
+                    writer.close()
+                writer = None
+                continue
+            latencies.append(time.perf_counter() - start)
+            if status >= 400:
+                errors[0] += 1
+            if not keep_alive:
+                writer.close()
+                writer = None
+        if writer is not None:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(connections)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'benchmark': 'asgi',
+        'rps': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'errors': errors[0],
+        'wall_s': elapsed,
+    }
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,48 +1,109 @@
-from app import app, db, Movie, User, forge, initdb
+from app import create_app, db, Movie, User, forge, initdb, login_limiter, asset_dist_path, load_asset_manifest, JOB_HANDLERS
+from app import ProfilingMiddleware, password_hasher, render_poster
+from asgi import create_asgi_app, aiosqlite
 import unittest
+import asyncio
+import os
+import json
+import gzip
+import io
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from sqlalchemy.exc import IntegrityError
 
 
 class WatchListTestCase(unittest.TestCase):
     # 测试flask程序
     def setUp(self):
-        # 更新配置
-        app.config.update(
+        # 使用工厂函数创建程序实例，传入测试配置
+        self.app = create_app({
             # 开启测试模式
-            TESTING=True,
+            'TESTING': True,
             # 启用SQLite内存型数据库，不会干扰开发时使用的数据文件
-            SQLALCEHMY_DATABASE_URI='sqlite:///:memory:'
-        )
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+        })
 
-        # 创建数据库和表
-        db.create_all()
+        # 数据库操作需要在程序上下文中执行
+        # 这里不持续推入上下文，否则测试客户端的请求会共用同一个上下文（包括g中的登录用户）
+        with self.app.app_context():
+            # 创建数据库和表
+            db.create_all()
 
-        # 创建测试数据：一个用户和一个电影条目
-        user = User(name='Test', username='test')
-        user.set_password('123')
-        movie = Movie(title='Test Movie Title', year='2019')
+            # 创建测试数据：一个用户和一个电影条目
+            user = User(name='Test', username='test')
+            user.set_password('123')
+            db.session.add(user)
+            db.session.flush() # 生成用户ID
+            movie = Movie(title='Test Movie Title', year='2019', user_id=user.id)
 
-        # 使用add_all()方法一次添加多个模型实例
-        db.session.add_all([user, movie])
-        db.session.commit()
+            # 使用add_all()方法一次添加多个模型实例
+            db.session.add_all([user, movie])
+            db.session.commit()
 
         # 创建测试客户端, 用来模拟客户端请求
-        self.client = app.test_client()
+        self.client = self.app.test_client()
         # 创建测试命令运行器，用来触发自定义命令
-        self.runner = app.test_cli_runner()
+        self.runner = self.app.test_cli_runner()
 
-    def tearDown(selfs):
-        # 清除数据库会话
-        db.session.remove()
-        # 删除数据库
-        db.drop_all()
+    def tearDown(self):
+        with self.app.app_context():
+            # 清除数据库会话
+            db.session.remove()
+            # 删除数据库
+            db.drop_all()
+
+    # 创建临时目录，测试结束后删除
+    def make_tempdir(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir, ignore_errors=True)
+        return tmpdir
+
+    # 创建使用临时目录的程序实例：多个线程、引擎或驱动需要共享数据库时使用其中的SQLite文件 data.db，
+    # 快照、session、上传文件、海报和分析结果也都写入临时目录。seed 为 True 时创建表和测试用户；
+    # 测试结束后释放数据库连接并删除目录。factory 为 create_asgi_app 时返回ASGI程序
+    def create_temp_app(self, tmpdir=None, factory=create_app, seed=True, **config):
+        tmpdir = tmpdir or self.make_tempdir()
+        options = {
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tmpdir, 'data.db'),
+            'READ_SNAPSHOT_PATH': os.path.join(tmpdir, 'read-snapshot.db'),
+            'SESSION_STORE_PATH': os.path.join(tmpdir, 'sessions.db'),
+            'JOB_UPLOAD_DIR': os.path.join(tmpdir, 'uploads'),
+            'POSTER_DIR': os.path.join(tmpdir, 'posters'),
+            'PROFILE_DIR': os.path.join(tmpdir, 'profiles'),
+        }
+        options.update(config)
+        application = factory(options)
+        app = getattr(application, 'app', application)
+        if seed:
+            with app.app_context():
+                db.create_all()
+                user = User(name='Test', username='test')
+                user.set_password('123')
+                db.session.add(user)
+                db.session.commit()
+        self.addCleanup(self.dispose_app, app)
+        return application
+
+    def dispose_app(self, app):
+        with app.app_context():
+            router = app.extensions['watchlist_reads']
+            if router.enabled:
+                router.get_engine().dispose()
+            db.session.remove()
+            db.engine.dispose()
 
     # 测试程序实例是否存在
     def test_app_existence(self):
-        self.assertIsNotNone(app)
+        self.assertIsNotNone(self.app)
 
     # 测试程序是否处于测试模式
     def test_app_is_in_testing(self):
-        self.assertTrue(app.config['TESTING'])
+        self.assertTrue(self.app.config['TESTING'])
 
     # 测试客户端
     # 调用这类方法返回包含响应数据的响应对象，对这个响应对象调用 get_data() 方法并把 as_text 参数设为 True 可以获取 Unicode 格式的响应主体
@@ -64,6 +125,624 @@ class WatchListTestCase(unittest.TestCase):
         self.assertIn('Test Movie Title', data)
         self.assertEqual(response.status_code, 200)
 
+    # 测试主页分页和流式渲染
+    def test_index_pagination(self):
+        with self.app.app_context():
+            db.session.add_all([Movie(title='Movie %d' % i, year='2020', user_id=1) for i in range(3)])
+            db.session.commit()
+
+        response = self.client.get('/?limit=2')
+        data = response.get_data(as_text=True)
+        self.assertIn('Test Movie Title', data)
+        self.assertIn('Movie 0', data)
+        self.assertNotIn('Movie 1', data)
+        self.assertIn('after=2', data)
+        self.assertNotIn('Prev', data)
+
+        response = self.client.get('/?after=2&limit=2')
+        data = response.get_data(as_text=True)
+        self.assertNotIn('Movie 0', data)
+        self.assertIn('Movie 1', data)
+        self.assertIn('Movie 2', data)
+        self.assertIn('before=3', data)
+        self.assertNotIn('Next', data)
+
+        response = self.client.get('/?before=3&limit=2')
+        data = response.get_data(as_text=True)
+        self.assertIn('Test Movie Title', data)
+        self.assertIn('Movie 0', data)
+        self.assertNotIn('Movie 1', data)
+
+        response = self.client.get('/?stream=1')
+        self.assertTrue(response.is_streamed)
+        data = response.get_data(as_text=True)
+        self.assertIn('Test\'s Watchlist', data)
+        self.assertIn('Movie 2', data)
+
+    # 测试列表排序和按年份筛选
+    def test_index_sorting(self):
+        with self.app.app_context():
+            db.session.add_all([
+                Movie(title='b Movie', year=1999, user_id=1),
+                Movie(title='A Movie', year=2005, user_id=1),
+                Movie(title='C Movie', year=1999, user_id=1),
+            ])
+            db.session.commit()
+
+        # 按标题排序不区分大小写
+        data = self.client.get('/?sort=title').get_data(as_text=True)
+        self.assertLess(data.index('A Movie'), data.index('b Movie'))
+        self.assertLess(data.index('b Movie'), data.index('C Movie'))
+        self.assertLess(data.index('C Movie'), data.index('Test Movie Title'))
+
+        # 翻页链接保留排序方式，从上一页最后一条之后继续
+        data = self.client.get('/?sort=-year&limit=2').get_data(as_text=True)
+        self.assertLess(data.index('Test Movie Title'), data.index('A Movie'))
+        self.assertNotIn('b Movie', data)
+        self.assertIn('after=3&amp;limit=2&amp;sort=-year', data)
+        # 年份相同时按ID倒序
+        data = self.client.get('/?sort=-year&limit=2&after=3').get_data(as_text=True)
+        self.assertLess(data.index('C Movie'), data.index('b Movie'))
+        data = self.client.get('/?sort=-year&limit=2&before=4').get_data(as_text=True)
+        self.assertIn('A Movie', data)
+        self.assertIn('Test Movie Title', data)
+        self.assertNotIn('b Movie', data)
+
+        data = self.client.get('/?year=1999').get_data(as_text=True)
+        self.assertIn('b Movie', data)
+        self.assertIn('C Movie', data)
+        self.assertNotIn('A Movie', data)
+        movies = self.client.get('/api/movies?sort=year&year_min=2000').get_json()['movies']
+        self.assertEqual([movie['title'] for movie in movies], ['A Movie', 'Test Movie Title'])
+
+    # 测试站点主人资料缓存
+    def test_owner_cache(self):
+        self.client.get('/')
+
+        # 记录渲染主页时执行的SQL语句
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        with self.app.app_context():
+            engine = db.engine
+        db.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = self.client.get('/')
+        finally:
+            db.event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertIn('Test\'s Watchlist', response.get_data(as_text=True))
+        self.assertFalse([s for s in statements if 'FROM user' in s])
+
+        # 修改名字后缓存失效
+        self.login()
+        self.client.post('/settings', data=dict(name='Cached'))
+        self.client.get('/logout')
+        response = self.client.get('/')
+        self.assertIn('Cached\'s Watchlist', response.get_data(as_text=True))
+
+    # 测试主页缓存和条件请求
+    def test_index_cache(self):
+        response = self.client.get('/')
+        etag = response.headers['ETag']
+
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(as_text=True), '')
+
+        # 登录用户的页面与匿名页面分开缓存
+        self.login()
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Delete', response.get_data(as_text=True))
+        self.assertIn('private', response.headers['Cache-Control'])
+
+        # 编辑条目后缓存失效
+        self.client.post('/movie/edit/1', data=dict(title='Cache Busted', year='2019'), follow_redirects=True)
+        self.client.get('/logout', follow_redirects=True)
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Cache Busted', response.get_data(as_text=True))
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    # 测试搜索
+    def test_search(self):
+        with self.app.app_context():
+            db.session.add_all([
+                Movie(title='My Neighbor Totoro', year='1988', user_id=1),
+                Movie(title='Dead Poets Society', year='1989', user_id=1),
+                Movie(title='Totoro Returns', year='2020', user_id=1),
+            ])
+            db.session.commit()
+
+        response = self.client.get('/search?q=toto')
+        data = response.get_data(as_text=True)
+        self.assertIn('2 Results', data)
+        self.assertIn('My Neighbor Totoro', data)
+        self.assertNotIn('Dead Poets Society', data)
+
+        response = self.client.get('/search?q=totoro&year=2020')
+        data = response.get_data(as_text=True)
+        self.assertIn('1 Results', data)
+        self.assertIn('Totoro Returns', data)
+
+        response = self.client.get('/search?year=1989')
+        data = response.get_data(as_text=True)
+        self.assertIn('Dead Poets Society', data)
+        self.assertNotIn('Totoro', data)
+
+        # 编辑和删除后索引同步更新
+        with self.app.app_context():
+            movie = Movie.query.filter_by(title='Totoro Returns').first()
+            movie.title = 'Ponyo'
+            db.session.commit()
+        response = self.client.get('/search?q=totoro')
+        self.assertIn('1 Results', response.get_data(as_text=True))
+        response = self.client.get('/search?q=pony')
+        self.assertIn('Ponyo', response.get_data(as_text=True))
+
+        # 特殊字符不会导致查询出错
+        response = self.client.get('/search?q=%22AND%20(')
+        self.assertEqual(response.status_code, 200)
+
+    # 测试JSON API
+    def test_api(self):
+        response = self.client.get('/api/movies')
+        self.assertEqual(response.get_json(), {
+            'movies': [{'id': 1, 'title': 'Test Movie Title', 'year': 2019}],
+            'next': None,
+        })
+        response = self.client.get('/api/movies/1')
+        self.assertEqual(response.get_json()['title'], 'Test Movie Title')
+        response = self.client.get('/api/movies/99')
+        self.assertEqual(response.status_code, 404)
+
+        # 未登录不能修改
+        response = self.client.post('/api/movies', json={'title': 'API Movie', 'year': '2020'})
+        self.assertEqual(response.status_code, 401)
+
+        self.login()
+        response = self.client.post('/api/movies', json={'title': 'API Movie', 'year': 2020})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.get_json(), {'id': 2, 'title': 'API Movie', 'year': 2020})
+        response = self.client.post('/api/movies', json={'title': '', 'year': '2020'})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.patch('/api/movies/2', json={'title': 'API Movie Edited'})
+        self.assertEqual(response.get_json()['year'], 2020)
+        response = self.client.put('/api/movies/2', json={'title': 'API Movie Edited'})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get('/api/movies?limit=1')
+        self.assertEqual(response.get_json()['next'], 1)
+        response = self.client.get('/api/movies?after=1')
+        self.assertEqual(response.get_json()['movies'][0]['title'], 'API Movie Edited')
+
+        response = self.client.delete('/api/movies/2')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.movie_count(), 1)
+
+    # 测试JSON API批量操作
+    def test_api_batch(self):
+        self.login()
+        response = self.client.post('/api/movies/batch', json={
+            'create': [{'title': 'Batch A', 'year': '2001'}, {'title': 'Batch B', 'year': '2002'}],
+            'update': [{'id': 1, 'year': '2018'}],
+        })
+        data = response.get_json()
+        self.assertEqual([movie['title'] for movie in data['created']], ['Batch A', 'Batch B'])
+        self.assertEqual(data['updated'], [{'id': 1, 'title': 'Test Movie Title', 'year': 2018}])
+        self.assertEqual(self.movie_count(), 3)
+
+        # 任何一项失败时整体回滚
+        response = self.client.post('/api/movies/batch', json={
+            'create': [{'title': 'Batch C', 'year': '2003'}],
+            'delete': [2, 99],
+        })
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.movie_count(), 3)
+        with self.app.app_context():
+            self.assertIsNone(Movie.query.filter_by(title='Batch C').first())
+
+        response = self.client.post('/api/movies/batch', json={'delete': [2, 3]})
+        self.assertEqual(response.get_json()['deleted'], [2, 3])
+        self.assertEqual(self.movie_count(), 1)
+
+    # 测试增量同步接口和变更记录压缩
+    def test_api_changes(self):
+        data = self.client.get('/api/changes').get_json()
+        self.assertEqual(data['changes'], [{'id': 1, 'title': 'Test Movie Title', 'year': 2019, 'seq': 1}])
+        since = data['next']
+
+        self.login()
+        self.client.post('/', data=dict(title='Added', year='2020'))
+        self.client.post('/movie/edit/2', data=dict(title='Added Twice', year='2020'))
+        self.client.post('/movie/delete/1')
+        data = self.client.get('/api/changes?since=%d' % since).get_json()
+        # 同一个条目的新增和修改合并为最新的状态，删除的条目只返回ID
+        self.assertEqual(data['changes'], [
+            {'id': 2, 'title': 'Added Twice', 'year': 2020, 'seq': 3},
+            {'id': 1, 'seq': 4, 'deleted': True},
+        ])
+        self.assertFalse(data['has_more'])
+        data = self.client.get('/api/changes?since=%d' % data['next']).get_json()
+        self.assertEqual(data['changes'], [])
+
+        data = self.client.get('/api/changes?since=%d&limit=1' % since).get_json()
+        self.assertTrue(data['has_more'])
+        self.assertEqual(data['next'], 2)
+
+        # 压缩后早于墓碑的 since 需要重新同步，从0同步得到完整的列表
+        result = self.runner.invoke(args=['compact-changes', '--days', '0'])
+        self.assertIn('Removed 2 superseded and 1 expired changes.', result.output)
+        self.assertEqual(self.client.get('/api/changes?since=%d' % since).status_code, 410)
+        data = self.client.get('/api/changes?since=0').get_json()
+        self.assertEqual([change['id'] for change in data['changes']], [2])
+
+    # 测试后台任务：导入、重试、状态接口
+    def test_jobs(self):
+        tmpdir = self.make_tempdir()
+        self.app.config['JOB_UPLOAD_DIR'] = tmpdir
+        self.app.config['JOB_RETRY_DELAY'] = 0
+        try:
+            self.assertEqual(self.client.get('/api/jobs/1').status_code, 401)
+            self.login()
+            movies = [{'title': 'One', 'year': 2001}, {'title': 'Two', 'year': 2002},
+                      {'title': '', 'year': 2003}, {'title': 'Four', 'year': '2004'}]
+            response = self.client.post('/api/import', json={'movies': movies})
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response.get_json()['status'], 'queued')
+            location = response.headers['Location']
+            self.assertEqual(self.movie_count(), 1)
+
+            result = self.runner.invoke(args=['worker', '--burst'])
+            self.assertIn('Processed 1 jobs.', result.output)
+            data = self.client.get(location).get_json()
+            self.assertEqual((data['status'], data['progress'], data['total']), ('done', 4, 4))
+            self.assertEqual(data['result'], {'imported': 3, 'skipped': 1})
+            self.assertEqual(self.movie_count(), 4)
+            self.assertIn('Four', self.client.get('/').get_data(as_text=True))
+            self.assertEqual(os.listdir(tmpdir), []) # 上传的文件导入后删除
+
+            # 失败的任务按重试次数重新执行，用完后标记为失败
+            JOB_HANDLERS['test-fail'] = lambda job: 1 / 0
+            with self.app.app_context():
+                job_id = self.app.extensions['watchlist_jobs'].enqueue('test-fail', user_id=1, max_attempts=2).id
+            result = self.runner.invoke(args=['worker', '--burst'])
+            self.assertIn('Processed 2 jobs.', result.output)
+            data = self.client.get('/api/jobs/%d' % job_id).get_json()
+            self.assertEqual((data['status'], data['attempts']), ('failed', 2))
+            self.assertIn('ZeroDivisionError', data['error'])
+
+            result = self.runner.invoke(args=['enqueue', 'search-index'])
+            self.assertIn('Queued search-index job', result.output)
+            self.runner.invoke(args=['enqueue', 'warm-cache'])
+            self.runner.invoke(args=['worker', '--burst'])
+            result = self.runner.invoke(args=['jobs'])
+            self.assertIn('warm-cache done 1/1', result.output)
+            self.assertIn('search-index done 1/1', result.output)
+            self.assertIn('One', self.client.get('/search?q=one').get_data(as_text=True))
+
+            # 其他用户的任务不可见
+            self.client.get('/logout')
+            with self.app.app_context():
+                other = User(name='Other', username='other')
+                other.set_password('456')
+                db.session.add(other)
+                db.session.commit()
+            self.client.post('/login', data=dict(username='other', password='456'))
+            self.assertEqual(self.client.get(location).status_code, 404)
+        finally:
+            JOB_HANDLERS.pop('test-fail', None)
+
+    # 测试合并提交：并发的写入在一个事务中提交，重复的条目只让对应的请求失败
+    def test_group_commit(self):
+        self.app.config['GROUP_COMMIT'] = True
+        self.runner.invoke(args=['unique-titles'])
+        self.login()
+        response = self.client.post('/', data=dict(title='Grouped', year='2020'), follow_redirects=True)
+        self.assertIn('Grouped', response.get_data(as_text=True))
+        response = self.client.post('/api/movies', json={'title': 'Grouped API', 'year': 2021})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.get_json()['title'], 'Grouped API')
+        self.assertEqual(self.client.get('/api/movies/%d' % response.get_json()['id']).status_code, 200)
+        self.assertEqual(self.client.post('/api/movies', json={'title': 'grouped', 'year': 2020}).status_code, 409)
+
+        app = self.create_temp_app(GROUP_COMMIT=True)
+        app.test_cli_runner().invoke(args=['unique-titles'])
+        writer = app.extensions['watchlist_writes']
+        results = {}
+        # 提交时提交者的连接使用 synchronous=FULL（2），归还连接池后恢复为 NORMAL（1）
+        with app.app_context():
+            engine = db.engine
+        levels = []
+
+        @db.event.listens_for(engine, 'commit')
+        def record_level(conn):
+            cursor = conn.connection.cursor()
+            levels.append(cursor.execute('PRAGMA synchronous').fetchone()[0])
+            cursor.close()
+
+        def add(title):
+            with app.app_context():
+                try:
+                    results[title] = writer.submit(1, Movie.__table__.insert().values(
+                        title=title, year=2020, user_id=1))
+                except IntegrityError:
+                    results[title] = None
+
+        threads = [threading.Thread(target=add, args=(title,)) for title in ('A', 'B', 'a', 'C')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(writer.writes, 4)
+        self.assertEqual(sorted(title for title, movie_id in results.items() if movie_id is None), ['a'])
+        with app.app_context():
+            self.assertEqual(Movie.query.count(), 3)
+        self.assertEqual(set(levels), {2})
+        connections = [engine.connect() for _ in range(app.config['SQLITE_POOL_SIZE'])]
+        self.assertEqual([conn.exec_driver_sql('PRAGMA synchronous').scalar() for conn in connections],
+                         [1] * len(connections))
+        for conn in connections:
+            conn.close()
+
+    # 测试海报上传、缩略图生成和发送
+    def test_posters(self):
+        from PIL import Image
+        tmpdir = self.make_tempdir()
+        self.app.config.update(POSTER_DIR=tmpdir, POSTER_WORKERS=0)
+        image = io.BytesIO()
+        Image.new('RGB', (300, 400), 'red').save(image, 'PNG')
+        self.login()
+        response = self.client.post('/movie/1/poster', data={'poster': (io.BytesIO(image.getvalue()), 'a.png')},
+                                    follow_redirects=True)
+        self.assertIn('Poster uploaded, it will appear in a moment.', response.get_data(as_text=True))
+        self.assertNotIn('srcset', self.client.get('/').get_data(as_text=True))
+
+        result = self.runner.invoke(args=['worker', '--burst'])
+        self.assertIn('Processed 1 jobs.', result.output)
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('92w', data)
+        self.assertIn('342w', data)
+        url = re.search(r'src="(/posters/[0-9a-f]{64}-92\.webp)"', data).group(1)
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'image/webp')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertEqual(Image.open(io.BytesIO(response.data)).size, (92, 138))
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': response.headers['ETag']}).status_code, 304)
+        self.assertEqual(self.client.get(url.replace('-92.', '-93.')).status_code, 404)
+
+        # 同样的图片已经有缩略图，直接设置
+        self.client.post('/', data=dict(title='Second', year='2020'))
+        response = self.client.post('/movie/2/poster', data={'poster': (io.BytesIO(image.getvalue()), 'b.png')},
+                                    follow_redirects=True)
+        self.assertIn('Poster updated.', response.get_data(as_text=True))
+        response = self.client.post('/movie/2/poster', data={'poster': (io.BytesIO(b'not an image'), 'c.png')},
+                                    follow_redirects=True)
+        self.assertIn('Poster must be a JPEG, PNG, GIF or WebP image.', response.get_data(as_text=True))
+
+        # 像素数超过上限的图片不解码（Pillow自己只拒绝2倍以上的图片）
+        source = os.path.join(tmpdir, 'large.png')
+        with open(source, 'wb') as f:
+            f.write(image.getvalue())
+        with self.assertRaises(Image.DecompressionBombError):
+            render_poster(source, (92,), 80, 300 * 400 - 1)
+        self.assertFalse(os.path.exists(source + '-92.webp'))
+        os.remove(source)
+
+        self.client.post('/movie/delete/1')
+        self.client.post('/movie/delete/2')
+        result = self.runner.invoke(args=['prune-posters', '--hours', '0'])
+        self.assertIn('Removed 4 poster files.', result.output)
+
+    # 测试按令牌和比例分析请求，以及查看分析结果
+    def test_profiling(self):
+        tmpdir = self.make_tempdir()
+        self.app.config.update(PROFILING=True, PROFILE_DIR=tmpdir, PROFILE_KEEP=2, PROFILE_INTERVAL=0.001)
+        self.app.wsgi_app = ProfilingMiddleware(self.app.wsgi_app, self.app)
+        token = self.runner.invoke(args=['profile-token', '--mode', 'cprofile']).output.strip()
+        self.assertNotIn('X-Profile-Id', self.client.get('/').headers)
+        self.assertNotIn('X-Profile-Id', self.client.get('/', headers={'X-Profile': token + 'x'}).headers)
+        # 只分析 PROFILE_ENDPOINTS 中的视图
+        self.assertNotIn('X-Profile-Id', self.client.get('/api/movies', headers={'X-Profile': token}).headers)
+
+        # 响应体发送完（关闭响应）时才保存结果
+        with self.client.get('/?_profile=' + token) as response:
+            profile_id = response.headers['X-Profile-Id']
+        result = self.runner.invoke(args=['profiles'])
+        self.assertIn(profile_id, result.output)
+        self.assertIn('cprofile  main.index', result.output)
+        self.assertIn('(index)', self.runner.invoke(args=['profiles', profile_id]).output)
+
+        token = self.runner.invoke(args=['profile-token']).output.strip()
+        self.client.get('/login', headers={'X-Profile': token}).close()
+        self.app.config['PROFILE_SAMPLE_RATE'] = 1
+        with self.client.get('/') as response:
+            profile_id = response.headers['X-Profile-Id']
+        with open(os.path.join(tmpdir, profile_id + '.json')) as f:
+            data = json.load(f)
+        self.assertEqual((data['mode'], data['status']), ('sample', 200))
+        result = self.runner.invoke(args=['profiles', profile_id])
+        self.assertEqual(result.exit_code, 0)
+        for line in result.output.splitlines():
+            self.assertRegex(line, r';.* [0-9]+$') # 折叠格式：栈帧;栈帧 次数
+        # 只保留最近的 PROFILE_KEEP 个结果
+        self.assertEqual(len([name for name in os.listdir(tmpdir) if name.endswith('.json')]), 2)
+
+    # 测试年份校验和标题唯一约束
+    def test_unique_titles(self):
+        self.login()
+        for year in ('abcd', '999', '19999'):
+            response = self.client.post('/', data=dict(title='Bad Year', year=year), follow_redirects=True)
+            self.assertIn('Invalid input.', response.get_data(as_text=True))
+        self.assertEqual(self.movie_count(), 1)
+
+        # 已有重复条目时不能开启
+        self.client.post('/', data=dict(title='test movie title', year='2019'))
+        result = self.runner.invoke(args=['unique-titles'])
+        self.assertIn('Remove duplicate movies first', result.output)
+        self.client.post('/movie/delete/2')
+
+        result = self.runner.invoke(args=['unique-titles'])
+        self.assertIn('Duplicate titles are rejected.', result.output)
+        response = self.client.post('/', data=dict(title=' TEST Movie Title ', year='2019'), follow_redirects=True)
+        self.assertIn('Movie already exists.', response.get_data(as_text=True))
+        response = self.client.post('/api/movies', json={'title': 'Test Movie Title', 'year': 2019})
+        self.assertEqual(response.status_code, 409)
+        # 年份不同的同名条目仍然可以添加
+        response = self.client.post('/api/movies', json={'title': 'Test Movie Title', 'year': 2020})
+        self.assertEqual(response.status_code, 201)
+        url = '/api/movies/%d' % response.get_json()['id']
+        response = self.client.patch(url, json={'year': 2019})
+        self.assertEqual(response.status_code, 409)
+
+        result = self.runner.invoke(args=['unique-titles', '--off'])
+        self.assertIn('Duplicate titles are allowed.', result.output)
+        response = self.client.patch(url, json={'year': 2019})
+        self.assertEqual(response.status_code, 200)
+
+    # 测试实时更新
+    def test_live_events(self):
+        # 默认关闭，页面不连接 /events
+        self.assertNotIn('/events', self.client.get('/').get_data(as_text=True))
+        self.assertEqual(self.client.get('/events').status_code, 404)
+
+        # 连接在补齐和一次等待之后立即结束
+        self.app.config.update(LIVE_UPDATES=True, LIVE_MAX_SECONDS=0, LIVE_POLL_INTERVAL=0)
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('/events?user=test&amp;since=1', data)
+        self.login()
+        self.assertIn('href="/movie/edit/0"', self.client.get('/').get_data(as_text=True))
+
+        # since之后的变化从数据库补齐，删除的条目只有ID
+        self.client.post('/', data=dict(title='Live', year='2020'))
+        self.client.post('/movie/delete/1')
+        response = self.client.get('/events?since=1', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.assertNotIn('Content-Encoding', response.headers)
+        data = response.get_data(as_text=True)
+        self.assertIn('id: 2\nevent: movie\ndata: {"id": 2, "title": "Live", "year": 2020, "seq": 2, "count": 1}', data)
+        self.assertIn('id: 3\nevent: movie\ndata: {"id": 1, "seq": 3, "deleted": true, "count": 1}', data)
+
+        # 之后的变化由进程内广播推送，其他用户的变化只推进序号
+        self.client.post('/movie/edit/2', data=dict(title='Live Edit', year='2020'))
+        with self.app.app_context():
+            other = User(name='Other', username='other')
+            db.session.add(other)
+            db.session.flush()
+            db.session.add(Movie(title='Other Movie', year='2001', user_id=other.id))
+            db.session.commit()
+        data = self.client.get('/events', headers={'Last-Event-ID': '3'}).get_data(as_text=True)
+        self.assertIn('id: 4\nevent: movie\ndata: {"id": 2, "title": "Live Edit", "year": 2020, "seq": 4, "count": 1}', data)
+        self.assertNotIn('Other Movie', data)
+        self.assertIn('id: 5\n: ping', data)
+
+        # 已经被压缩的序号需要重新加载页面
+        self.runner.invoke(args=['compact-changes', '--days', '0'])
+        self.assertIn('event: reset', self.client.get('/events?since=1').get_data(as_text=True))
+
+        self.app.config['LIVE_MAX_CLIENTS'] = 0
+        self.assertEqual(self.client.get('/events').status_code, 503)
+
+    # 测试多用户列表
+    def test_user_watchlists(self):
+        with self.app.app_context():
+            other = User(name='Other', username='other')
+            other.set_password('456')
+            db.session.add(other)
+            db.session.flush()
+            db.session.add(Movie(title='Other Movie', year='2001', user_id=other.id))
+            db.session.commit()
+
+        # 每个用户的页面只显示自己的条目
+        response = self.client.get('/u/other')
+        data = response.get_data(as_text=True)
+        self.assertIn('Other\'s Watchlist', data)
+        self.assertIn('1 Titles', data)
+        self.assertIn('Other Movie', data)
+        self.assertNotIn('Test Movie Title', data)
+        self.assertEqual(self.client.get('/u/nobody').status_code, 404)
+        response = self.client.get('/search?q=movie&user=other')
+        self.assertIn('1 Results', response.get_data(as_text=True))
+        response = self.client.get('/api/movies?user=other')
+        self.assertEqual([movie['title'] for movie in response.get_json()['movies']], ['Other Movie'])
+
+        # 登录后主页是自己的列表，不能修改其他用户的条目
+        self.client.post('/login', data=dict(username='other', password='456'), follow_redirects=True)
+        response = self.client.get('/')
+        data = response.get_data(as_text=True)
+        self.assertIn('Other Movie', data)
+        self.assertIn('Delete', data)
+        self.assertNotIn('Delete', self.client.get('/u/test').get_data(as_text=True))
+        self.assertEqual(self.client.post('/movie/delete/1').status_code, 404)
+        self.assertEqual(self.client.patch('/api/movies/1', json={'title': 'Hijacked'}).status_code, 404)
+
+        response = self.client.post('/u/other', data=dict(title='Added', year='2002'), follow_redirects=True)
+        data = response.get_data(as_text=True)
+        self.assertIn('Item created.', data)
+        self.assertIn('2 Titles', data)
+        response = self.client.get('/u/test')
+        self.assertIn('1 Titles', response.get_data(as_text=True))
+
+    # 测试请求耗时统计
+    def test_metrics(self):
+        response = self.client.get('/')
+        timing = response.headers['Server-Timing']
+        self.assertIn('db;dur=', timing)
+        self.assertIn('queries"', timing)
+        self.assertIn('tpl;dur=', timing)
+        self.assertIn('total;dur=', timing)
+
+        # 没有设置令牌时不开放，令牌错误时拒绝
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        self.app.config['METRICS_TOKEN'] = 'secret'
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code, 403)
+        response = self.client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+        data = response.get_data(as_text=True)
+        self.assertEqual(response.mimetype, 'text/plain')
+        self.assertIn('watchlist_request_duration_seconds_bucket{endpoint="main.index",le="+Inf"}', data)
+        self.assertIn('watchlist_db_queries_total{endpoint="main.index"}', data)
+        self.assertIn('watchlist_requests_total{endpoint="main.index",status="200"}', data)
+
+        # 出错的语句不会在连接上留下开始时间
+        with self.app.app_context(), db.engine.connect() as connection:
+            with self.assertRaises(IntegrityError):
+                connection.execute(User.__table__.insert(), {'id': 1, 'name': 'Duplicate'})
+            self.assertEqual(connection.info['query_start'], [])
+
+    # 测试响应压缩和模板压缩
+    def test_compression(self):
+        response = self.client.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertTrue(response.headers['ETag'].startswith('W/'))
+        data = gzip.decompress(response.get_data()).decode('utf-8')
+        self.assertIn('Test Movie Title', data)
+        # 模板中的HTML注释和缩进不会发送给客户端
+        self.assertNotIn('<!--', data)
+        self.assertNotIn('\n    <li>', data)
+
+        # 带弱ETag的条件请求
+        response = self.client.get('/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+        # 流式响应逐块压缩
+        response = self.client.get('/?stream=1', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Test Movie Title', gzip.decompress(response.get_data()).decode('utf-8'))
+
+        # 小于阈值的响应不压缩
+        response = self.client.get('/api/movies/1', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    # 测试辅助方法，查询电影条目数量
+    def movie_count(self):
+        with self.app.app_context():
+            return Movie.query.count()
+
     # 测试辅助方法，用于登入用户
     # follow_redirects 参数设为 True 可以跟随重定向，最终返回的会是重定向后的响应
     def login(self):
@@ -211,6 +890,45 @@ class WatchListTestCase(unittest.TestCase):
         self.assertNotIn('Login success.', data)
         self.assertIn('Invalid input.', data)
 
+    # 测试登录失败次数限制
+    def test_login_rate_limit(self):
+        self.app.config['LOGIN_RATE_LIMIT'] = 2
+        try:
+            for _ in range(2):
+                self.client.post('/login', data=dict(username='test', password='456'))
+            response = self.client.post('/login', data=dict(username='test', password='123'))
+            self.assertEqual(response.status_code, 429)
+            self.assertIn('Too many failed login attempts', response.get_data(as_text=True))
+        finally:
+            login_limiter.reset()
+
+    # 测试散列计算超时：返回503，任务在进程池中结束之前不归还排队名额
+    def test_login_hash_timeout(self):
+        self.app.config.update(HASH_WORKERS=1, HASH_TIMEOUT=0)
+        with self.app.test_request_context():
+            password_hasher._get_executor()
+        available = password_hasher._slots._value
+        response = self.client.post('/login', data=dict(username='test', password='123'))
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Server busy, please try again later.', response.get_data(as_text=True))
+        self.assertEqual(password_hasher._slots._value, available - 1)
+        deadline = time.time() + 30
+        while password_hasher._slots._value < available and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(password_hasher._slots._value, available)
+
+    # 测试散列强度变化后登录时重新散列
+    def test_login_rehash(self):
+        with self.app.app_context():
+            self.assertFalse(User.query.first().password_needs_rehash())
+            self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+            self.assertTrue(User.query.first().password_needs_rehash())
+        self.login()
+        with self.app.app_context():
+            user = User.query.first()
+            self.assertTrue(user.password_hash.startswith('pbkdf2:sha256:1000$'))
+            self.assertTrue(user.validate_password('123'))
+
     # 测试登出
     def test_logout(self):
         self.login()
@@ -254,7 +972,322 @@ class WatchListTestCase(unittest.TestCase):
     def test_forge_command(self):
         result = self.runner.invoke(forge)
         self.assertIn('Done.', result.output)
-        self.assertNotEqual(Movie.query.count(), 0)
+        self.assertNotEqual(self.movie_count(), 0)
+
+    # 测试预热缓存任务跳过没有用户名的用户（forge 创建的用户）
+    def test_warm_cache_after_forge(self):
+        self.runner.invoke(forge)
+        self.runner.invoke(args=['enqueue', 'warm-cache'])
+        result = self.runner.invoke(args=['worker', '--burst'])
+        self.assertIn('Processed 1 jobs.', result.output)
+        result = self.runner.invoke(args=['jobs'])
+        self.assertIn('warm-cache done 1/1', result.output)
+
+    # 测试批量导入导出
+    def test_import_export_commands(self):
+        tmpdir = self.make_tempdir()
+        source = os.path.join(tmpdir, 'movies.csv')
+        with open(source, 'w') as f:
+            f.write('title,year\nImported A,2001\nImported B,2002\n,2003\nImported C,2003\n')
+
+        result = self.runner.invoke(args=['import-movies', source, '--batch-size', '2'])
+        self.assertIn('Imported 3 movies, skipped 1 invalid rows', result.output)
+        self.assertEqual(self.movie_count(), 4)
+
+        target = os.path.join(tmpdir, 'movies.jsonl')
+        result = self.runner.invoke(args=['export-movies', target])
+        self.assertIn('Exported 4 movies', result.output)
+        with open(target) as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(rows[0], {'title': 'Test Movie Title', 'year': 2019})
+        self.assertEqual(rows[-1], {'title': 'Imported C', 'year': 2003})
+
+        response = self.client.get('/')
+        self.assertIn('Imported C', response.get_data(as_text=True))
+
+    # 测试静态文件构建
+    def test_build_assets_command(self):
+        # 在静态文件的临时副本中构建，不写入项目的 static/dist
+        static_folder = self.app.static_folder
+        self.app.static_folder = os.path.join(self.make_tempdir(), 'static')
+        shutil.copytree(static_folder, self.app.static_folder,
+                        ignore=shutil.ignore_patterns(self.app.config['ASSET_DIST_DIR']))
+        try:
+            result = self.runner.invoke(args=['build-assets'])
+            self.assertIn('Built', result.output)
+            with self.app.app_context():
+                dist = asset_dist_path()
+            with open(os.path.join(dist, 'manifest.json')) as f:
+                manifest = json.load(f)
+            self.assertIn('style.css', manifest)
+
+            response = self.client.get('/')
+            data = response.get_data(as_text=True)
+            url = '/static/dist/' + manifest['style.css']
+            self.assertIn(url, data)
+            # 视频的 poster 是体积很小的第一帧图片，而不是原GIF
+            self.assertIn('images/totoro-poster.webp', manifest)
+            if 'images/totoro.mp4' in manifest:
+                self.assertIn('poster="/static/dist/%s"' % manifest['images/totoro-poster.webp'], data)
+
+            response = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(response.mimetype, 'text/css')
+            self.assertTrue(response.cache_control.immutable)
+            response.close()
+
+            response = self.client.get(url)
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertIn('.movie-list', response.get_data(as_text=True))
+        finally:
+            self.app.static_folder = static_folder
+            with self.app.app_context():
+                load_asset_manifest()
+
+    # 测试升级旧的单用户数据库
+    def test_upgradedb_command(self):
+        tmpdir = self.make_tempdir()
+        path = os.path.join(tmpdir, 'data.db')
+        connection = sqlite3.connect(path)
+        connection.executescript(
+            'CREATE TABLE user (id INTEGER PRIMARY KEY, name VARCHAR(20), username VARCHAR(20), '
+            'password_hash VARCHAR(128));'
+            'CREATE TABLE movie (id INTEGER PRIMARY KEY, title VARCHAR(60), year VARCHAR(4));'
+            "INSERT INTO user (name, username) VALUES ('Old', 'old');"
+            "INSERT INTO movie (title, year) VALUES ('Old Movie', '1999');")
+        connection.close()
+
+        app = self.create_temp_app(tmpdir, seed=False)
+        result = app.test_cli_runner().invoke(args=['upgradedb'])
+        self.assertIn('Upgraded database to version 1.', result.output)
+        self.assertIn('Upgraded database to version 2.', result.output)
+        self.assertIn('Upgraded database to version 3.', result.output)
+        self.assertIn('Upgraded database to version 4.', result.output)
+        self.assertIn('Upgraded database to version 5.', result.output)
+        result = app.test_cli_runner().invoke(args=['upgradedb'])
+        self.assertNotIn('Upgraded', result.output)
+
+        client = app.test_client()
+        data = client.get('/u/old').get_data(as_text=True)
+        self.assertIn('Old Movie', data)
+        self.assertIn('Old Movie', client.get('/search?q=old').get_data(as_text=True))
+        self.assertEqual(client.get('/api/changes?user=old').get_json()['changes'][0]['title'], 'Old Movie')
+        with app.app_context():
+            self.assertEqual(Movie.query.first().user_id, 1)
+            self.assertEqual(db.session.execute(db.text('SELECT typeof(year) FROM movie')).scalar(), 'integer')
+
+    # 测试已有条目不符合新约束时不修改数据库
+    def test_upgradedb_invalid_movies(self):
+        tmpdir = self.make_tempdir()
+        path = os.path.join(tmpdir, 'data.db')
+        connection = sqlite3.connect(path)
+        connection.executescript(
+            'CREATE TABLE user (id INTEGER PRIMARY KEY, name VARCHAR(20), username VARCHAR(20), '
+            'password_hash VARCHAR(128));'
+            'CREATE TABLE movie (id INTEGER PRIMARY KEY, title VARCHAR(60), year VARCHAR(4));'
+            "INSERT INTO user (name, username) VALUES ('Old', 'old');"
+            "INSERT INTO movie (title, year) VALUES ('Old Movie', '1999'), ('Bad Movie', '19xx');")
+        connection.close()
+
+        app = self.create_temp_app(tmpdir, seed=False)
+        result = app.test_cli_runner().invoke(args=['upgradedb'])
+        self.assertIn("Fix or delete these movies before upgrading: #2 'Bad Movie' (19xx)", result.output)
+        self.assertNotIn('Upgraded database to version 3.', result.output)
+        with app.app_context():
+            db.session.execute(db.text("UPDATE movie SET year = '1998' WHERE id = 2"))
+            db.session.commit()
+        result = app.test_cli_runner().invoke(args=['upgradedb'])
+        self.assertIn('Upgraded database to version 3.', result.output)
+        self.assertIn('Bad Movie', app.test_client().get('/u/old').get_data(as_text=True))
+
+    # 测试读写分离：GET请求读取快照，提交修改的用户随后从主库读取
+    def test_read_snapshot(self):
+        app = self.create_temp_app(READ_SNAPSHOT_INTERVAL=3600)
+        writer = app.test_client()
+        reader = app.test_client()
+        self.assertNotIn('Snapshot Movie', reader.get('/').get_data(as_text=True))
+        self.assertTrue(os.path.exists(app.config['READ_SNAPSHOT_PATH']))
+
+        writer.post('/login', data=dict(username='test', password='123'))
+        response = writer.post('/', data=dict(title='Snapshot Movie', year='2020'), follow_redirects=True)
+        self.assertIn('Snapshot Movie', response.get_data(as_text=True))
+        # 其他用户在快照更新之前看不到新条目
+        self.assertNotIn('Snapshot Movie', reader.get('/').get_data(as_text=True))
+
+        router = app.extensions['watchlist_reads']
+        router.take_snapshot()
+        self.assertIn('Snapshot Movie', reader.get('/').get_data(as_text=True))
+
+    # 测试ASGI入口：列表和编辑页面在事件循环中用异步驱动查询，其他请求在线程池中处理
+    def test_asgi(self):
+        application = self.create_temp_app(factory=create_asgi_app)
+        with application.app.app_context():
+            db.session.add(Movie(title='Async Movie', year='2021', user_id=1))
+            db.session.commit()
+
+        # 在事件循环中处理的请求
+        inline = []
+        call_inline = application.call_inline
+
+        async def record_inline(environ, send):
+            inline.append(environ['PATH_INFO'])
+            await call_inline(environ, send)
+        application.call_inline = record_inline
+
+        # disconnect：收到这么多条响应消息后客户端断开
+        async def call(method, path, headers=(), body=b'', disconnect=None):
+            messages = [{'type': 'http.request', 'body': body}]
+            sent = []
+            gone = asyncio.Event()
+
+            async def receive():
+                if messages:
+                    return messages.pop(0)
+                await gone.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+                if disconnect is not None and len(sent) >= disconnect:
+                    gone.set()
+
+            path, _, query = path.partition('?')
+            scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query.encode(),
+                     'headers': list(headers), 'server': ('localhost', 80), 'client': ('127.0.0.1', 1234)}
+            await application(scope, receive, send)
+            return sent[0]['status'], dict(sent[0]['headers']), b''.join(m.get('body', b'') for m in sent[1:])
+
+        async def scenario():
+            try:
+                status, headers, body = await call('GET', '/')
+                self.assertEqual(status, 200)
+                self.assertIn(b'Async Movie', body)
+                if aiosqlite is not None:
+                    self.assertIn(b'"0 queries"', headers[b'server-timing'])
+
+                status, headers, body = await call('GET', '/api/movies/1')
+                self.assertEqual(json.loads(body.decode())['title'], 'Async Movie')
+
+                status, headers, body = await call(
+                    'POST', '/login', headers=[(b'content-type', b'application/x-www-form-urlencoded')],
+                    body=b'username=test&password=123')
+                self.assertEqual(status, 302)
+                cookie = headers[b'set-cookie'].split(b';')[0]
+                status, headers, body = await call('GET', '/movie/edit/1', headers=[(b'cookie', cookie)])
+                self.assertEqual(status, 200)
+                self.assertIn(b'Async Movie', body)
+                self.assertIn(b'Logout', body)
+                status, headers, body = await call('GET', '/movie/edit/1')
+                self.assertEqual(status, 302)
+                if aiosqlite is not None:
+                    self.assertEqual(inline, ['/', '/api/movies/1', '/movie/edit/1', '/movie/edit/1'])
+
+                # 用记住我Cookie恢复登录时Flask-Login会同步查询用户，预查询之后交给线程池处理
+                status, headers, body = await call('GET', '/', headers=[(b'cookie', b'remember_token=1|x')])
+                self.assertEqual(status, 200)
+                self.assertNotIn('/', inline[4:])
+
+                # 预查询到记录不存在时直接返回404，事件循环中不再查询数据库
+                for path, headers in (('/api/movies/99999', []), ('/u/nobody', []),
+                                      ('/movie/edit/99999', [(b'cookie', cookie)])):
+                    status, headers, body = await call('GET', path, headers=headers)
+                    self.assertEqual(status, 404)
+                    if aiosqlite is not None:
+                        self.assertIn(path, inline)
+                        self.assertIn(b'"0 queries"', headers[b'server-timing'])
+
+                # 使用只读快照时请求中可能重新生成快照，交给线程池处理
+                application.app.config['READ_SNAPSHOT_INTERVAL'] = 3600
+                count = len(inline)
+                status, headers, body = await call('GET', '/')
+                self.assertEqual(status, 200)
+                self.assertEqual(len(inline), count)
+                application.app.config['READ_SNAPSHOT_INTERVAL'] = None
+
+                # 实时更新的连接在事件循环中等待，不占用线程池；从数据库补齐时返回与Flask相同的消息
+                application.app.config.update(LIVE_UPDATES=True, LIVE_HEARTBEAT=0.05, LIVE_MAX_SECONDS=0)
+                live = application.app.extensions['watchlist_live']
+                self.assertEqual(live.thread_limit, application.app.config['ASGI_THREADS'] // 2)
+                threaded = []
+                call_threaded = application.call_threaded
+
+                async def record_threaded(environ, receive, send):
+                    threaded.append(environ['PATH_INFO'])
+                    await call_threaded(environ, receive, send)
+                application.call_threaded = record_threaded
+                status, headers, body = await asyncio.wait_for(call('GET', '/events?user=test&since=0'), 10)
+                self.assertEqual(status, 200)
+                self.assertEqual(headers[b'content-type'], b'text/event-stream; charset=utf-8')
+                self.assertIn(b'id: 1\nevent: movie\ndata: {"id": 1, "title": "Async Movie"', body)
+                if aiosqlite is not None:
+                    self.assertEqual(threaded, [])
+                status, headers, body = await call('GET', '/events?user=nobody')
+                self.assertEqual(status, 404)
+
+                # 本进程提交写入后立即唤醒事件循环中等待的连接
+                application.app.config.update(LIVE_HEARTBEAT=5, LIVE_MAX_SECONDS=300)
+                waiting = asyncio.ensure_future(call('GET', '/events?user=test', disconnect=3))
+                await asyncio.sleep(0.2)
+
+                def write():
+                    with application.app.app_context():
+                        db.session.add(Movie(title='Pushed Movie', year='2022', user_id=1))
+                        db.session.commit()
+                await asyncio.get_running_loop().run_in_executor(None, write)
+                status, headers, body = await asyncio.wait_for(waiting, 0.6)
+                self.assertIn(b'"title": "Pushed Movie"', body)
+
+                # 客户端断开后停止等待，连接数归零；在线程池中处理的流式响应同样会关闭
+                application.app.config['LIVE_HEARTBEAT'] = 0.05
+                for cookie_header in ([], [(b'cookie', b'remember_token=1|x')]):
+                    status, headers, body = await asyncio.wait_for(
+                        call('GET', '/events', headers=cookie_header, disconnect=3), 10)
+                    self.assertEqual(status, 200)
+                    self.assertIn(b': ping', body)
+                    self.assertEqual(live.clients, 0)
+                if aiosqlite is not None:
+                    self.assertEqual(threaded, ['/events', '/events'])
+            finally:
+                await application.close()
+
+        asyncio.run(scenario())
+
+    # 测试服务端session：Cookie中只有session ID，GET请求从session中读取用户资料
+    def test_server_session(self):
+        for store in ('memory', 'sqlite'):
+            app = self.create_temp_app(SESSION_STORE=store)
+            with app.app_context():
+                engine = db.engine
+            client = app.test_client()
+
+            def session_cookie():
+                return [cookie.value for cookie in client.cookie_jar if cookie.name == 'session'][0]
+
+            client.post('/login', data=dict(username='bad', password='bad'))
+            anonymous_sid = session_cookie()
+            response = client.post('/login', data=dict(username='test', password='123'), follow_redirects=True)
+            self.assertIn('Login success.', response.get_data(as_text=True))
+            # 登录后更换session ID，Cookie中只有ID
+            self.assertNotEqual(session_cookie(), anonymous_sid)
+            self.assertLess(len(session_cookie()), 50)
+
+            statements = []
+            def before_cursor_execute(conn, cursor, statement, *args):
+                statements.append(statement)
+            db.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+            try:
+                response = client.get('/settings')
+            finally:
+                db.event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+            self.assertIn('value="Test"', response.get_data(as_text=True))
+            self.assertFalse([s for s in statements if 'FROM user' in s])
+
+            # 修改名字后缓存的用户资料失效
+            client.post('/settings', data=dict(name='Renamed'))
+            self.assertIn('value="Renamed"', client.get('/settings').get_data(as_text=True))
+
+            client.get('/logout')
+            self.assertEqual(client.get('/settings').status_code, 302)
 
     # 测试初始化数据库
     def test_initdb_command(self):
@@ -263,14 +1296,16 @@ class WatchListTestCase(unittest.TestCase):
 
     # 测试生成管理员账户
     def test_admin_command(self):
-        db.drop_all()
-        db.create_all()
+        with self.app.app_context():
+            db.drop_all()
+            db.create_all()
         result = self.runner.invoke(args=['admin', '--username', 'duj4', '--password', '123'])
         self.assertIn('Creating user...', result.output)
         self.assertIn('Done.', result.output)
-        self.assertEqual(User.query.count(), 1)
-        self.assertEqual(User.query.first().username, 'duj4')
-        self.assertTrue(User.query.first().validate_password('123'))
+        with self.app.app_context():
+            self.assertEqual(User.query.count(), 1)
+            self.assertEqual(User.query.first().username, 'duj4')
+            self.assertTrue(User.query.first().validate_password('123'))
 
     # 测试更新管理员账户
     def test_admin_command_update(self):
@@ -278,9 +1313,10 @@ class WatchListTestCase(unittest.TestCase):
         result = self.runner.invoke(args=['admin', '--username', 'peter', '--password', '456'])
         self.assertIn('Updating user...', result.output)
         self.assertIn('Done.', result.output)
-        self.assertEqual(User.query.count(), 1)
-        self.assertEqual(User.query.first().username, 'peter')
-        self.assertTrue(User.query.first().validate_password('456'))
+        with self.app.app_context():
+            self.assertEqual(User.query.count(), 1)
+            self.assertEqual(User.query.first().username, 'peter')
+            self.assertTrue(User.query.first().validate_password('456'))
 
 
 if __name__ == '__main__':